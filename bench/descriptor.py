@@ -0,0 +1,66 @@
+#!/usr/bin/env python2
+"""
+Measures per-descriptor CPU and memory costs of Descriptor: creation of new
+descriptors (which hashes their value), creation from a selector that
+includes a hash, metadata serialization and unserialization, as done by
+storage backends and buses.
+
+Reports operations per second, and the size of a descriptor object,
+excluding its attribute values.
+
+Usage: bench/descriptor.py [-n COUNT] [--size BYTES]
+"""
+import argparse
+import sys
+import time
+from rebus.descriptor import Descriptor
+from rebus.tools.serializer import picklev2 as serializer
+
+
+def rate(count, func):
+    start = time.time()
+    for i in xrange(count):
+        func(i)
+    return count / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--count', type=int, default=100000,
+                        help='Number of operations per measure')
+    parser.add_argument('--size', type=int, default=200,
+                        help='Size of descriptor values, in bytes')
+    options = parser.parse_args()
+    count = options.count
+    value = 'x' * options.size
+    root = Descriptor('sample', '/binary/elf', value, agent='inject')
+    child = root.spawn_descriptor('/signature/md5', value, 'hasher')
+    meta = child.serialize_meta(serializer)
+
+    results = [
+        ('new (root)', rate(count, lambda i: Descriptor(
+            'sample', '/binary/elf', value, agent='inject'))),
+        ('new (spawned)', rate(count, lambda i: root.spawn_descriptor(
+            '/signature/md5', value, 'hasher'))),
+        ('new (hashed selector)', rate(count, lambda i: Descriptor(
+            child.label, child.selector, value, child.domain, child.agent,
+            child.precursors, child.version, child.processing_time,
+            child.uuid))),
+        ('serialize_meta', rate(count, lambda i: child.serialize_meta(
+            serializer))),
+        ('serialize', rate(count, lambda i: child.serialize(serializer))),
+        ('unserialize', rate(count, lambda i: Descriptor.unserialize(
+            serializer, meta))),
+        ('unserialize (trusted)', rate(count, lambda i: Descriptor.unserialize(
+            serializer, meta, trusted=True))),
+    ]
+    for name, ops in results:
+        print "%-22s %9.0f ops/s" % (name, ops)
+    size = sys.getsizeof(child)
+    if hasattr(child, '__dict__'):
+        size += sys.getsizeof(child.__dict__)
+    print "%-22s %9d bytes" % ('object size', size)
+
+
+if __name__ == '__main__':
+    main()
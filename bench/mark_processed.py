@@ -0,0 +1,55 @@
+#!/usr/bin/env python2
+"""
+Measures DiskStorage.mark_processed throughput, which is called by the bus
+master each time an agent finishes processing a descriptor.
+
+Compares committing every write (--commit-interval 0, previous behaviour)
+to grouped commits.
+
+Usage: bench/mark_processed.py [-n COUNT] [--commit-interval MS ...]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from rebus.storage import StorageRegistry
+import rebus.storage_backends
+
+rebus.storage_backends.import_all()
+
+
+def run(count, commit_interval):
+    tmpdir = tempfile.mkdtemp('rebus-bench')
+    try:
+        parser = argparse.ArgumentParser()
+        storagecls = StorageRegistry.get('diskstorage')
+        storagecls.add_arguments(parser)
+        options = parser.parse_args(['--path', tmpdir, '--commit-interval',
+                                     str(commit_interval)])
+        store = storagecls(options)
+        selectors = ['/binary/elf/%%%064x' % i for i in xrange(count)]
+        start = time.time()
+        for selector in selectors:
+            store.mark_processed('default', selector, 'agent', '{}')
+        store.store_state()
+        return count / (time.time() - start)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--count', type=int, default=5000,
+                        help='Number of mark_processed calls')
+    parser.add_argument('--commit-interval', type=int, nargs='+',
+                        default=[0, 10, 100],
+                        help='Commit intervals to compare, in milliseconds')
+    options = parser.parse_args()
+    for commit_interval in options.commit_interval:
+        rate = run(options.count, commit_interval)
+        print "commit interval %5d ms: %8.0f mark_processed/s" % (
+            commit_interval, rate)
+
+
+if __name__ == '__main__':
+    main()
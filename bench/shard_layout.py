@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+"""
+Measures DiskStorage performance on a corpus of descriptors sharing the same
+selector prefix, for several numbers of hash-prefix subdirectory levels
+(--shard-levels).
+
+For each number of levels, reports descriptor insertion throughput, time
+needed to rebuild the index by walking the storage directory, and time
+needed to stat every descriptor file.
+
+Usage: bench/shard_layout.py [-n COUNT] [--levels N ...] [--path DIR]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from rebus.descriptor import Descriptor
+from rebus.storage import StorageRegistry
+import rebus.storage_backends
+
+rebus.storage_backends.import_all()
+
+
+def open_storage(path, levels):
+    parser = argparse.ArgumentParser()
+    storagecls = StorageRegistry.get('diskstorage')
+    storagecls.add_arguments(parser)
+    options = parser.parse_args(['--path', path, '--shard-levels',
+                                 str(levels), '--cache-bytes', '0'])
+    return storagecls(options)
+
+
+def run(count, levels, basedir):
+    path = tempfile.mkdtemp('rebus-bench', dir=basedir)
+    try:
+        store = open_storage(path, levels)
+        start = time.time()
+        for i in xrange(count):
+            store.add(Descriptor('sample', '/binary/pe', 'value %d' % i,
+                                 agent='bench'))
+        store.store_state()
+        add_rate = count / (time.time() - start)
+
+        start = time.time()
+        store.db.set_info('layout_version', 0)
+        store = open_storage(path, levels)
+        store.store_state()
+        rebuild_time = time.time() - start
+
+        start = time.time()
+        for domain, selector in store.db.iter_descriptors():
+            os.stat(store._pathFromSelector(domain, selector) + '.meta')
+        stat_time = time.time() - start
+        return add_rate, rebuild_time, stat_time
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--count', type=int, default=1000000,
+                        help='Number of descriptors')
+    parser.add_argument('--levels', type=int, nargs='+', default=[0, 1, 2],
+                        help='Numbers of subdirectory levels to compare')
+    parser.add_argument('--path', default=None,
+                        help='Directory in which storages are created, on '
+                        'the file system to be measured')
+    options = parser.parse_args()
+    for levels in options.levels:
+        add_rate, rebuild_time, stat_time = run(options.count, levels,
+                                                options.path)
+        print "%d levels: %8.0f add/s, index rebuilt in %6.1fs, " \
+            "files stat'ed in %6.1fs" % (levels, add_rate, rebuild_time,
+                                         stat_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+"""
+Compares add, get and find throughput of storage backends, on a corpus of
+small descriptors (links, submissions, signatures) which are typical of
+workloads dominated by per-descriptor overhead.
+
+For each backend, reports descriptor insertion throughput, get_descriptor +
+get_value throughput on random selectors, and find_by_selector and
+find_by_value throughput.
+
+Usage: bench/storage_backends.py [-n COUNT] [--size BYTES]
+    [--backends NAME ...] [--path DIR]
+"""
+import argparse
+import random
+import shutil
+import tempfile
+import time
+from rebus.descriptor import Descriptor
+from rebus.storage import StorageRegistry
+import rebus.storage_backends
+
+rebus.storage_backends.import_all()
+
+#: Selector prefixes of generated descriptors
+PREFIXES = ['/link/', '/submission/', '/signature/md5/', '/signature/sha1/']
+
+#: Number of find requests
+FINDS = 50
+
+
+def open_storage(name, path):
+    parser = argparse.ArgumentParser()
+    storagecls = StorageRegistry.get(name)
+    storagecls.add_arguments(parser)
+    args = []
+    if name != 'ramstorage':
+        args = ['--path', path]
+    return storagecls(parser.parse_args(args))
+
+
+def run(name, count, size, basedir):
+    path = tempfile.mkdtemp('rebus-bench', dir=basedir)
+    try:
+        store = open_storage(name, path)
+        descs = [Descriptor('bench%d' % i, PREFIXES[i % len(PREFIXES)],
+                            ('value %d ' % i).ljust(size, 'x'), agent='bench')
+                 for i in xrange(count)]
+        start = time.time()
+        for desc in descs:
+            store.add(desc)
+        add_rate = count / (time.time() - start)
+
+        selectors = [desc.selector for desc in descs]
+        random.shuffle(selectors)
+        start = time.time()
+        for selector in selectors:
+            store.get_descriptor('default', selector)
+            store.get_value('default', selector)
+        get_rate = count / (time.time() - start)
+
+        start = time.time()
+        for i in xrange(FINDS):
+            store.find_by_selector('default', PREFIXES[i % len(PREFIXES)],
+                                   limit=100, offset=i)
+        find_rate = FINDS / (time.time() - start)
+
+        start = time.time()
+        for i in xrange(FINDS):
+            store.find_by_value('default', '/', 'value %d ' % (i * 7))
+        value_rate = FINDS / (time.time() - start)
+        store.store_state()
+        return add_rate, get_rate, find_rate, value_rate
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--count', type=int, default=20000,
+                        help='Number of descriptors')
+    parser.add_argument('--size', type=int, default=200,
+                        help='Size of descriptor values, in bytes')
+    parser.add_argument('--backends', nargs='+',
+                        default=['ramstorage', 'diskstorage', 'sqlitestorage',
+                                 'segmentstorage'],
+                        help='Storage backends to compare')
+    parser.add_argument('--path', default=None,
+                        help='Directory in which storages are created, on '
+                        'the file system to be measured')
+    options = parser.parse_args()
+    for name in options.backends:
+        rates = run(name, options.count, options.size, options.path)
+        print "%-15s %8.0f add/s, %8.0f get/s, %6.1f find_by_selector/s, " \
+            "%6.1f find_by_value/s" % ((name,) + rates)
+
+
+if __name__ == '__main__':
+    main()
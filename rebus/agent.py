@@ -45,6 +45,11 @@ class Agent(object):
     #: influencing the output.
     _output_altering_options_ = None
 
+    #: Number of internal state checkpoints after which the full internal
+    #: state is stored instead of its changes, so that restoring does not
+    #: replay too many changes
+    STATE_MAX_DELTAS = 1000
+
     @staticmethod
     def register(f):
         return AgentRegistry.register_ref(f, key="_name_")
@@ -84,6 +89,12 @@ class Agent(object):
         self.log.info('Agent {0.name} registered on bus {1._name_} '
                       'with id {0.id}'.format(self, self.bus))
         self.process_slots = defaultdict(dict)
+        #: process slots that have been filled since the last internal state
+        #: checkpoint
+        self._slots_delta = defaultdict(dict)
+        #: number of changes appended to the stored internal state since it
+        #: has been fully stored
+        self._state_deltas = 0
         #: List of currently held locks, for descriptors that are being
         #: processed. Used by Bus when SystemExit or KeyboardInterrupt is
         #: received. Contains tuples of unlock() arguments
@@ -206,6 +217,7 @@ class Agent(object):
             assert fres in self._process_slots_
             slots = self.process_slots[uuid]
             slots[fres] = selector
+            self._slots_delta[uuid][fres] = selector
             self.log.info("Filling slot %s for %s. Filling level %i/%i." %
                           (fres, uuid, len(slots), len(self._process_slots_)))
             if not self.slots_are_processable(slots):
@@ -382,34 +394,90 @@ class Agent(object):
     def request_processing(self, domain, selector, targets):
         return self.bus.request_processing(self.id, domain, selector, targets)
 
+    def _checkpoints_deltas(self):
+        """
+        Returns True if changes of the internal state can be stored: the
+        agent implements get_internal_state_delta(), or its only state is
+        process slots.
+        """
+        cls = self.__class__
+        return (cls.get_internal_state_delta !=
+                Agent.get_internal_state_delta or
+                cls.get_internal_state == Agent.get_internal_state)
+
     def save_internal_state(self):
         """
         Send internal state to storage. Called at agent shutdown, if persistent
-        storage is in use.
+        storage is in use. Only changes since the last checkpoint are sent if
+        possible.
         """
+        if self._checkpoints_deltas() and \
+                self._state_deltas < self.STATE_MAX_DELTAS:
+            self.checkpoint_internal_state()
+            return
         state = self.get_internal_state()
         if state or self._process_slots_:
             complete_state = (state, self.process_slots)
-            self.log.info("Save internal state %r" % (complete_state,))
+            self.log.debug("Save internal state %r" % (complete_state,))
             # TODO move serialization to bus
-            self.bus.store_internal_state(self.id,
-                                          cPickle.dumps(complete_state))
+            serialized = cPickle.dumps(complete_state)
+            self.log.info("Save internal state (%d bytes)", len(serialized))
+            self.bus.store_internal_state(self.id, serialized)
+            self._slots_delta.clear()
+            self._state_deltas = 0
+
+    def checkpoint_internal_state(self):
+        """
+        Called periodically by the bus: sends changes of the internal state
+        since the last checkpoint to storage, or the full internal state if
+        the agent does not implement get_internal_state_delta().
+        """
+        if not self._checkpoints_deltas() or \
+                self._state_deltas >= self.STATE_MAX_DELTAS:
+            self.save_internal_state()
+            return
+        state_delta = self.get_internal_state_delta()
+        if state_delta is None and not self._slots_delta:
+            return
+        # TODO move serialization to bus
+        delta = cPickle.dumps((state_delta, dict(self._slots_delta)))
+        self.log.debug("Checkpoint internal state (%d bytes)", len(delta))
+        self.bus.append_internal_state(self.id, delta)
+        self._slots_delta.clear()
+        self._state_deltas += 1
 
     def restore_internal_state(self):
         """
-        Retrieve internal state from storage.
+        Retrieve internal state from storage, then replay changes that have
+        been appended to it, by chunks.
         """
         state_ps = self.bus.load_internal_state(self.id)
-        self.log.info("Restore state: %r" % state_ps)
+        self.log.info("Restore state (%d bytes)", len(state_ps))
         if state_ps:
             # TODO move serialization to bus
             state, ps = cPickle.loads(state_ps)
             if self._process_slots_:
-                self.log.info("Restore process slot state: %r" % ps)
+                self.log.debug("Restore process slot state: %r" % ps)
                 self.process_slots = ps
             if state:
-                self.log.info("Restore internal state: %r" % state)
+                self.log.debug("Restore internal state: %r" % state)
                 self.set_internal_state(state)
+        position = 0
+        while True:
+            deltas, position = self.bus.load_internal_state_deltas(self.id,
+                                                                   position)
+            if not deltas:
+                break
+            for delta in deltas:
+                state_delta, slots_delta = cPickle.loads(delta)
+                for uuid, slots in slots_delta.iteritems():
+                    self.process_slots[uuid].update(slots)
+                if state_delta is not None:
+                    self.apply_internal_state_delta(state_delta)
+            self._state_deltas += len(deltas)
+        if self._state_deltas:
+            self.log.info("Restored %d internal state changes",
+                          self._state_deltas)
 
     # These are the main methods that agents may overload
     def init_agent(self):
@@ -486,6 +554,29 @@ class Agent(object):
         """
         return
 
+    def get_internal_state_delta(self):
+        """
+        May be overridden by agents that have a large internal state, together
+        with apply_internal_state_delta(). Only changes are then stored at
+        each checkpoint and at shutdown; the full state (get_internal_state())
+        is stored once in a while.
+
+        Return a picklable data structure describing changes of the internal
+        state since the previous call, or None if it has not changed.
+        """
+        return
+
+    def apply_internal_state_delta(self, delta):
+        """
+        Called when restoring the internal state, after set_internal_state(),
+        for each delta returned by get_internal_state_delta(), in order.
+        Applying a delta to a state that already contains it must not fail
+        (ex. adding an item to a set).
+
+        :param delta: data structure returned by get_internal_state_delta()
+        """
+        return
+
     def __repr__(self):
         return self.id
 
@@ -39,25 +39,21 @@ class Inject(Agent):
             start = time.time()
             label = self.config['label'] if self.config['label'] else \
                 os.path.basename(f)
-            try:
-                data = open(f).read()
-            except IOError as e:
-                if e.errno != os.errno.ENOENT:
-                    raise
+            if not os.path.isfile(f):
                 self.log.warning("File [%s] not found" % f)
                 continue
-            if self.config['printable']:
-                data = unicode(data)
-
             selector = self.config['selector'] if self.config['selector'] \
-                else guess_selector(buf=data, label=label)
-            done = time.time()
+                else guess_selector(fname=f, label=label)
             if self.config["random_hash"]:
-                create_new = Descriptor.new_with_randomhash
+                selector = Descriptor.random_hash_selector(selector)
+            if self.config['printable']:
+                data = unicode(open(f).read())
+                desc = Descriptor(label, selector, data, self.domain,
+                                  agent=self._name_, **dparam)
             else:
-                create_new = Descriptor
-
-            desc = create_new(label, selector, data, self.domain,
-                              agent=self._name_, processing_time=(done-start),
-                              **dparam)
+                # the file is hashed by chunks, its contents are read by the
+                # bus or storage
+                desc = Descriptor.from_file(label, selector, f, self.domain,
+                                            agent=self._name_, **dparam)
+            desc.processing_time = time.time() - start
             self.push(desc)
@@ -17,11 +17,18 @@ class Search(Agent):
                                help="Selector prefix")
         subparser.add_argument("value_regex", nargs=1, help="Regex that the "
                                "value has to match (from its beginning)")
+        subparser.add_argument("--limit", type=int, default=0,
+                               help="Maximum number of results, 0 for no "
+                               "limit")
+        subparser.add_argument("--offset", type=int, default=0,
+                               help="Number of results to skip")
 
     def run(self):
         matches = self.bus.find_by_value(self, self.config['domain'],
                                          self.config['selector_prefix'][0],
-                                         self.config['value_regex'][0])
+                                         self.config['value_regex'][0],
+                                         self.config['limit'],
+                                         self.config['offset'])
         if len(matches) == 0:
             sys.stdout.write('No match found.\n')
         for match in matches:
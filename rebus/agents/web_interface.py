@@ -293,6 +293,10 @@ class Application(tornado.web.Application):
 
 
 class DescriptorStore(object):
+    #: Values larger than this size, in bytes, are not fetched to display a
+    #: preview
+    PREVIEW_MAX_SIZE = 64 << 10
+
     def __init__(self, agent, async):
 
         self.async = async
@@ -381,8 +385,11 @@ class DescriptorStore(object):
 
         descrinfos = []
         for desc in descriptors:
-            printablevalue = desc.value if isinstance(desc.value, unicode) \
-                else ''
+            value_size = desc.value_size
+            printablevalue = ''
+            if value_size is None or value_size <= self.PREVIEW_MAX_SIZE:
+                if isinstance(desc.value, unicode):
+                    printablevalue = desc.value
             if len(printablevalue) > 80:
                 printablevalue = (printablevalue[:80] + '...')
 
@@ -395,6 +402,7 @@ class DescriptorStore(object):
                 'fullselector': desc.selector,
                 'label': desc.label,
                 'printablevalue': printablevalue,
+                'value_size': value_size,
                 'processing_time': format(desc.processing_time, '.3f'),
                 'precursors': desc.precursors,
                 'version': desc.version,
@@ -161,7 +161,7 @@ class Bus(object):
         raise NotImplementedError
 
     def find_by_value(self, agent_id, desc_domain, selector_prefix,
-                      value_regex):
+                      value_regex, limit=0, offset=0):
         """
         Returns a list of matching descriptors:
         * desc.domain == desc_domain
@@ -172,6 +172,9 @@ class Bus(object):
         :param desc_domain: string, domain in which to look for descriptors
         :param selector_prefix: search prefix for the Descriptors
         :param value_regex: regex that the Descriptors' values should match
+        :param limit: int, max number of matching descriptors to return.
+            Unlimited if 0.
+        :param offset: int, number of matching descriptors to skip.
         """
         raise NotImplementedError
 
@@ -238,6 +241,25 @@ class Bus(object):
         """
         raise NotImplementedError
 
+    def get_lineage(self, agent_id, desc_domain, selector, ancestors=False,
+                    max_depth=0, max_count=0, selector_prefix=''):
+        """
+        Returns a list of (depth, descriptor) couples: descendants of selector
+        (or its ancestors, if ancestors is True), in breadth-first order.
+        Values of returned descriptors are fetched when accessed.
+
+        :param agent_id: current agent id
+        :param desc_domain: string, domain in which to look for descriptors
+        :param selector: string
+        :param ancestors: boolean, walk precursors instead of children
+        :param max_depth: int, max distance from selector. Unlimited if 0.
+        :param max_count: int, max number of descriptors to return.
+            Unlimited if 0.
+        :param selector_prefix: only return descriptors whose selector starts
+            with this prefix
+        """
+        raise NotImplementedError
+
     def store_internal_state(self, agent_id, state):
         """
         Called by agents that need their serialized internal state to be
@@ -259,6 +281,29 @@ class Bus(object):
         """
         raise NotImplementedError
 
+    def append_internal_state(self, agent_id, delta):
+        """
+        Called by agents to store a serialized change of their internal
+        state, which is appended to the state stored by
+        store_internal_state().
+
+        :param agent_id: current agent id
+        :param delta: Agent's serialized state change. Will not be
+            interpreted by the bus or storage
+        """
+        raise NotImplementedError
+
+    def load_internal_state_deltas(self, agent_id, position=0):
+        """
+        Called by agents to fetch changes that have been appended to their
+        internal state, by chunks. Returns (deltas, next_position), where
+        deltas is a list of strings, empty once all deltas have been fetched.
+
+        :param agent_id: current agent id
+        :param position: 0, or next_position returned by the previous call
+        """
+        raise NotImplementedError
+
     def request_processing(self, agent_id, desc_domain, selector, targets):
         """
         Requests that described descriptor (domain, selector) be processed by
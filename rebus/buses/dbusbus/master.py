@@ -1,5 +1,6 @@
 #! /usr/bin/env python
 
+import itertools
 import sys
 import signal
 from collections import Counter, defaultdict
@@ -14,6 +15,7 @@ from rebus.tools.serializer import b64serializer as serializer
 from rebus.busmaster import BusMaster
 from rebus.tools.sched import Sched
 from rebus.tools import format_check
+from rebus.tools.chunked import IncomingTransfers, ValueChunkReader
 
 
 log = logging.getLogger("rebus.bus")
@@ -24,6 +26,10 @@ class DBusMaster(dbus.service.Object, BusMaster):
     _name_ = "dbus"
     _desc_ = "Use RabbitMQ to exchange messages"
 
+    #: Number of not-yet processed descriptors sent at once to a newly
+    #: registered agent
+    BACKLOG_CHUNK = 100
+
     def __init__(self, bus, objpath, store):
         dbus.service.Object.__init__(self, bus, objpath)
         self.store = store
@@ -52,10 +58,18 @@ class DBusMaster(dbus.service.Object, BusMaster):
         self.descriptor_handled_count = {}
         #: uniq_conf_clients[(agent_name, config_txt)] = [agent_id, ...]
         self.uniq_conf_clients = defaultdict(list)
+        #: backlogs[(agent_name, config_txt)] iterates over (domain, uuid,
+        #: selector) that have not been processed by this agent yet, and are
+        #: being sent to it
+        self.backlogs = {}
         #: retry_counters[(agent_name, config_txt, domain, selector)] = \
         #:     number of remaining retries
         self.retry_counters = defaultdict(dict)
         self.sched = Sched(self._sched_inject)
+        #: values being pushed by chunks
+        self.incoming = IncomingTransfers()
+        #: serves values fetched by chunks
+        self.value_reader = ValueChunkReader(store)
 
     def _update_check_idle(self, agent_name, output_altering_options):
         """
@@ -69,7 +83,7 @@ class DBusMaster(dbus.service.Object, BusMaster):
         self._check_idle()
 
     def _check_idle(self):
-        if self.exiting:
+        if self.exiting or self.backlogs:
             return
         # Check if we have reached idle state
         nbdistinctagents = len(self.descriptor_handled_count)
@@ -106,15 +120,36 @@ class DBusMaster(dbus.service.Object, BusMaster):
         elif not already_running:
             # Send not-yet processed descriptors to the agent,
             # unless another instance of the same agent has already been
-            # started, and should be processing those descriptors
-            unprocessed = \
-                self.store.list_unprocessed_by_agent(agent_name,
-                                                     output_altering_options)
-            self.descriptor_handled_count[name_config] = \
-                self.descriptor_count - len(unprocessed)
-            for dom, uuid, sel in unprocessed:
-                self.targeted_descriptor("storage", dom, uuid, sel,
-                                         [agent_name], False)
+            # started, and should be processing those descriptors.
+            # They are sent by chunks once registration has returned; each
+            # sent descriptor decreases the handled count.
+            backlog = self.store.iter_unprocessed_by_agent(
+                agent_name, output_altering_options)
+            self.descriptor_handled_count[name_config] = self.descriptor_count
+            self.backlogs[name_config] = backlog
+            self._busthread_call(self._send_backlog, name_config, backlog)
+
+    def _send_backlog(self, name_config, backlog):
+        """
+        Sends the next BACKLOG_CHUNK descriptors of an agent's backlog, then
+        schedules sending the following ones from the bus thread, so that
+        other requests are served in between.
+        """
+        if self.exiting or self.backlogs.get(name_config) is not backlog:
+            # agent has unregistered, or bus is exiting
+            return
+        agent_name = name_config[0]
+        sent = 0
+        for dom, uuid, sel in itertools.islice(backlog, self.BACKLOG_CHUNK):
+            self.descriptor_handled_count[name_config] -= 1
+            self.targeted_descriptor("storage", dom, uuid, sel, [agent_name],
+                                     False)
+            sent += 1
+        if sent == self.BACKLOG_CHUNK:
+            self._busthread_call(self._send_backlog, name_config, backlog)
+        else:
+            del self.backlogs[name_config]
+            self._check_idle()
 
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
                          in_signature='s', out_signature='')
@@ -126,7 +161,9 @@ class DBusMaster(dbus.service.Object, BusMaster):
         self.uniq_conf_clients[name_config].remove(agent_id)
         if len(self.uniq_conf_clients[name_config]) == 0:
             del self.descriptor_handled_count[name_config]
+            self.backlogs.pop(name_config, None)
         del self.clients[agent_id]
+        self.incoming.discard_agent(agent_id)
         self._check_idle()
         if self.exiting:
             if len(self.clients) == 0:
@@ -151,8 +188,16 @@ class DBusMaster(dbus.service.Object, BusMaster):
         if key in locks:
             return False
         locks.add(key)
+        self._set_processing(desc_domain, selector, True)
         return True
 
+    def _set_processing(self, desc_domain, selector, processing):
+        # selector lists all the slots of the lock, '?' for missing ones
+        for sel in selector.split('!'):
+            if sel != '?':
+                self.store.set_processing(str(desc_domain), str(sel),
+                                          processing)
+
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
                          in_signature='ssssbuu', out_signature='')
     def unlock(self, agent_id, lockid, desc_domain, selector,
@@ -169,6 +214,7 @@ class DBusMaster(dbus.service.Object, BusMaster):
         if lkey not in locks:
             return
         locks.remove(lkey)
+        self._set_processing(desc_domain, selector, False)
         # find agent_name, config_txt
         for (agent_name, config_txt), ids in self.uniq_conf_clients.items():
             if agent_id in ids:
@@ -179,6 +225,9 @@ class DBusMaster(dbus.service.Object, BusMaster):
         if self.retry_counters[rkey] > 0:
             self.retry_counters[rkey] -= 1
             desc = self.store.get_descriptor(desc_domain, selector)
+            if desc is None:
+                # deleted by the garbage collector
+                return
             uuid = desc.uuid
             self.sched.add_action(wait_time, (agent_id, desc_domain, uuid,
                                               selector, agent_name))
@@ -188,6 +237,9 @@ class DBusMaster(dbus.service.Object, BusMaster):
     def push(self, agent_id, serialized_descriptor):
         descriptor = Descriptor.unserialize(serializer,
                                             str(serialized_descriptor))
+        return self._push_descriptor(agent_id, descriptor)
+
+    def _push_descriptor(self, agent_id, descriptor):
         desc_domain = str(descriptor.domain)
         uuid = str(descriptor.uuid)
         selector = str(descriptor.selector)
@@ -211,6 +263,53 @@ class DBusMaster(dbus.service.Object, BusMaster):
                       selector)
             return False
 
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sstb', out_signature='s')
+    def push_begin(self, agent_id, serialized_meta, size, raw):
+        """
+        Starts receiving a descriptor whose value is sent by chunks. Returns a
+        transfer id, "" if the descriptor is refused or already stored.
+        """
+        descriptor = Descriptor.unserialize(serializer, str(serialized_meta))
+        desc_domain = str(descriptor.domain)
+        selector = str(descriptor.selector)
+        if self.store.get_descriptor(desc_domain, selector) is not None:
+            log.debug("PUSH: %s already seen => %s:%s", agent_id, desc_domain,
+                      selector)
+            return ""
+        if not format_check.processing_depth(self.store, descriptor):
+            log.warning("Refusing descriptor %s:%s received from %s: loop or "
+                        ">2 ancestors having the same descriptor", agent_id,
+                        desc_domain, selector)
+            return ""
+        log.debug("PUSHBEGIN: %s => %s:%s (%d bytes)", agent_id, desc_domain,
+                  selector, size)
+        return self.incoming.begin(str(agent_id), descriptor, int(size),
+                                   bool(raw))
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sstay', out_signature='b',
+                         byte_arrays=True)
+    def push_chunk(self, agent_id, transfer_id, offset, data):
+        return self.incoming.write(str(agent_id), str(transfer_id),
+                                   int(offset), str(data))
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sss', out_signature='b')
+    def push_commit(self, agent_id, transfer_id, digest):
+        """
+        Checks the value received by chunks against digest, then adds the
+        descriptor.
+        """
+        incoming = self.incoming.finish(str(agent_id), str(transfer_id),
+                                        str(digest))
+        if incoming is None:
+            return False
+        try:
+            return self._push_descriptor(agent_id, incoming.descriptor)
+        finally:
+            incoming.close()
+
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
                          in_signature='sss', out_signature='s')
     def get(self, agent_id, desc_domain, selector):
@@ -237,6 +336,44 @@ class DBusMaster(dbus.service.Object, BusMaster):
             return ""
         return serializer.dumps(value)
 
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='ssstu', out_signature='tbsay')
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        """
+        Returns (size, raw, digest, data), where data is a chunk of the value
+        starting at offset. digest is "" if there is no such descriptor. See
+        ValueChunkReader.read.
+        """
+        log.debug("GETVALUERANGE: %s %s:%s %d+%d", agent_id, desc_domain,
+                  selector, offset, length)
+        result = None
+        if format_check.is_valid_domain(desc_domain) and \
+                format_check.is_valid_selector(selector):
+            result = self.value_reader.read(str(desc_domain), str(selector),
+                                            int(offset), int(length))
+        if result is None:
+            return 0, False, "", dbus.ByteArray("")
+        size, raw, digest, data = result
+        return size, raw, digest, dbus.ByteArray(data)
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sss', out_signature='s')
+    def get_value_path(self, agent_id, desc_domain, selector):
+        """
+        Returns the path of a local file containing the raw value, "" if there
+        is none. Used by agents running on the same host.
+        """
+        log.debug("GETVALUEPATH: %s %s:%s", agent_id, desc_domain, selector)
+        if not format_check.is_valid_domain(desc_domain):
+            return ""
+        if not format_check.is_valid_selector(selector):
+            return ""
+        path = self.store.get_value_path(str(desc_domain), str(selector))
+        if path is None:
+            return ""
+        return path
+
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
                          in_signature='ss', out_signature='a{ss}')
     def list_uuids(self, agent_id, desc_domain):
@@ -278,16 +415,17 @@ class DBusMaster(dbus.service.Object, BusMaster):
         return [desc.serialize_meta(serializer) for desc in descs]
 
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
-                         in_signature='ssss', out_signature='as')
+                         in_signature='ssssuu', out_signature='as')
     def find_by_value(self, agent_id, desc_domain, selector_prefix,
-                      value_regex):
-        log.debug("FINDBYVALUE: %s %s %s %s", agent_id, desc_domain,
-                  selector_prefix, value_regex)
+                      value_regex, limit=0, offset=0):
+        log.debug("FINDBYVALUE: %s %s %s %s (max %d skip %d)", agent_id,
+                  desc_domain, selector_prefix, value_regex, limit, offset)
         if not format_check.is_valid_domain(desc_domain):
             return []
         descs = self.store.find_by_value(str(desc_domain),
                                          str(selector_prefix),
-                                         str(value_regex))
+                                         str(value_regex), int(limit),
+                                         int(offset))
         return [desc.serialize_meta(serializer) for desc in descs]
 
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
@@ -361,6 +499,23 @@ class DBusMaster(dbus.service.Object, BusMaster):
                                         recurse=bool(recurse))
         return [desc.serialize_meta(serializer) for desc in descs]
 
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sssbuus', out_signature='a(us)')
+    def get_lineage(self, agent_id, desc_domain, selector, ancestors,
+                    max_depth, max_count, selector_prefix):
+        log.debug("GET_LINEAGE: %s %s:%s ancestors=%s (depth %d max %d) %s",
+                  agent_id, desc_domain, selector, ancestors, max_depth,
+                  max_count, selector_prefix)
+        if not format_check.is_valid_domain(desc_domain):
+            return []
+        if not format_check.is_valid_fullselector(selector):
+            return []
+        lineage = self.store.get_lineage(
+            str(desc_domain), str(selector), bool(ancestors), int(max_depth),
+            int(max_count), str(selector_prefix))
+        return [(depth, desc.serialize_meta(serializer))
+                for depth, desc in lineage]
+
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
                          in_signature='ss', out_signature='')
     def store_internal_state(self, agent_id, state):
@@ -378,6 +533,24 @@ class DBusMaster(dbus.service.Object, BusMaster):
             return self.store.load_agent_state(agent_name)
         return ""
 
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='ss', out_signature='')
+    def append_internal_state(self, agent_id, delta):
+        agent_name = self.agentnames[str(agent_id)]
+        log.debug("APPEND_INTSTATE: %s", agent_name)
+        if self.store.STORES_INTSTATE:
+            self.store.append_agent_state(agent_name, str(delta))
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sx', out_signature='asx')
+    def load_internal_state_deltas(self, agent_id, position):
+        agent_name = self.agentnames[str(agent_id)]
+        log.debug("LOAD_INTSTATE_DELTAS: %s %d", agent_name, position)
+        if self.store.STORES_INTSTATE:
+            return self.store.load_agent_state_deltas(agent_name,
+                                                      int(position))
+        return [], position
+
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
                          in_signature='sssas', out_signature='')
     def request_processing(self, agent_id, desc_domain, selector, targets):
@@ -389,6 +562,10 @@ class DBusMaster(dbus.service.Object, BusMaster):
             return
 
         d = self.store.get_descriptor(str(desc_domain), str(selector))
+        if d is None:
+            log.warning("REQUEST_PROCESSING: %s:%s does not exist",
+                        desc_domain, selector)
+            return
         self.userrequestid += 1
 
         self.targeted_descriptor(agent_id, desc_domain, d.uuid, selector,
@@ -435,6 +612,21 @@ class DBusMaster(dbus.service.Object, BusMaster):
         self.exiting = True
         return
 
+    @dbus.service.signal(dbus_interface='com.airbus.rebus.bus',
+                         signature='')
+    def checkpoint(self):
+        """
+        Signal sent periodically, asking agents to store changes of their
+        internal state.
+        """
+        pass
+
+    def _periodic_checkpoint(self):
+        if not self.exiting:
+            self.checkpoint()
+        # keep calling
+        return True
+
     @dbus.service.signal(dbus_interface='com.airbus.rebus.bus',
                          signature='')
     def on_idle(self):
@@ -453,6 +645,9 @@ class DBusMaster(dbus.service.Object, BusMaster):
         bus = dbus.SessionBus()
         name = dbus.service.BusName("com.airbus.rebus.bus", bus)
         svc = cls(bus, "/bus", store)
+        if store.STORES_INTSTATE and master_options.checkpoint_interval > 0:
+            gobject.timeout_add_seconds(master_options.checkpoint_interval,
+                                        svc._periodic_checkpoint)
 
         svc.mainloop = gobject.MainLoop()
         log.info("Entering main loop.")
@@ -488,7 +683,11 @@ class DBusMaster(dbus.service.Object, BusMaster):
     def add_arguments(subparser):
         # TODO allow specifying dbus address? Currently specified by local dbus
         # configuration file or environment variable
-        pass
+        subparser.add_argument(
+            "--checkpoint-interval", type=int, default=300,
+            help="Interval between checkpoints of agents' internal state, in "
+            "seconds. Disabled if 0, or if the storage does not store agent "
+            "states.")
 
     def _busthread_call(self, method, *args):
         gobject.idle_add(method, *args)
@@ -12,6 +12,9 @@ from rebus.agent import Agent
 from rebus.bus import Bus, DEFAULT_DOMAIN
 from rebus.descriptor import Descriptor
 from rebus.tools.serializer import b64serializer as serializer
+from rebus.tools.chunked import fetch_chunks, push_chunks, \
+    serialize_small, value_chunks
+from rebus.tools.valuefile import read_value_file
 log = logging.getLogger("rebus.bus.dbus")
 DEFAULT_BUS = "(local dbus instance)"
 
@@ -61,6 +64,9 @@ class DBus(Bus):
         self.agent = None
         self.loop = None
         self.main_thread_id = thread.get_ident()
+        #: Read raw values from local files when the bus master provides
+        #: them, instead of receiving them through dbus
+        self.local_values = options.local_values
 
     def join(self, agent, agent_domain=DEFAULT_DOMAIN):
         self.agent = agent
@@ -84,6 +90,9 @@ class DBus(Bus):
         self.bus.add_signal_receiver(self.agent.on_idle,
                                      dbus_interface="com.airbus.rebus.bus",
                                      signal_name="on_idle")
+        self.bus.add_signal_receiver(self.agent.checkpoint_internal_state,
+                                     dbus_interface="com.airbus.rebus.bus",
+                                     signal_name="checkpoint")
 
         self.iface = dbus.Interface(self.rebus, "com.airbus.rebus.bus")
         registerSucceed = False
@@ -120,7 +129,19 @@ class DBus(Bus):
             self.busthread_call(self._push, str(agent_id), descriptor)
 
     def _push(self, agent_id, descriptor):
-        sd = descriptor.serialize(serializer)
+        sd = serialize_small(descriptor, serializer)
+        if sd is None:
+            # large values are sent by chunks, each in its own message
+            raw, size, chunks = value_chunks(descriptor)
+            meta = descriptor.serialize_meta(serializer)
+            return push_chunks(
+                size, raw, chunks,
+                lambda size, raw: str(self.iface.push_begin(
+                    str(agent_id), meta, size, raw)),
+                lambda tid, offset, data: bool(self.iface.push_chunk(
+                    str(agent_id), tid, offset, dbus.ByteArray(data))),
+                lambda tid, digest: bool(self.iface.push_commit(
+                    str(agent_id), tid, digest)))
         # Arbitrary size based on the true limit of 134217728 bytes
         # The true limit apply to the total size (message + header)
         #  -> I don't know the size of the message header
@@ -137,11 +158,27 @@ class DBus(Bus):
         return Descriptor.unserialize(serializer, str(result), bus=self)
 
     def get_value(self, agent_id, desc_domain, selector):
-        result = str(self.iface.get_value(str(agent_id), desc_domain,
-                                          selector))
-        if result == "":
+        if self.local_values:
+            path = str(self.iface.get_value_path(str(agent_id), desc_domain,
+                                                 selector))
+            if path:
+                value = read_value_file(path)
+                if value is not None:
+                    return value
+                log.warning("Could not read value from %s, bus master may be "
+                            "running on another host", path)
+        return fetch_chunks(
+            lambda offset, length: self._get_value_range(
+                str(agent_id), desc_domain, selector, offset, length))
+
+    def _get_value_range(self, agent_id, desc_domain, selector, offset,
+                         length):
+        size, raw, digest, data = self.iface.get_value_range(
+            agent_id, desc_domain, selector, offset, length,
+            byte_arrays=True)
+        if not digest:
             return None
-        return Descriptor.unserialize_value(serializer, result)
+        return int(size), bool(raw), str(digest), str(data)
 
     def list_uuids(self, agent_id, desc_domain):
         return {str(k): str(v) for k, v in
@@ -165,9 +202,10 @@ class DBus(Bus):
                 dlist]
 
     def find_by_value(self, agent_id, desc_domain, selector_prefix,
-                      value_regex):
+                      value_regex, limit=0, offset=0):
         dlist = self.iface.find_by_value(
-            str(agent_id), desc_domain, selector_prefix, value_regex)
+            str(agent_id), desc_domain, selector_prefix, value_regex, limit,
+            offset)
         return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
                 dlist]
 
@@ -195,12 +233,29 @@ class DBus(Bus):
                 self.iface.get_children(str(agent_id), desc_domain, selector,
                                         recurse)]
 
+    def get_lineage(self, agent_id, desc_domain, selector, ancestors=False,
+                    max_depth=0, max_count=0, selector_prefix=''):
+        lineage = self.iface.get_lineage(str(agent_id), desc_domain, selector,
+                                         ancestors, max_depth, max_count,
+                                         selector_prefix)
+        return [(int(depth), Descriptor.unserialize(serializer, str(s),
+                                                    bus=self))
+                for depth, s in lineage]
+
     def store_internal_state(self, agent_id, state):
         self.iface.store_internal_state(str(agent_id), state)
 
     def load_internal_state(self, agent_id):
         return str(self.iface.load_internal_state(str(agent_id)))
 
+    def append_internal_state(self, agent_id, delta):
+        self.iface.append_internal_state(str(agent_id), delta)
+
+    def load_internal_state_deltas(self, agent_id, position=0):
+        deltas, position = self.iface.load_internal_state_deltas(
+            str(agent_id), position)
+        return [str(delta) for delta in deltas], int(position)
+
     def request_processing(self, agent_id, desc_domain, selector, targets):
         self.iface.request_processing(str(agent_id), desc_domain, selector,
                                       targets)
@@ -273,3 +328,7 @@ class DBus(Bus):
         subparser.add_argument(
             "--busaddr", help="URL of the dbus server",
             default=DEFAULT_BUS)
+        subparser.add_argument(
+            "--local-values", action='store_true',
+            help="Read descriptor values directly from the master's storage "
+            "when possible. Agents must run on the same host as the master")
@@ -133,11 +133,11 @@ class LocalBus(Bus):
         return self.store.find_by_uuid(desc_domain, uuid)
 
     def find_by_value(self, agent_id, desc_domain, selector_prefix,
-                      value_regex):
-        log.debug("FINDBYVALUE: %s %s %s %s", agent_id, desc_domain,
-                  selector_prefix, value_regex)
+                      value_regex, limit=0, offset=0):
+        log.debug("FINDBYVALUE: %s %s %s %s (max %d skip %d)", agent_id,
+                  desc_domain, selector_prefix, value_regex, limit, offset)
         return self.store.find_by_value(desc_domain, selector_prefix,
-                                        value_regex)
+                                        value_regex, limit, offset)
 
     def mark_processed(self, agent_id, desc_domain, selector):
         agent_name = self.agents[agent_id].name
@@ -172,6 +172,14 @@ class LocalBus(Bus):
         return list(self.store.get_children(desc_domain, selector,
                                             recurse))
 
+    def get_lineage(self, agent_id, desc_domain, selector, ancestors=False,
+                    max_depth=0, max_count=0, selector_prefix=''):
+        log.debug("GET_LINEAGE: %s %s:%s ancestors=%s (depth %d max %d) %s",
+                  agent_id, desc_domain, selector, ancestors, max_depth,
+                  max_count, selector_prefix)
+        return self.store.get_lineage(desc_domain, selector, ancestors,
+                                      max_depth, max_count, selector_prefix)
+
     def store_internal_state(self, agent_id, state):
         log.debug("STORE_INTSTATE: %s", agent_id)
         if self.store.STORES_INTSTATE:
@@ -185,6 +193,19 @@ class LocalBus(Bus):
             return self.store.load_agent_state(agent_name)
         return ""
 
+    def append_internal_state(self, agent_id, delta):
+        log.debug("APPEND_INTSTATE: %s", agent_id)
+        if self.store.STORES_INTSTATE:
+            agent_name = self.agents[agent_id].name
+            self.store.append_agent_state(agent_name, str(delta))
+
+    def load_internal_state_deltas(self, agent_id, position=0):
+        log.debug("LOAD_INTSTATE_DELTAS: %s %d", agent_id, position)
+        if self.store.STORES_INTSTATE:
+            agent_name = self.agents[agent_id].name
+            return self.store.load_agent_state_deltas(agent_name, position)
+        return [], position
+
     def request_processing(self, agent_id, desc_domain, selector,
                            targets):
         log.debug("REQUEST_PROCESSING: %s %s:%s target %s", agent_id,
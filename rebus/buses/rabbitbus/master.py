@@ -1,5 +1,6 @@
 #! /usr/bin/env python
 
+import itertools
 import os
 import sys
 import time
@@ -13,6 +14,7 @@ import rebus.tools.serializer as serializer
 from rebus.busmaster import BusMaster
 from rebus.tools.sched import Sched
 from rebus.tools import format_check
+from rebus.tools.chunked import IncomingTransfers, ValueChunkReader
 
 log = logging.getLogger("rebus.bus")
 
@@ -22,6 +24,10 @@ class RabbitBusMaster(BusMaster):
     _name_ = "rabbit"
     _desc_ = "Use RabbitMQ to exchange messages"
 
+    #: Number of not-yet processed descriptors sent at once to a newly
+    #: registered agent
+    BACKLOG_CHUNK = 100
+
     def __init__(self, store, server_addr, heartbeat_interval=0):
         self.store = store
         #: maps agent_id (ex. inject-:1.234) to object path (ex: /agent/inject)
@@ -48,10 +54,18 @@ class RabbitBusMaster(BusMaster):
         self.descriptor_handled_count = {}
         #: uniq_conf_clients[(agent_name, config_txt)] = [agent_id, ...]
         self.uniq_conf_clients = defaultdict(list)
+        #: backlogs[(agent_name, config_txt)] iterates over (domain, uuid,
+        #: selector) that have not been processed by this agent yet, and are
+        #: being sent to it
+        self.backlogs = {}
         #: retry_counters[(agent_name, config_txt, domain, selector)] = \
         #:     number of remaining retries
         self.retry_counters = defaultdict(dict)
         self.sched = Sched(self._sched_inject)
+        #: values being pushed by chunks
+        self.incoming = IncomingTransfers()
+        #: serves values fetched by chunks
+        self.value_reader = ValueChunkReader(store)
         #: last published agent id
         self.last_published_id = 0
         #: bus session id, to make sure agents were not registered to another
@@ -140,8 +154,13 @@ class RabbitBusMaster(BusMaster):
              'lock': self.lock,
              'unlock': self.unlock,
              'push': self.push,
+             'push_begin': self.push_begin,
+             'push_chunk': self.push_chunk,
+             'push_commit': self.push_commit,
              'get': self.get,
              'get_value': self.get_value,
+             'get_value_range': self.get_value_range,
+             'get_value_path': self.get_value_path,
              'list_uuids': self.list_uuids,
              'find': self.find,
              'find_by_uuid': self.find_by_uuid,
@@ -153,8 +172,11 @@ class RabbitBusMaster(BusMaster):
              'list_agents': self.list_agents,
              'processed_stats': self.processed_stats,
              'get_children': self.get_children,
+             'get_lineage': self.get_lineage,
              'store_internal_state': self.store_internal_state,
              'load_internal_state': self.load_internal_state,
+             'append_internal_state': self.append_internal_state,
+             'load_internal_state_deltas': self.load_internal_state_deltas,
              'request_processing': self.request_processing,
              }
         return f[name](**args)
@@ -200,7 +222,7 @@ class RabbitBusMaster(BusMaster):
         self._check_idle()
 
     def _check_idle(self):
-        if self.exiting:
+        if self.exiting or self.backlogs:
             return
         # Check if we have reached idle state
         nbdistinctagents = len(self.descriptor_handled_count)
@@ -240,15 +262,36 @@ class RabbitBusMaster(BusMaster):
             self.descriptor_handled_count[name_config] = 0
         elif not already_running:
             # ...unless another instance of the same agent has already been
-            # started, and should be processing those descriptors
-            unprocessed = \
-                self.store.list_unprocessed_by_agent(agent_name,
-                                                     output_altering_options)
-            self.descriptor_handled_count[name_config] = \
-                self.descriptor_count - len(unprocessed)
-            for dom, uuid, sel in unprocessed:
-                self._targeted_descriptor("storage", dom, uuid, sel,
-                                          [agent_name], False)
+            # started, and should be processing those descriptors.
+            # They are sent by chunks once registration has returned; each
+            # sent descriptor decreases the handled count.
+            backlog = self.store.iter_unprocessed_by_agent(
+                agent_name, output_altering_options)
+            self.descriptor_handled_count[name_config] = self.descriptor_count
+            self.backlogs[name_config] = backlog
+            self._busthread_call(self._send_backlog, name_config, backlog)
+
+    def _send_backlog(self, name_config, backlog):
+        """
+        Sends the next BACKLOG_CHUNK descriptors of an agent's backlog, then
+        schedules sending the following ones from the bus thread, so that
+        other requests are served in between.
+        """
+        if self.exiting or self.backlogs.get(name_config) is not backlog:
+            # agent has unregistered, or bus is exiting
+            return
+        agent_name = name_config[0]
+        sent = 0
+        for dom, uuid, sel in itertools.islice(backlog, self.BACKLOG_CHUNK):
+            self.descriptor_handled_count[name_config] -= 1
+            self._targeted_descriptor("storage", dom, uuid, sel,
+                                      [agent_name], False)
+            sent += 1
+        if sent == self.BACKLOG_CHUNK:
+            self._busthread_call(self._send_backlog, name_config, backlog)
+        else:
+            del self.backlogs[name_config]
+            self._check_idle()
 
     def unregister(self, agent_id):
         log.info("Agent %s has unregistered", agent_id)
@@ -260,7 +303,9 @@ class RabbitBusMaster(BusMaster):
         self.uniq_conf_clients[name_config].remove(agent_id)
         if len(self.uniq_conf_clients[name_config]) == 0:
             del self.descriptor_handled_count[name_config]
+            self.backlogs.pop(name_config, None)
         del self.clients[agent_id]
+        self.incoming.discard_agent(agent_id)
         self._check_idle()
         if self.exiting:
             if len(self.clients) == 0:
@@ -285,8 +330,16 @@ class RabbitBusMaster(BusMaster):
         if key in locks:
             return False
         locks.add(key)
+        self._set_processing(desc_domain, selector, True)
         return True
 
+    def _set_processing(self, desc_domain, selector, processing):
+        # selector lists all the slots of the lock, '?' for missing ones
+        for sel in selector.split('!'):
+            if sel != '?':
+                self.store.set_processing(str(desc_domain), str(sel),
+                                          processing)
+
     def unlock(self, agent_id, lockid, desc_domain, selector,
                processing_failed, retries, wait_time):
         if not self._check_agent_id(agent_id):
@@ -303,6 +356,7 @@ class RabbitBusMaster(BusMaster):
         if lkey not in locks:
             return
         locks.remove(lkey)
+        self._set_processing(desc_domain, selector, False)
         # find agent_name, config_txt
         for (agent_name, config_txt), ids in self.uniq_conf_clients.items():
             if agent_id in ids:
@@ -313,6 +367,9 @@ class RabbitBusMaster(BusMaster):
         if self.retry_counters[rkey] > 0:
             self.retry_counters[rkey] -= 1
             desc = self.store.get_descriptor(desc_domain, selector)
+            if desc is None:
+                # deleted by the garbage collector
+                return
             uuid = desc.uuid
             self.sched.add_action(wait_time, (agent_id, desc_domain, uuid,
                                               selector, agent_name))
@@ -322,6 +379,9 @@ class RabbitBusMaster(BusMaster):
             return False
         descriptor = Descriptor.unserialize(serializer,
                                             str(serialized_descriptor))
+        return self._push_descriptor(agent_id, descriptor)
+
+    def _push_descriptor(self, agent_id, descriptor):
         desc_domain = str(descriptor.domain)
         uuid = str(descriptor.uuid)
         selector = str(descriptor.selector)
@@ -345,6 +405,49 @@ class RabbitBusMaster(BusMaster):
                       selector)
             return False
 
+    def push_begin(self, agent_id, serialized_meta, size, raw):
+        """
+        Starts receiving a descriptor whose value is sent by chunks. Returns a
+        transfer id, "" if the descriptor is refused or already stored.
+        """
+        if not self._check_agent_id(agent_id):
+            return ""
+        descriptor = Descriptor.unserialize(serializer, str(serialized_meta))
+        desc_domain = str(descriptor.domain)
+        selector = str(descriptor.selector)
+        if self.store.get_descriptor(desc_domain, selector) is not None:
+            log.debug("PUSH: %s already seen => %s:%s", agent_id, desc_domain,
+                      selector)
+            return ""
+        if not format_check.processing_depth(self.store, descriptor):
+            log.warning("Refusing descriptor %s:%s: loop or >2 ancestors "
+                        "having the same descriptor, or invalid precursor",
+                        desc_domain, selector)
+            return ""
+        log.debug("PUSHBEGIN: %s => %s:%s (%d bytes)", agent_id, desc_domain,
+                  selector, size)
+        return self.incoming.begin(agent_id, descriptor, size, raw)
+
+    def push_chunk(self, agent_id, transfer_id, offset, data):
+        if not self._check_agent_id(agent_id):
+            return False
+        return self.incoming.write(agent_id, transfer_id, offset, data)
+
+    def push_commit(self, agent_id, transfer_id, digest):
+        """
+        Checks the value received by chunks against digest, then adds the
+        descriptor.
+        """
+        if not self._check_agent_id(agent_id):
+            return False
+        incoming = self.incoming.finish(agent_id, transfer_id, digest)
+        if incoming is None:
+            return False
+        try:
+            return self._push_descriptor(agent_id, incoming.descriptor)
+        finally:
+            incoming.close()
+
     def get(self, agent_id, desc_domain, selector):
         log.debug("GET: %s %s:%s", agent_id, desc_domain, selector)
         if not self._check_agent_id(agent_id):
@@ -371,6 +474,41 @@ class RabbitBusMaster(BusMaster):
             return ""
         return serializer.dumps(value)
 
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        """
+        Returns (size, raw, digest, data), where data is a chunk of the value
+        starting at offset, None if there is no such descriptor. See
+        ValueChunkReader.read.
+        """
+        log.debug("GETVALUERANGE: %s %s:%s %d+%d", agent_id, desc_domain,
+                  selector, offset, length)
+        if not self._check_agent_id(agent_id):
+            return None
+        if not format_check.is_valid_domain(desc_domain):
+            return None
+        if not format_check.is_valid_selector(selector):
+            return None
+        return self.value_reader.read(str(desc_domain), str(selector),
+                                      offset, length)
+
+    def get_value_path(self, agent_id, desc_domain, selector):
+        """
+        Returns the path of a local file containing the raw value, "" if there
+        is none. Used by agents running on the same host.
+        """
+        log.debug("GETVALUEPATH: %s %s:%s", agent_id, desc_domain, selector)
+        if not self._check_agent_id(agent_id):
+            return ""
+        if not format_check.is_valid_domain(desc_domain):
+            return ""
+        if not format_check.is_valid_selector(selector):
+            return ""
+        path = self.store.get_value_path(str(desc_domain), str(selector))
+        if path is None:
+            return ""
+        return path
+
     def list_uuids(self, agent_id, desc_domain):
         log.debug("LISTUUIDS: %s %s", agent_id, desc_domain)
         if not self._check_agent_id(agent_id):
@@ -411,16 +549,17 @@ class RabbitBusMaster(BusMaster):
         return [desc.serialize_meta(serializer) for desc in descs]
 
     def find_by_value(self, agent_id, desc_domain, selector_prefix,
-                      value_regex):
-        log.debug("FINDBYVALUE: %s %s %s %s", agent_id, desc_domain,
-                  selector_prefix, value_regex)
+                      value_regex, limit=0, offset=0):
+        log.debug("FINDBYVALUE: %s %s %s %s (max %d skip %d)", agent_id,
+                  desc_domain, selector_prefix, value_regex, limit, offset)
         if not self._check_agent_id(agent_id):
             return []
         if not format_check.is_valid_domain(desc_domain):
             return []
         descs = self.store.find_by_value(str(desc_domain),
                                          str(selector_prefix),
-                                         str(value_regex))
+                                         str(value_regex), int(limit),
+                                         int(offset))
         return [desc.serialize_meta(serializer) for desc in descs]
 
     def mark_processed(self, agent_id, desc_domain, selector):
@@ -490,9 +629,26 @@ class RabbitBusMaster(BusMaster):
             return []
         if not format_check.is_valid_fullselector(selector):
             return []
-        return list(self.store.get_children(str(desc_domain), str(selector),
-                                            serializer=serializer,
-                                            recurse=bool(recurse)))
+        descs = self.store.get_children(str(desc_domain), str(selector),
+                                        recurse=bool(recurse))
+        return [desc.serialize_meta(serializer) for desc in descs]
+
+    def get_lineage(self, agent_id, desc_domain, selector, ancestors,
+                    max_depth, max_count, selector_prefix):
+        log.debug("GET_LINEAGE: %s %s:%s ancestors=%s (depth %d max %d) %s",
+                  agent_id, desc_domain, selector, ancestors, max_depth,
+                  max_count, selector_prefix)
+        if not self._check_agent_id(agent_id):
+            return []
+        if not format_check.is_valid_domain(desc_domain):
+            return []
+        if not format_check.is_valid_fullselector(selector):
+            return []
+        lineage = self.store.get_lineage(
+            str(desc_domain), str(selector), bool(ancestors), int(max_depth),
+            int(max_count), str(selector_prefix))
+        return [(depth, desc.serialize_meta(serializer))
+                for depth, desc in lineage]
 
     def store_internal_state(self, agent_id, state):
         if not self._check_agent_id(agent_id):
@@ -511,6 +667,24 @@ class RabbitBusMaster(BusMaster):
             return self.store.load_agent_state(agent_name)
         return ""
 
+    def append_internal_state(self, agent_id, delta):
+        if not self._check_agent_id(agent_id):
+            return
+        agent_name = self.agentnames[str(agent_id)]
+        log.debug("APPEND_INTSTATE: %s", agent_name)
+        if self.store.STORES_INTSTATE:
+            self.store.append_agent_state(agent_name, str(delta))
+
+    def load_internal_state_deltas(self, agent_id, position):
+        if not self._check_agent_id(agent_id):
+            return [], 0
+        agent_name = self.agentnames[str(agent_id)]
+        log.debug("LOAD_INTSTATE_DELTAS: %s %d", agent_name, position)
+        if self.store.STORES_INTSTATE:
+            return self.store.load_agent_state_deltas(agent_name,
+                                                      int(position))
+        return [], position
+
     def request_processing(self, agent_id, desc_domain, selector, targets):
         log.debug("REQUEST_PROCESSING: %s %s:%s targets %s", agent_id,
                   desc_domain, selector, [str(t) for t in targets])
@@ -522,6 +696,10 @@ class RabbitBusMaster(BusMaster):
             return
 
         d = self.store.get_descriptor(str(desc_domain), str(selector))
+        if d is None:
+            log.warning("REQUEST_PROCESSING: %s:%s does not exist",
+                        desc_domain, selector)
+            return
         self.userrequestid += 1
 
         self._targeted_descriptor(agent_id, desc_domain, d.uuid, selector,
@@ -570,6 +748,21 @@ class RabbitBusMaster(BusMaster):
         self.exiting = True
         return
 
+    def _checkpoint(self):
+        """
+        Signal sent periodically, asking agents to store changes of their
+        internal state.
+        """
+        args = locals()
+        args.pop('self', None)
+        self._send_signal("checkpoint", args)
+
+    def _periodic_checkpoint(self):
+        if not self.exiting:
+            self._checkpoint()
+        self.connection.add_timeout(self.checkpoint_interval,
+                                    self._periodic_checkpoint)
+
     def _on_idle(self):
         """
         Signal sent when the bus is idle, i.e. all descriptors have been
@@ -611,6 +804,10 @@ class RabbitBusMaster(BusMaster):
         server_addr = master_options.rabbitaddr
         heartbeat_interval = master_options.heartbeat
         svc = cls(store, server_addr, heartbeat_interval)
+        svc.checkpoint_interval = master_options.checkpoint_interval
+        if store.STORES_INTSTATE and svc.checkpoint_interval > 0:
+            svc.connection.add_timeout(svc.checkpoint_interval,
+                                       svc._periodic_checkpoint)
         log.info("Entering main loop.")
         try:
             while True:
@@ -667,6 +864,11 @@ class RabbitBusMaster(BusMaster):
         subparser.add_argument(
             "--heartbeat", help="Rabbitmq heartbeat interval, in seconds",
             default=0)
+        subparser.add_argument(
+            "--checkpoint-interval", type=int, default=300,
+            help="Interval between checkpoints of agents' internal state, in "
+            "seconds. Disabled if 0, or if the storage does not store agent "
+            "states.")
 
     def _busthread_call(self, method, *args):
         f = lambda: method(*args)
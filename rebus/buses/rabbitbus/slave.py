@@ -10,6 +10,9 @@ from rebus.agent import Agent
 from rebus.bus import Bus, DEFAULT_DOMAIN
 from rebus.descriptor import Descriptor
 import rebus.tools.serializer as serializer
+from rebus.tools.chunked import fetch_chunks, push_chunks, \
+    serialize_small, value_chunks
+from rebus.tools.valuefile import read_value_file
 
 
 log = logging.getLogger("rebus.bus.rabbitbus")
@@ -52,13 +55,17 @@ class RabbitBus(Bus):
         #: instances.
         self.agent = None
         self.main_thread_id = thread.get_ident()
+        #: Read raw values from local files when the bus master provides
+        #: them, instead of receiving them through rabbitmq
+        self.local_values = options.local_values
 
     # TODO: check if key exists
     def signal_handler(self, ch, method, properties, body):
         f = {'new_descriptor': self.broadcast_wrapper,
              'targeted_descriptor': self.targeted_wrapper,
              'bus_exit': self.bus_exit_handler,
-             'on_idle': self.agent.on_idle}
+             'on_idle': self.agent.on_idle,
+             'checkpoint': self.agent.checkpoint_internal_state}
         signal_type = serializer.loads(body)
         f[signal_type['signal_name']](**signal_type['args'])
 
@@ -161,6 +168,21 @@ class RabbitBus(Bus):
         args = {'agent_id': agent_id, 'serialized_descriptor': descriptor}
         return self.send_rpc("push", args, False)
 
+    def rpc_push_begin(self, agent_id, serialized_meta, size, raw):
+        args = {'agent_id': agent_id, 'serialized_meta': serialized_meta,
+                'size': size, 'raw': raw}
+        return self.send_rpc("push_begin", args, False)
+
+    def rpc_push_chunk(self, agent_id, transfer_id, offset, data):
+        args = {'agent_id': agent_id, 'transfer_id': transfer_id,
+                'offset': offset, 'data': data}
+        return self.send_rpc("push_chunk", args, False)
+
+    def rpc_push_commit(self, agent_id, transfer_id, digest):
+        args = {'agent_id': agent_id, 'transfer_id': transfer_id,
+                'digest': digest}
+        return self.send_rpc("push_commit", args, False)
+
     def rpc_get(self, agent_id, desc_domain, selector):
         args = {'agent_id': agent_id, 'desc_domain': desc_domain,
                 'selector': selector}
@@ -173,6 +195,17 @@ class RabbitBus(Bus):
                 'selector': selector}
         return self.send_rpc("get_value", args)
 
+    def rpc_get_value_range(self, agent_id, desc_domain, selector, offset,
+                            length):
+        args = {'agent_id': self.agent.id, 'desc_domain': desc_domain,
+                'selector': selector, 'offset': offset, 'length': length}
+        return self.send_rpc("get_value_range", args)
+
+    def rpc_get_value_path(self, agent_id, desc_domain, selector):
+        args = {'agent_id': self.agent.id, 'desc_domain': desc_domain,
+                'selector': selector}
+        return self.send_rpc("get_value_path", args)
+
     def rpc_list_uuids(self, agent_id, desc_domain):
         args = {'agent_id': agent_id, 'desc_domain': desc_domain}
         return self.send_rpc("list_uuids", args)
@@ -197,9 +230,10 @@ class RabbitBus(Bus):
         return self.send_rpc("find_by_uuid", args)
 
     def rpc_find_by_value(self, agent_id, desc_domain, selector_prefix,
-                          value_regex):
+                          value_regex, limit, offset):
         args = {'agent_id': agent_id, 'desc_domain': desc_domain,
-                'selector_prefix': selector_prefix, 'value_regex': value_regex}
+                'selector_prefix': selector_prefix, 'value_regex': value_regex,
+                'limit': limit, 'offset': offset}
         return self.send_rpc("find_by_value", args)
 
     def rpc_mark_processed(self, agent_id, desc_domain, selector):
@@ -230,6 +264,12 @@ class RabbitBus(Bus):
         args.pop('self', None)
         return self.send_rpc("get_children", args)
 
+    def rpc_get_lineage(self, agent_id, desc_domain, selector, ancestors,
+                        max_depth, max_count, selector_prefix):
+        args = locals()
+        args.pop('self', None)
+        return self.send_rpc("get_lineage", args)
+
     def rpc_store_internal_state(self, agent_id, state):
         args = locals()
         args.pop('self', None)
@@ -240,6 +280,16 @@ class RabbitBus(Bus):
         args.pop('self', None)
         return self.send_rpc("load_internal_state", args)
 
+    def rpc_append_internal_state(self, agent_id, delta):
+        args = locals()
+        args.pop('self', None)
+        return self.send_rpc("append_internal_state", args)
+
+    def rpc_load_internal_state_deltas(self, agent_id, position):
+        args = locals()
+        args.pop('self', None)
+        return self.send_rpc("load_internal_state_deltas", args)
+
     def rpc_request_processing(self, agent_id, desc_domain, selector, targets):
         args = locals()
         args.pop('self', None)
@@ -311,7 +361,19 @@ class RabbitBus(Bus):
             self.busthread_call(self._push, str(agent_id), descriptor)
 
     def _push(self, agent_id, descriptor):
-        sd = descriptor.serialize(serializer)
+        sd = serialize_small(descriptor, serializer)
+        if sd is None:
+            # large values are sent by chunks, each in its own message
+            raw, size, chunks = value_chunks(descriptor)
+            meta = descriptor.serialize_meta(serializer)
+            return push_chunks(
+                size, raw, chunks,
+                lambda size, raw: self.rpc_push_begin(agent_id, meta, size,
+                                                      raw),
+                lambda tid, offset, data: self.rpc_push_chunk(
+                    agent_id, tid, offset, data),
+                lambda tid, digest: self.rpc_push_commit(agent_id, tid,
+                                                         digest))
         return bool(self.rpc_push(str(agent_id), sd))
 
     def get(self, agent_id, desc_domain, selector):
@@ -321,10 +383,18 @@ class RabbitBus(Bus):
         return Descriptor.unserialize(serializer, result, bus=self)
 
     def get_value(self, agent_id, desc_domain, selector):
-        result = str(self.rpc_get_value(str(agent_id), desc_domain, selector))
-        if result == "":
-            return None
-        return Descriptor.unserialize_value(serializer, result)
+        if self.local_values:
+            path = str(self.rpc_get_value_path(str(agent_id), desc_domain,
+                                               selector))
+            if path:
+                value = read_value_file(path)
+                if value is not None:
+                    return value
+                log.warning("Could not read value from %s, bus master may be "
+                            "running on another host", path)
+        return fetch_chunks(
+            lambda offset, length: self.rpc_get_value_range(
+                str(agent_id), desc_domain, selector, offset, length))
 
     def list_uuids(self, agent_id, desc_domain):
         return {str(k): v.encode('utf-8') for k, v in
@@ -348,9 +418,10 @@ class RabbitBus(Bus):
                 dlist]
 
     def find_by_value(self, agent_id, desc_domain, selector_prefix,
-                      value_regex):
+                      value_regex, limit=0, offset=0):
         dlist = self.rpc_find_by_value(
-            str(agent_id), desc_domain, selector_prefix, value_regex)
+            str(agent_id), desc_domain, selector_prefix, value_regex, limit,
+            offset)
         return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
                 dlist]
 
@@ -378,12 +449,29 @@ class RabbitBus(Bus):
                 self.rpc_get_children(str(agent_id), desc_domain, selector,
                                       recurse)]
 
+    def get_lineage(self, agent_id, desc_domain, selector, ancestors=False,
+                    max_depth=0, max_count=0, selector_prefix=''):
+        lineage = self.rpc_get_lineage(str(agent_id), desc_domain, selector,
+                                       ancestors, max_depth, max_count,
+                                       selector_prefix)
+        return [(int(depth), Descriptor.unserialize(serializer, str(s),
+                                                    bus=self))
+                for depth, s in lineage]
+
     def store_internal_state(self, agent_id, state):
         self.rpc_store_internal_state(str(agent_id), state)
 
     def load_internal_state(self, agent_id):
         return str(self.rpc_load_internal_state(str(agent_id)))
 
+    def append_internal_state(self, agent_id, delta):
+        self.rpc_append_internal_state(str(agent_id), delta)
+
+    def load_internal_state_deltas(self, agent_id, position=0):
+        deltas, position = self.rpc_load_internal_state_deltas(str(agent_id),
+                                                               position)
+        return [str(delta) for delta in deltas], int(position)
+
     def request_processing(self, agent_id, desc_domain, selector, targets):
         self.rpc_request_processing(str(agent_id), desc_domain, selector,
                                     targets)
@@ -464,3 +552,7 @@ class RabbitBus(Bus):
         subparser.add_argument(
             "--heartbeat", help="Rabbitmq heartbeat interval, in seconds",
             default=0)
+        subparser.add_argument(
+            "--local-values", action='store_true',
+            help="Read descriptor values directly from the master's storage "
+            "when possible. Agents must run on the same host as the master")
@@ -8,13 +8,88 @@ from rebus.tools import format_check
 log = logging.getLogger("rebus.descriptor")
 
 
+#: Size of chunks in which file-backed values are read
+FILE_CHUNK_SIZE = 1 << 20
+
+
+class FileValue(object):
+    """
+    Used as the bus of descriptors created by Descriptor.from_file: their
+    value is read from a local file when it is accessed.
+    """
+
+    def __init__(self, source):
+        """
+        :param source: file path, or seekable file object opened in binary
+            mode, positioned at the start of the value
+        """
+        if isinstance(source, basestring):
+            self.path = source
+            self.fp = None
+            self.offset = 0
+        else:
+            self.path = getattr(source, 'name', None)
+            self.fp = source
+            self.offset = source.tell()
+
+    def size(self):
+        """
+        Returns the size of the value, in bytes.
+        """
+        if self.fp is None:
+            return os.path.getsize(self.path)
+        self.fp.seek(0, os.SEEK_END)
+        return self.fp.tell() - self.offset
+
+    def iter_chunks(self, chunk_size=FILE_CHUNK_SIZE):
+        """
+        Yields the value by chunks of at most chunk_size bytes.
+        """
+        if self.fp is None:
+            fp = open(self.path, 'rb')
+        else:
+            fp = self.fp
+            fp.seek(self.offset)
+        try:
+            while True:
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            if self.fp is None:
+                fp.close()
+
+    def get_value(self, agent_id, domain, selector):
+        if self.fp is None:
+            with open(self.path, 'rb') as fp:
+                return fp.read()
+        self.fp.seek(self.offset)
+        return self.fp.read()
+
+    def __repr__(self):
+        return "<file %s>" % (self.path,)
+
+
 class Descriptor(object):
 
     NAMESPACE_REBUS = m_uuid.uuid5(m_uuid.NAMESPACE_DNS, "rebus.airbus.com")
 
+    #: Serialized fields, in constructor argument order
+    FIELDS = ("label", "selector", "value", "domain", "agent", "precursors",
+              "version", "processing_time", "uuid")
+    #: Serialized fields, excluding the value, which is described by its
+    #: size and digest
+    META_FIELDS = tuple(f for f in FIELDS if f != "value") + \
+        ("value_size", "value_digest")
+
+    __slots__ = ("label", "selector", "_value", "domain", "agent",
+                 "precursors", "version", "processing_time", "uuid", "hash",
+                 "bus", "_value_size", "_value_digest")
+
     def __init__(self, label, selector, value=None, domain="default",
                  agent=None, precursors=None, version=0, processing_time=-1,
-                 uuid=None, bus=None):
+                 uuid=None, bus=None, value_size=None, value_digest=None):
         self.label = label
         """
         :param label: descriptor's label. Usually a file name, or
@@ -30,6 +105,10 @@ class Descriptor(object):
         :param uuid: descriptor's uuid
         :param bus: descriptor's bus. None iif the value must be fetched from
             the bus
+        :param value_size: size of the value, see value_size. Computed from
+            value if unset
+        :param value_digest: digest of the value, see value_digest. Computed
+            from value if unset
 
         May raise a ValueError if provided selector or descriptor are invalid
         """
@@ -41,6 +120,8 @@ class Descriptor(object):
         self.agent = agent
 
         self.bus = bus
+        self._value_size = value_size
+        self._value_digest = value_digest
 
         if not format_check.is_valid_domain(domain):
             raise ValueError("invalid domain format (%s)" % domain)
@@ -51,26 +132,34 @@ class Descriptor(object):
             h = selector[(p+1):]
             self.hash = h
         else:
+            # the value is hashed in place, rather than concatenated
+            hashed = hashlib.sha256()
             if self.agent and self.precursors:
                 if type(value) is unicode:
                     strvalue = value.encode('utf-8')
                 else:
                     strvalue = str(value)
-                v = str(self.agent) + str(self.precursors) + selector + \
-                    strvalue
+                hashed.update(str(self.agent))
+                hashed.update(str(self.precursors))
+                hashed.update(selector)
+                hashed.update(strvalue)
             else:
-                v = str(value)
-            self.hash = hashlib.sha256(v).hexdigest()
-            selector = os.path.join(selector, "%" + self.hash)
+                hashed.update(str(value))
+            self.hash = hashed.hexdigest()
+            if type(value) is str and value_digest is None and \
+                    not (self.agent and self.precursors):
+                # only the value has been hashed
+                self._value_digest = self.hash
+            selector = _hashed_selector(selector, self.hash)
         self.selector = selector
         if self.bus is None:
-            self.value = value
+            self._value = value
         self.domain = domain
         self.version = version
         #: if -1, will be set by agent when push() is called
         self.processing_time = processing_time
         if uuid is None:
-            uuid = str(m_uuid.uuid5(self.NAMESPACE_REBUS, self.hash))
+            uuid = _uuid5(self.hash)
         #: A new uuid is generated for:
         #:
         #: * newly injected descriptors
@@ -78,6 +167,71 @@ class Descriptor(object):
         #: * new versions of descriptors
         self.uuid = uuid
 
+    @classmethod
+    def from_file(cls, label, selector, source, domain="default", agent=None,
+                  precursors=None, version=0, processing_time=-1, uuid=None):
+        """
+        Creates a descriptor whose value is the contents of source, a file
+        path or a seekable file object opened in binary mode. The value is
+        hashed by chunks, and is only loaded in memory if the value attribute
+        is accessed; storage backends may copy it by chunks (see file_value).
+        Its hash is the same as that of a descriptor created using the file
+        contents as value.
+
+        May raise a ValueError if provided selector or descriptor are invalid
+        """
+        file_value = FileValue(source)
+        value_size = value_digest = None
+        if selector.find("%") < 0:
+            hashed = hashlib.sha256()
+            digest = hashed
+            if agent and precursors:
+                hashed.update(str(agent))
+                hashed.update(str(precursors))
+                hashed.update(selector)
+                digest = hashlib.sha256()
+            value_size = 0
+            for chunk in file_value.iter_chunks():
+                hashed.update(chunk)
+                if digest is not hashed:
+                    digest.update(chunk)
+                value_size += len(chunk)
+            value_digest = digest.hexdigest()
+            selector = _hashed_selector(selector, hashed.hexdigest())
+        return cls(label, selector, None, domain, agent=agent,
+                   precursors=precursors, version=version,
+                   processing_time=processing_time, uuid=uuid,
+                   bus=file_value, value_size=value_size,
+                   value_digest=value_digest)
+
+    @classmethod
+    def from_trusted(cls, label, selector, value=None, domain="default",
+                     agent=None, precursors=None, version=0,
+                     processing_time=-1, uuid=None, bus=None,
+                     value_size=None, value_digest=None):
+        """
+        Builds a descriptor from fields that have been produced by another
+        Descriptor instance, such as metadata read from a storage backend.
+        Fields are not validated, selector must include a hash, and uuid must
+        be set.
+        """
+        self = cls.__new__(cls)
+        self.label = label
+        self.selector = selector
+        self.hash = selector[selector.find("%")+1:]
+        self.domain = domain
+        self.agent = agent
+        self.precursors = precursors if precursors is not None else []
+        self.version = version
+        self.processing_time = processing_time
+        self.uuid = uuid
+        self.bus = bus
+        self._value_size = value_size
+        self._value_digest = value_digest
+        if bus is None:
+            self._value = value
+        return self
+
     @classmethod
     def new_with_randomhash(cls, label, selector, *args, **kwargs):
         """
@@ -85,9 +239,15 @@ class Descriptor(object):
         Useful in case the user wants to inject a previously-seen value, to
         force its re-processing by all agents.
         """
+        return cls(label, cls.random_hash_selector(selector), *args, **kwargs)
+
+    @staticmethod
+    def random_hash_selector(selector):
+        """
+        Returns selector, followed by a random hash.
+        """
         random_hashstring = "%064x" % SystemRandom().getrandbits(256)
-        selector = selector.split('%')[0] + '%' + random_hashstring
-        return cls(label, selector, *args, **kwargs)
+        return selector.split('%')[0] + '%' + random_hashstring
 
     def spawn_descriptor(self, selector, value, agent, processing_time=-1,
                          label=None):
@@ -177,9 +337,7 @@ class Descriptor(object):
 
     def serialize(self, serializer):
         return serializer.dumps(
-            {k: getattr(self, k) for k in dir(self)
-             if k in ["label", "selector", "value", "domain", "agent",
-                      "precursors", "version", "processing_time", "uuid"]})
+            dict((k, getattr(self, k)) for k in self.FIELDS))
 
     def serialize_meta(self, serializer):
         """
@@ -189,9 +347,7 @@ class Descriptor(object):
         # ascii") which may result in invalid UTF-8, thus causing errors when
         # using dbus
         return serializer.dumps(
-            {k: getattr(self, k) for k in dir(self)
-             if k in ["label", "selector", "domain", "agent", "precursors",
-                      "version", "processing_time", "uuid"]})
+            dict((k, getattr(self, k)) for k in self.META_FIELDS))
 
     def serialize_value(self, serializer):
         """
@@ -204,7 +360,12 @@ class Descriptor(object):
         return serializer.loads(s)
 
     @classmethod
-    def unserialize(cls, serializer, s, bus=None):
+    def unserialize(cls, serializer, s, bus=None, trusted=False):
+        """
+        :param trusted: skip validation of fields, which must have been
+            serialized by serialize or serialize_meta, e.g. by a storage
+            backend. See from_trusted.
+        """
         try:
             unserialized = serializer.loads(s)
         except ValueError:
@@ -213,6 +374,8 @@ class Descriptor(object):
                 "unserializing a descriptor", exc_info=1)
             return None
         if unserialized:
+            if trusted:
+                return cls.from_trusted(bus=bus, **unserialized)
             return cls(bus=bus, **unserialized)
         else:
             return None
@@ -230,18 +393,129 @@ class Descriptor(object):
     @value.setter
     def value(self, value):
         self._value = value
+        self._value_size = None
+        self._value_digest = None
+
+    @property
+    def value_size(self):
+        """
+        Size of the value in bytes: length of str values, of the UTF-8
+        encoding of unicode values, and of str(value) for other values.
+        Recorded in serialized metadata, so that it is known without fetching
+        the value. None if it is unknown, e.g. for descriptors stored by
+        previous versions, until the value has been fetched.
+        """
+        if self._value_size is None:
+            file_value = self.file_value
+            if self.bus is None:
+                self._value_size = len(_value_bytes(self._value))
+            elif file_value is not None:
+                self._value_size = file_value.size()
+        return self._value_size
+
+    @property
+    def value_digest(self):
+        """
+        sha256 hex digest of the value, converted as described in value_size.
+        Unlike the descriptor hash, it only depends on the value. None if it
+        is unknown.
+        """
+        if self._value_digest is None:
+            file_value = self.file_value
+            if self.bus is None:
+                self._value_digest = hashlib.sha256(
+                    _value_bytes(self._value)).hexdigest()
+            elif file_value is not None:
+                hashed = hashlib.sha256()
+                for chunk in file_value.iter_chunks():
+                    hashed.update(chunk)
+                self._value_digest = hashed.hexdigest()
+        return self._value_digest
+
+    @property
+    def file_value(self):
+        """
+        FileValue containing the value of a descriptor created by from_file,
+        as long as this value has not been loaded. None otherwise.
+        """
+        if isinstance(self.bus, FileValue):
+            return self.bus
+        return None
 
     def __repr__(self):
-        v = repr(self.value)
-        if len(v) > 30:
-            v = "[%i][%s...]" % (len(v), v[:22])
-        return "%s:%s(%s)=%s" % (self.domain, self.selector, self.label.encode('utf-8'), v)
+        if self.bus is None:
+            v = repr(self._value)
+            if len(v) > 30:
+                v = "[%i][%s...]" % (len(v), v[:22])
+        else:
+            # do not fetch the value
+            size = self.value_size
+            v = "[%s bytes]" % (size if size is not None else "?")
+        return "%s:%s(%s)=%s" % (self.domain, self.selector,
+                                 self.label.encode('utf-8'), v)
+
+    def __getstate__(self):
+        # required by pickle protocols 0 and 1
+        return dict((k, getattr(self, k)) for k in self.__slots__
+                    if hasattr(self, k))
+
+    def __setstate__(self, state):
+        # state may also be the __dict__ of a descriptor pickled by a
+        # previous version
+        self._value_size = self._value_digest = None
+        for k, v in state.iteritems():
+            setattr(self, k, v)
+
+    def _state(self):
+        # value size and digest are derived from the value, and may not have
+        # been computed yet
+        return tuple(getattr(self, k, None) for k in self.__slots__
+                     if k not in ("_value_size", "_value_digest"))
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return self._state() == other._state()
+
+    def __ne__(self, other):
+        return not self == other
 
     def __hash__(self):
         """
         self.hash is never changed
         """
         return hash(self.hash)
+
+
+_NAMESPACE_REBUS_BYTES = Descriptor.NAMESPACE_REBUS.bytes
+
+
+def _uuid5(name):
+    """
+    Returns str(uuid.uuid5(Descriptor.NAMESPACE_REBUS, name)), without
+    building intermediate UUID objects.
+    """
+    digest = bytearray(hashlib.sha1(_NAMESPACE_REBUS_BYTES + name).digest())
+    digest[6] = (digest[6] & 0x0f) | 0x50
+    digest[8] = (digest[8] & 0x3f) | 0x80
+    h = str(digest[:16]).encode('hex')
+    return '%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def _value_bytes(value):
+    """
+    Returns value as a str, as described in Descriptor.value_size.
+    """
+    if type(value) is str:
+        return value
+    if type(value) is unicode:
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _hashed_selector(selector, h):
+    """
+    Returns selector, followed by hash h. Same as os.path.join(selector, "%" +
+    h).
+    """
+    if not selector.endswith('/'):
+        selector += '/'
+    return selector + "%" + h
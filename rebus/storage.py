@@ -1,8 +1,22 @@
 #!/usr/bin/env python2
 from rebus.tools.registry import Registry
+from rebus.tools import format_check
+from rebus.tools.serializer import picklev2 as store_serializer
+import argparse
+import bz2
+import hashlib
+import logging
+import os
+import tempfile
 import threading
+import time
 import re
 import sqlite3
+import struct
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+log = logging.getLogger("rebus.storage")
 
 
 class StorageRegistry(Registry):
@@ -69,7 +83,8 @@ class Storage(object):
         """
         raise NotImplementedError
 
-    def find_by_value(self, domain, selector_prefix, value_regex):
+    def find_by_value(self, domain, selector_prefix, value_regex, limit=0,
+                      offset=0):
         """
         Return a list of matching descriptors:
 
@@ -123,6 +138,18 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def get_value_path(self, domain, selector):
+        """
+        Returns the path of a local file containing the raw (unserialized)
+        value of this descriptor, allowing it to be read without copying it
+        through the bus. Returns None if the value is not stored this way, or
+        if descriptor could not be found.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string
+        """
+        return None
+
     def get_children(self, domain, selector, recurse=True):
         """
         Return a set of children descriptors from given selector.
@@ -131,8 +158,97 @@ class Storage(object):
         :param selector: string
         :param recurse: boolean, recursively fetch children if True
         """
+        return set(desc for _, desc in
+                   self.get_lineage(domain, selector,
+                                    max_depth=0 if recurse else 1))
+
+    def get_lineage(self, domain, selector, ancestors=False, max_depth=0,
+                    max_count=0, selector_prefix=''):
+        """
+        Returns a list of (depth, descriptor) couples, in breadth-first order:
+        descriptors spawned from selector, then descriptors spawned from them,
+        etc. If ancestors is True, precursors are walked instead. Each
+        descriptor is returned once, at its smallest depth. Descriptors
+        contain metadata only; their value may be fetched later.
+
+        Returns an empty list if descriptor could not be found.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string
+        :param ancestors: boolean, walk precursors instead of children
+        :param max_depth: int, max distance from selector. Unlimited if 0.
+        :param max_count: int, max number of descriptors to return.
+            Unlimited if 0.
+        :param selector_prefix: only descriptors whose selector starts with
+            this prefix are returned; others are still walked through
+        """
+        desc = self.get_descriptor(domain, selector)
+        if desc is None:
+            return []
+        if ancestors:
+            neighbours = self._list_precursors
+        else:
+            neighbours = self._list_children
+        result = []
+        seen = set([desc.selector])
+        frontier = [desc.selector]
+        depth = 0
+        while frontier and (max_depth <= 0 or depth < max_depth):
+            depth += 1
+            next_frontier = []
+            for current in frontier:
+                for neighbour in neighbours(domain, current):
+                    if neighbour in seen:
+                        continue
+                    seen.add(neighbour)
+                    next_frontier.append(neighbour)
+                    if not neighbour.startswith(selector_prefix):
+                        continue
+                    desc = self.get_descriptor(domain, neighbour)
+                    if desc is None:
+                        # precursor has been deleted
+                        continue
+                    result.append((depth, desc))
+                    if 0 < max_count <= len(result):
+                        return result
+            frontier = next_frontier
+        return result
+
+    def _list_children(self, domain, selector):
+        """
+        Returns selectors of descriptors that were spawned from selector.
+        Used by get_lineage.
+        """
         raise NotImplementedError
 
+    def _list_precursors(self, domain, selector):
+        """
+        Returns selectors of descriptors from which selector was spawned.
+        Used by get_lineage.
+        """
+        desc = self.get_descriptor(domain, selector)
+        if desc is None:
+            return []
+        return desc.precursors
+
+    def get_ancestry(self, domain, selector):
+        """
+        Returns the ancestry summary of a descriptor (see make_ancestry),
+        which allows checking for processing loops without walking its
+        ancestors.
+
+        Returns None if descriptor could not be found.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string
+        """
+        def list_precursors(sel):
+            desc = self.get_descriptor(domain, sel)
+            if desc is None:
+                return None
+            return desc.precursors
+        return resolve_ancestry(selector, lambda sel: None, list_precursors)
+
     def add(self, descriptor):
         """
         Add new descriptor to storage. Return False if descriptor was already
@@ -148,7 +264,9 @@ class Storage(object):
         configuration is serialized in config_txt.
 
         Returns True if this selector had not already been marked processed or
-        processable by this (agent, config_txt)
+        processable by this (agent, config_txt). Returns False if there is no
+        such descriptor, e.g. when it has been deleted by the garbage
+        collector.
 
         :param domain: string, domain on which operations are performed
         :param selector: string
@@ -164,7 +282,8 @@ class Storage(object):
         interactive mode whose configuration is serialized in config_txt.
 
         Returns True if this selector had not already been marked processed or
-        processable by this (agent, config_txt).
+        processable by this (agent, config_txt). Returns False if there is no
+        such descriptor.
 
         :param domain: string, domain on which operations are performed
         :param selector: string
@@ -174,6 +293,20 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def set_processing(self, domain, selector, processing):
+        """
+        Called by the bus master when an agent locks selector before
+        processing it (processing=True), and when it releases this lock after
+        a failure (processing=False). The processing ends when the agent
+        marks selector as processed. Backends whose garbage collector runs
+        concurrently may use it to keep descriptors that are being processed.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string
+        :param processing: boolean
+        """
+        pass
+
     def get_processed(self, domain, selector):
         """
         Return the set of (agents, config_txt) that have processed this
@@ -203,13 +336,37 @@ class Storage(object):
 
     def store_agent_state(self, agent_name, state):
         """
-        Store serialized agent state.
+        Store serialized agent state. Deltas appended to the previous state
+        are discarded.
 
         :param agent_name: string, agent name
         :param state: string, serialized internal state of agent
         """
         raise NotImplementedError
 
+    def append_agent_state(self, agent_name, delta):
+        """
+        Append a serialized change of agent state to its stored state.
+        Unlike store_agent_state, cost does not depend on the state size.
+
+        :param agent_name: string, agent name
+        :param delta: string, serialized change of internal state of agent
+        """
+        raise NotImplementedError
+
+    def load_agent_state_deltas(self, agent_name, position=0,
+                                max_bytes=1 << 20):
+        """
+        Return (deltas, next_position): a list of deltas that have been
+        appended to agent state, in order, starting at position. The list
+        is empty once all deltas have been read.
+
+        :param agent_name: string, agent name
+        :param position: int, 0 or a position returned by a previous call
+        :param max_bytes: stop reading deltas once their size exceeds it
+        """
+        raise NotImplementedError
+
     def load_agent_state(self, agent_name):
         """
         Return serialized agent state.
@@ -219,12 +376,64 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def list_agent_states(self):
+        """
+        Returns names of agents whose internal state is stored.
+        """
+        raise NotImplementedError
+
+    def list_domains(self):
+        """
+        Returns the list of domains containing descriptors.
+        """
+        raise NotImplementedError
+
+    def iter_selectors(self, domain):
+        """
+        Yields selectors of all descriptors of domain, from oldest to newest.
+        Descriptors added during the iteration may not be yielded.
+
+        :param domain: string, domain on which operations are performed
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def bulk_load(self):
+        """
+        Context manager, within which many descriptors are about to be added.
+        Backends may defer durability of these writes (e.g. commits) until it
+        exits.
+        """
+        yield
+
     def store_state(self):
         """
         May be used to store storage state.
         """
         pass
 
+    def storage_stats(self):
+        """
+        Returns a dictionary of backend-specific statistics, such as the
+        amount of stored data, mapping names to numbers.
+        """
+        return {}
+
+    def collect_garbage(self, dry_run=False):
+        """
+        Deletes descriptors that have expired according to retention rules,
+        together with their edges, processed entries and values that are not
+        referenced anymore.
+
+        Returns a report: a dictionary containing the number of deleted
+        'descriptors' and value 'blobs', the number of reclaimed 'bytes', and
+        'rules', mapping each retention rule to the number of descriptors it
+        expired.
+
+        :param dry_run: only report what would be deleted
+        """
+        return {'descriptors': 0, 'blobs': 0, 'bytes': 0, 'rules': {}}
+
     def list_unprocessed_by_agent(self, agent_name, config_txt):
         """
         Return a list of (domain, uuid, selector) that have not been processed
@@ -236,6 +445,16 @@ class Storage(object):
         """
         return []
 
+    def iter_unprocessed_by_agent(self, agent_name, config_txt):
+        """
+        Returns an iterator over (domain, uuid, selector) that have not been
+        processed by this agent, like list_unprocessed_by_agent. Descriptors
+        that are added after this method has been called are not returned.
+
+        Backends may read descriptors lazily, while the iterator is consumed.
+        """
+        return iter(self.list_unprocessed_by_agent(agent_name, config_txt))
+
     @staticmethod
     def add_arguments(subparser):
         """
@@ -245,9 +464,46 @@ class Storage(object):
 
 
 class MetadataDB(object):
-    def __init__(self, db_path):
+    """
+    sqlite3 database used by storage backends. Writes are performed using a
+    single connection, and are grouped: they are committed every
+    commit_interval seconds, or when commit_rows writes are pending, whichever
+    comes first. Up to commit_interval seconds of writes may thus be lost on
+    crash.
+
+    Queries on processed descriptors are served by per-thread reader
+    connections, and take pending writes into account.
+    """
+    #: Maximum number of trigrams looked up in the value trigram index for a
+    #: single query
+    MAX_QUERY_TRIGRAMS = 32
+
+    #: Blobs containing more distinct trigrams are not indexed, so that a
+    #: single large binary does not add millions of index rows. They are
+    #: always read when searching values.
+    MAX_BLOB_TRIGRAMS = 16384
+
+    def __init__(self, db_path, commit_interval=0, commit_rows=1000):
+        """
+        :param commit_interval: durability window, in seconds. 0 commits
+            every write.
+        :param commit_rows: maximum number of uncommitted writes
+        """
+        self._db_path = db_path
+        self._commit_interval = commit_interval
+        self._commit_rows = commit_rows
+        #: number of uncommitted writes
+        self._pending = 0
+        #: number of active deferred_commits contexts
+        self._deferred = 0
+        #: uncommitted processed rows: self._pending_processed[(domain,
+        #: selector)] is a set of (agent_name, config_txt)
+        self._pending_processed = defaultdict(set)
+        self._reader_conns = threading.local()
         self._dblock = threading.RLock()
-        self._db = sqlite3.connect(db_path)
+        # may be used from a background index verification thread
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
         self._cursor = self._db.cursor()
         self._cursor.execute(
             'CREATE TABLE IF NOT EXISTS processed(domain TEXT, selector TEXT, '
@@ -255,108 +511,1286 @@ class MetadataDB(object):
         self._cursor.execute(
             'CREATE UNIQUE INDEX IF NOT EXISTS no_processed_dups ON '
             'processed(domain, selector, agent_name, config_txt)')
+        # Descriptor metadata index. meta contains the serialized descriptor
+        # metadata, other columns are used for lookups.
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS descriptors(id INTEGER PRIMARY KEY, '
+            'domain TEXT, selector TEXT, prefix TEXT, uuid TEXT, label TEXT, '
+            'agent TEXT, version INTEGER, processing_time REAL, '
+            'is_root INTEGER, meta BLOB)')
         self._cursor.execute(
-            'CREATE TABLE IF NOT EXISTS selectors(domain TEXT, selector TEXT)')
+            'CREATE UNIQUE INDEX IF NOT EXISTS no_descriptor_dups ON '
+            'descriptors(domain, selector)')
         self._cursor.execute(
-            'CREATE UNIQUE INDEX IF NOT EXISTS no_selector_dups ON '
-            'selectors(domain, selector)')
+            'CREATE INDEX IF NOT EXISTS descriptors_by_version ON '
+            'descriptors(domain, prefix, version)')
+        self._cursor.execute(
+            'CREATE INDEX IF NOT EXISTS descriptors_by_uuid ON '
+            'descriptors(domain, uuid)')
+        #: edges(domain, precursor, selector): selector has been spawned from
+        #: precursor
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS edges(domain TEXT, precursor TEXT, '
+            'selector TEXT)')
+        self._cursor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS no_edge_dups ON '
+            'edges(domain, precursor, selector)')
+        self._cursor.execute(
+            'CREATE INDEX IF NOT EXISTS edges_by_selector ON '
+            'edges(domain, selector)')
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS storage_info(key TEXT PRIMARY KEY, '
+            'value TEXT)')
+        #: blobs(ref, refcount, size, data_size): values stored in a
+        #: BlobStore, the number of descriptors referencing them, their size
+        #: on disk and their size before compression
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS blobs(ref TEXT PRIMARY KEY, '
+            'refcount INTEGER, size INTEGER)')
+        self._add_column('blobs', 'data_size', 'INTEGER')
+        #: blobs.trigrams is 1 if trigrams of this blob have been indexed, 0
+        #: if it is not to be indexed, NULL if it has not been examined yet
+        self._add_column('blobs', 'trigrams', 'INTEGER')
+        #: value_trigrams(trigram, blob): blob, identified by its rowid in
+        #: the blobs table, contains trigram
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS value_trigrams(trigram BLOB, '
+            'blob INTEGER, PRIMARY KEY(trigram, blob)) WITHOUT ROWID')
+        self._cursor.execute(
+            'CREATE INDEX IF NOT EXISTS value_trigrams_by_blob ON '
+            'value_trigrams(blob)')
+        self._add_column('descriptors', 'value_ref', 'TEXT')
+        #: descriptors.added: time at which the descriptor has been stored
+        if self._add_column('descriptors', 'added', 'REAL'):
+            # ages of existing descriptors are counted from now on
+            self._cursor.execute('UPDATE descriptors SET added=?',
+                                 (time.time(),))
+        #: descriptors.ancestry: serialized ancestry summary (see
+        #: make_ancestry). NULL if it has not been computed yet, as for
+        #: descriptors added before their precursors were indexed.
+        self._add_column('descriptors', 'ancestry', 'BLOB')
+        # Superseded by the descriptors table
+        self._cursor.execute('DROP TABLE IF EXISTS selectors')
+        #: processed_counts(domain, agent_name, count): number of distinct
+        #: selectors processed by agent_name. Rows having an empty agent_name
+        #: count descriptors in domain.
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS processed_counts(domain TEXT, '
+            'agent_name TEXT, count INTEGER, PRIMARY KEY(domain, agent_name))')
+        if self.get_info('processed_counts') is None:
+            # Database created by a previous version
+            self._cursor.execute('DELETE FROM processed_counts')
+            self._cursor.execute(
+                'INSERT INTO processed_counts(domain, agent_name, count) '
+                'SELECT domain, agent_name, COUNT(DISTINCT selector) '
+                'FROM processed GROUP BY domain, agent_name')
+            self._cursor.execute(
+                "INSERT INTO processed_counts(domain, agent_name, count) "
+                "SELECT domain, '', COUNT(1) FROM descriptors GROUP BY domain")
+            self._cursor.execute(
+                'INSERT OR REPLACE INTO storage_info(key, value) '
+                "VALUES ('processed_counts', '1')")
+        self._db.commit()
+
+        if commit_interval > 0:
+            self._flush_needed = threading.Event()
+            t = threading.Thread(target=self._flush_loop)
+            t.daemon = True
+            t.start()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_needed.wait()
+            time.sleep(self._commit_interval)
+            self.flush()
+
+    def _written(self):
+        """
+        Must be called with _dblock held, after each write.
+        """
+        self._pending += 1
+        if self._pending >= self._commit_rows or \
+                (self._commit_interval <= 0 and not self._deferred):
+            self._commit()
+        elif self._pending == 1 and self._commit_interval > 0:
+            self._flush_needed.set()
+
+    def _commit(self):
+        if self._commit_interval > 0:
+            self._flush_needed.clear()
         self._db.commit()
+        self._pending = 0
+        self._pending_processed.clear()
+
+    def flush(self):
+        """
+        Commits pending writes.
+        """
+        with self._dblock:
+            if self._pending:
+                self._commit()
+
+    @contextmanager
+    def deferred_commits(self):
+        """
+        Context manager within which writes are committed by batches of
+        commit_rows, even if commit_interval is 0. Pending writes are
+        committed when it exits.
+        """
+        with self._dblock:
+            self._deferred += 1
+        try:
+            yield
+        finally:
+            with self._dblock:
+                self._deferred -= 1
+            self.flush()
+
+    def close(self):
+        self.flush()
+        with self._dblock:
+            self._db.close()
+
+    def _reader(self):
+        """
+        Returns this thread's reader connection. It does not see uncommitted
+        writes.
+        """
+        conn = getattr(self._reader_conns, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, isolation_level=None)
+            self._reader_conns.conn = conn
+        return conn
+
+    def _add_column(self, table, column, decl):
+        """
+        Adds a column to a table that has been created by a previous version.
+        Returns True if the column has been added.
+        """
+        columns = [row[1] for row in
+                   self._cursor.execute('PRAGMA table_info(%s)' % table)]
+        if column in columns:
+            return False
+        self._cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                             (table, column, decl))
+        return True
+
+    def get_info(self, key, default=None):
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT value FROM storage_info WHERE key=?',
+                (key,)).fetchone()
+        if res is None:
+            return default
+        return str(res[0])
+
+    def set_info(self, key, value):
+        with self._dblock:
+            self._cursor.execute(
+                'INSERT OR REPLACE INTO storage_info(key, value) '
+                'VALUES (?, ?)', (key, str(value)))
+            self._commit()
+
+    def add_descriptor(self, desc, meta, value_ref=None):
+        """
+        Adds a descriptor to the metadata index. Returns False if it was
+        already present.
+
+        :param desc: Descriptor instance
+        :param meta: serialized descriptor metadata
+        :param value_ref: reference to the value in a BlobStore, if any. Its
+            reference count is incremented.
+        """
+        domain = desc.domain
+        selector = desc.selector
+        label = desc.label
+        if not isinstance(label, unicode):
+            label = label.decode('utf-8', 'replace')
+        with self._dblock:
+            self._cursor.execute(
+                'INSERT OR IGNORE INTO descriptors(domain, selector, prefix, '
+                'uuid, label, agent, version, processing_time, is_root, meta, '
+                'value_ref, added) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (domain, selector, selector.split('%')[0], desc.uuid, label,
+                 desc.agent, desc.version, desc.processing_time,
+                 int(not desc.precursors), sqlite3.Binary(meta), value_ref,
+                 time.time()))
+            if self._cursor.rowcount != 1:
+                return False
+            if value_ref is not None:
+                self._incref(value_ref)
+            self._add_count(domain, '', 1)
+            self._cursor.executemany(
+                'INSERT OR IGNORE INTO edges(domain, precursor, selector) '
+                'VALUES (?, ?, ?)',
+                [(domain, precursor, selector) for precursor in
+                 desc.precursors])
+            ancestries = [self._cached_ancestry(domain, precursor)
+                          for precursor in desc.precursors]
+            if None not in ancestries:
+                self._set_ancestry(domain, selector,
+                                   make_ancestry(selector, ancestries))
+            self._written()
+            return True
+
+    def _cached_ancestry(self, domain, selector):
+        """
+        Returns the stored ancestry summary of selector, None if it is not
+        indexed or if its summary has not been computed.
+        """
+        res = self._cursor.execute(
+            'SELECT ancestry FROM descriptors WHERE domain=? AND selector=?',
+            (domain, selector)).fetchone()
+        if res is None or res[0] is None:
+            return None
+        return store_serializer.loads(str(res[0]))
+
+    def _set_ancestry(self, domain, selector, ancestry):
+        self._cursor.execute(
+            'UPDATE descriptors SET ancestry=? WHERE domain=? AND selector=?',
+            (sqlite3.Binary(store_serializer.dumps(ancestry)), domain,
+             selector))
+
+    def get_ancestry(self, domain, selector):
+        """
+        Returns the ancestry summary (see make_ancestry) of a descriptor, None
+        if it is not indexed. Missing summaries of the descriptor and its
+        ancestors are computed and saved.
+        """
+        def list_precursors(sel):
+            res = self._cursor.execute(
+                'SELECT 1 FROM descriptors WHERE domain=? AND selector=?',
+                (domain, sel)).fetchone()
+            if res is None:
+                return None
+            return self.list_precursors(domain, sel)
+
+        def save(sel, ancestry):
+            self._set_ancestry(domain, sel, ancestry)
+            self._written()
+
+        with self._dblock:
+            return resolve_ancestry(
+                selector, lambda sel: self._cached_ancestry(domain, sel),
+                list_precursors, save)
+
+    def has_descriptor(self, domain, selector):
+        with self._dblock:
+            return self._cursor.execute(
+                'SELECT 1 FROM descriptors WHERE domain=? AND selector=?',
+                (domain, selector)).fetchone() is not None
+
+    def get_meta(self, domain, selector):
+        """
+        Returns serialized metadata for this descriptor, None if it is not
+        indexed.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT meta FROM descriptors WHERE domain=? AND selector=?',
+                (domain, selector)).fetchone()
+        if res is None:
+            return None
+        return str(res[0])
+
+    def add_blob(self, ref, size, data_size):
+        """
+        Records the size of a new BlobStore blob.
+
+        :param size: size on disk
+        :param data_size: size before compression
+        """
+        with self._dblock:
+            self._cursor.execute(
+                'INSERT OR IGNORE INTO blobs(ref, refcount, size, data_size) '
+                'VALUES (?, 0, ?, ?)', (ref, size, data_size))
+            self._written()
+
+    def list_unindexed_blobs(self, count):
+        """
+        Returns a list of (reference, size before compression) of at most
+        count blobs that have not been examined by add_trigrams yet. The size
+        may be None.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT ref, data_size FROM blobs WHERE trigrams IS NULL '
+                'LIMIT ?', (count,)).fetchall()
+        return [(str(ref), data_size) for ref, data_size in res]
+
+    def add_trigrams(self, ref, trigrams):
+        """
+        Indexes the trigrams contained in a BlobStore blob.
+
+        :param trigrams: set of 3-byte strings, None if the blob is not to be
+            indexed. Sets larger than MAX_BLOB_TRIGRAMS are not indexed.
+        """
+        if trigrams is not None and len(trigrams) > self.MAX_BLOB_TRIGRAMS:
+            trigrams = None
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT rowid FROM blobs WHERE ref=?', (ref,)).fetchone()
+            if res is None:
+                # removed in the meantime
+                return
+            blob = res[0]
+            if trigrams is not None:
+                self._cursor.executemany(
+                    'INSERT OR IGNORE INTO value_trigrams(trigram, blob) '
+                    'VALUES (?, ?)',
+                    ((sqlite3.Binary(t), blob) for t in trigrams))
+            self._cursor.execute(
+                'UPDATE blobs SET trigrams=? WHERE rowid=?',
+                (int(trigrams is not None), blob))
+            self._written()
+
+    def iter_value_candidates(self, domain, selector_prefix, trigrams):
+        """
+        Generates (selector, value reference) of descriptors whose selector
+        starts with selector_prefix, from oldest to newest, which may have a
+        value containing all of trigrams. Descriptors whose value has not been
+        indexed are always generated; their value reference may be None.
+
+        Pending writes are committed first; descriptors added later may not be
+        generated.
+
+        :param trigrams: set of 3-byte strings. At most
+            MAX_QUERY_TRIGRAMS of them are used.
+        """
+        self.flush()
+        reader = self._reader()
+        candidates = None
+        if trigrams:
+            trigrams = sorted(trigrams)[:self.MAX_QUERY_TRIGRAMS]
+            candidates = set(blob for (blob,) in reader.execute(
+                'SELECT blob FROM value_trigrams WHERE trigram IN (%s) '
+                'GROUP BY blob HAVING COUNT(1)=?' %
+                ','.join('?' * len(trigrams)),
+                [sqlite3.Binary(t) for t in trigrams] + [len(trigrams)]))
+        cond, params = _prefix_range(selector_prefix)
+        res = reader.execute(
+            'SELECT selector, value_ref, blobs.rowid, blobs.trigrams '
+            'FROM descriptors LEFT JOIN blobs ON blobs.ref=value_ref '
+            'WHERE domain=? AND ' + cond + ' ORDER BY id',
+            (domain,) + params)
+        for selector, value_ref, blob, indexed in res:
+            if candidates is not None and indexed and blob not in candidates:
+                continue
+            yield str(selector), None if value_ref is None else str(value_ref)
+
+    def _add_count(self, domain, agent_name, delta):
+        """
+        Must be called with _dblock held. Updates processed_counts.
+        """
+        self._cursor.execute(
+            'INSERT OR IGNORE INTO processed_counts(domain, agent_name, '
+            'count) VALUES (?, ?, 0)', (domain, agent_name))
+        self._cursor.execute(
+            'UPDATE processed_counts SET count=count+? WHERE domain=? AND '
+            'agent_name=?', (delta, domain, agent_name))
+
+    def _incref(self, ref):
+        self._cursor.execute(
+            'INSERT OR IGNORE INTO blobs(ref, refcount) VALUES (?, 0)', (ref,))
+        self._cursor.execute(
+            'UPDATE blobs SET refcount=refcount+1 WHERE ref=?', (ref,))
+
+    def get_value_ref(self, domain, selector):
+        """
+        Returns the BlobStore reference of this descriptor's value, None if it
+        is unknown.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT value_ref FROM descriptors WHERE domain=? AND '
+                'selector=?', (domain, selector)).fetchone()
+        if res is None or res[0] is None:
+            return None
+        return str(res[0])
+
+    def set_value_ref(self, domain, selector, value_ref):
+        """
+        Sets the value reference of an indexed descriptor that did not have
+        one (value stored using a previous layout).
+        """
+        with self._dblock:
+            self._cursor.execute(
+                'UPDATE descriptors SET value_ref=? WHERE domain=? AND '
+                'selector=? AND value_ref IS NULL',
+                (value_ref, domain, selector))
+            if self._cursor.rowcount == 1:
+                self._incref(value_ref)
+                self._written()
+
+    def get_refcount(self, value_ref):
+        """
+        Returns the number of descriptors referencing this value.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT refcount FROM blobs WHERE ref=?',
+                (value_ref,)).fetchone()
+        if res is None:
+            return 0
+        return res[0]
+
+    def blob_stats(self):
+        """
+        Returns (number of referenced blobs, total size on disk, total size
+        before compression). Sizes only take into account blobs whose sizes
+        are known.
+        """
+        with self._dblock:
+            count, size, data_size = self._cursor.execute(
+                'SELECT COUNT(1), SUM(size), SUM(data_size) FROM blobs '
+                'WHERE refcount > 0 AND data_size IS NOT NULL').fetchone()
+        return count, size or 0, data_size or 0
+
+    def version_lookup(self, domain, prefix, version):
+        """
+        Returns the selector of the given version of prefix (/sel/ector/),
+        None if it is unknown. Negative versions are evaluated from the most
+        recent version, counting backwards.
+        """
+        with self._dblock:
+            if version < 0:
+                maxversion = self._cursor.execute(
+                    'SELECT MAX(version) FROM descriptors WHERE domain=? AND '
+                    'prefix=?', (domain, prefix)).fetchone()[0]
+                if maxversion is None:
+                    return None
+                version = maxversion + version + 1
+            res = self._cursor.execute(
+                'SELECT selector FROM descriptors WHERE domain=? AND prefix=? '
+                'AND version=?', (domain, prefix, version)).fetchone()
+        if res is None:
+            return None
+        return str(res[0])
+
+    def list_children(self, domain, selector):
+        """
+        Returns selectors of descriptors that were spawned from selector.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT selector FROM edges WHERE domain=? AND precursor=?',
+                (domain, selector)).fetchall()
+        return [str(child) for (child,) in res]
+
+    def list_precursors(self, domain, selector):
+        """
+        Returns selectors of descriptors from which selector was spawned.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT precursor FROM edges WHERE domain=? AND selector=?',
+                (domain, selector)).fetchall()
+        return [str(precursor) for (precursor,) in res]
 
-        def regex_function(pattern, string):
-            return re.match(pattern, string) is None
+    def list_metas_by_uuid(self, domain, uuid):
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT meta FROM descriptors WHERE domain=? AND uuid=?',
+                (domain, uuid)).fetchall()
+        return [str(meta) for (meta,) in res]
 
-        self._db.create_function('REGEXP', 2, regex_function)
+    def list_selectors_by_prefix(self, domain, selector_prefix):
+        """
+        Returns selectors starting with selector_prefix, from oldest to newest.
+        """
+        cond, params = _prefix_range(selector_prefix)
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT selector FROM descriptors WHERE domain=? AND ' + cond +
+                ' ORDER BY id', (domain,) + params).fetchall()
+        return [str(selector) for (selector,) in res]
 
-    def add_selector(self, domain, selector):
+    def list_unstored(self):
+        """
+        Returns (domain, selector) of indexed descriptors that do not have a
+        value reference.
+        """
         with self._dblock:
+            res = self._cursor.execute(
+                'SELECT domain, selector FROM descriptors WHERE '
+                'value_ref IS NULL').fetchall()
+        return [(str(domain), str(selector)) for domain, selector in res]
+
+    def remove_descriptor(self, domain, selector):
+        """
+        Removes a descriptor from the index, decrements the reference count of
+        its value.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT value_ref FROM descriptors WHERE domain=? AND '
+                'selector=?', (domain, selector)).fetchone()
+            if res is None:
+                return
+            if res[0] is not None:
+                self._cursor.execute(
+                    'UPDATE blobs SET refcount=refcount-1 WHERE ref=?',
+                    (res[0],))
+            self._cursor.execute(
+                'DELETE FROM descriptors WHERE domain=? AND selector=?',
+                (domain, selector))
+            self._add_count(domain, '', -1)
             self._cursor.execute(
-                'INSERT OR IGNORE INTO selectors(domain, selector) '
-                'VALUES (?, ?)',
+                'DELETE FROM edges WHERE domain=? AND selector=?',
                 (domain, selector))
-            self._db.commit()
+            self._written()
+
+    def delete_descriptor(self, domain, selector):
+        """
+        Removes a descriptor from the index, together with its edges and
+        processed rows, and decrements the reference count of its value.
+        Returns its value reference, None if it was not indexed.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT value_ref FROM descriptors WHERE domain=? AND '
+                'selector=?', (domain, selector)).fetchone()
+            if res is None:
+                return None
+            self.remove_descriptor(domain, selector)
+            self._cursor.execute(
+                'DELETE FROM edges WHERE domain=? AND precursor=?',
+                (domain, selector))
+            agents = self._cursor.execute(
+                'SELECT DISTINCT agent_name FROM processed WHERE domain=? AND '
+                'selector=?', (domain, selector)).fetchall()
+            for (agent_name,) in agents:
+                self._add_count(domain, agent_name, -1)
+            self._cursor.execute(
+                'DELETE FROM processed WHERE domain=? AND selector=?',
+                (domain, selector))
+            self._pending_processed.pop((domain, selector), None)
+            self._written()
+            return None if res[0] is None else str(res[0])
+
+    def list_domains(self):
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT DISTINCT domain FROM descriptors').fetchall()
+        return [str(domain) for (domain,) in res]
+
+    def iter_retention_records(self, domain, selector_prefix,
+                               batch_size=10000):
+        """
+        Generates (selector, uuid, version, added, value size on disk) of
+        descriptors whose selector starts with selector_prefix, from newest to
+        oldest, as expected by RetentionRule.expired. Descriptors whose value
+        is still being written are skipped.
+        """
+        self.flush()
+        cond, params = _prefix_range(selector_prefix)
+        last_id = None
+        while True:
+            rows = self._reader().execute(
+                'SELECT id, selector, uuid, version, added, blobs.size '
+                'FROM descriptors LEFT JOIN blobs ON blobs.ref=value_ref '
+                'WHERE domain=? AND ' + cond + ' AND id < ? AND '
+                'value_ref IS NOT NULL ORDER BY id DESC LIMIT ?',
+                (domain,) + params + (last_id or (1 << 62), batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            for _, selector, uuid, version, added, size in rows:
+                yield str(selector), str(uuid), version, added, size or 0
+            last_id = rows[-1][0]
+
+    def blob_info(self, ref):
+        """
+        Returns (reference count, size on disk) of a blob, None if it is
+        unknown.
+        """
+        with self._dblock:
+            return self._cursor.execute(
+                'SELECT refcount, size FROM blobs WHERE ref=?',
+                (ref,)).fetchone()
+
+    def list_orphan_blobs(self):
+        """
+        Returns a list of (reference, size on disk) of blobs that are not
+        referenced by any descriptor.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT ref, size FROM blobs WHERE refcount <= 0').fetchall()
+        return [(str(ref), size or 0) for ref, size in res]
+
+    def is_trigram_indexed(self, ref):
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT trigrams FROM blobs WHERE ref=?', (ref,)).fetchone()
+        return res is not None and bool(res[0])
+
+    def remove_blob(self, ref):
+        """
+        Forgets a blob and its trigrams, unless it is referenced. Returns True
+        if it has been removed.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT rowid, trigrams FROM blobs WHERE ref=? AND '
+                'refcount <= 0', (ref,)).fetchone()
+            if res is None:
+                return False
+            blob, indexed = res
+            if indexed:
+                self._cursor.execute(
+                    'DELETE FROM value_trigrams WHERE blob=?', (blob,))
+            self._cursor.execute('DELETE FROM blobs WHERE rowid=?', (blob,))
+            self._written()
+            return True
+
+    def iter_descriptors(self, batch_size=10000, domain=None):
+        """
+        Yields (domain, selector) of all indexed descriptors, or of those of
+        domain if it is not None, from oldest to newest. Queries are performed
+        in batches, so that the database is not locked during the whole
+        iteration.
+        """
+        last_id = 0
+        cond, params = '', ()
+        if domain is not None:
+            cond, params = 'domain=? AND ', (domain,)
+        while True:
+            with self._dblock:
+                res = self._cursor.execute(
+                    'SELECT id, domain, selector FROM descriptors WHERE ' +
+                    cond + 'id>? ORDER BY id LIMIT ?',
+                    params + (last_id, batch_size)).fetchall()
+            if not res:
+                return
+            for last_id, domain, selector in res:
+                yield str(domain), str(selector)
+
+    def list_uuids(self, domain):
+        """
+        Returns a dictionary mapping known UUIDs to their labels.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT uuid, label FROM descriptors WHERE domain=? '
+                'ORDER BY is_root, id DESC', (domain,)).fetchall()
+        # Heuristic for choosing uuid label : prefer label of a descriptor
+        # that has no precursor (sorted last, overrides other labels)
+        return {str(uuid): label for uuid, label in res}
 
     def add_processed(self, domain, selector, agent_name, config_txt):
         """
         Returns True if this (domain, selector) had not already been marked as
-        processed by this (agent_name, config_txt)
+        processed by this (agent_name, config_txt). Returns False if it is not
+        indexed, e.g. when it has been deleted by the garbage collector.
         """
         with self._dblock:
+            if not self.has_descriptor(domain, selector):
+                return False
+            # processed by this agent using another configuration?
+            known = self._cursor.execute(
+                'SELECT 1 FROM processed WHERE domain=? AND selector=? AND '
+                'agent_name=? LIMIT 1',
+                (domain, selector, agent_name)).fetchone() is not None
             try:
                 self._cursor.execute(
                     'INSERT OR ABORT INTO processed(domain, selector, '
                     'agent_name, config_txt) VALUES (?, ?, ?, ?)',
                     (domain, selector, agent_name, config_txt))
-                self._db.commit()
-                return True
             except sqlite3.IntegrityError:
                 return False
+            if not known:
+                self._add_count(domain, agent_name, 1)
+            self._pending_processed[(domain, selector)].add(
+                (agent_name, config_txt))
+            self._written()
+            return True
 
     def is_processed(self, domain, selector, agent_name, config_txt):
         with self._dblock:
-            res = self._cursor.execute(
-                'SELECT COUNT(1) FROM PROCESSED WHERE domain=? AND selector=? '
-                'AND agent_name=? AND config_txt=?',
-                (domain, selector, agent_name, config_txt)
-            ).fetchone()[0]
-            return res == 1
+            pending = self._pending_processed.get((domain, selector), ())
+            if (agent_name, config_txt) in pending:
+                return True
+        res = self._reader().execute(
+            'SELECT COUNT(1) FROM PROCESSED WHERE domain=? AND selector=? '
+            'AND agent_name=? AND config_txt=?',
+            (domain, selector, agent_name, config_txt)
+        ).fetchone()[0]
+        return res == 1
 
     def list_processed(self, domain, selector):
         with self._dblock:
-            res = self._cursor.execute(
-                'SELECT agent_name, config_txt FROM processed WHERE '
-                'domain=? AND selector=?', (domain, selector)).fetchall()
-            return {(str(agent_name), str(config_txt)) for
-                    (agent_name, config_txt) in res}
+            pending = set(self._pending_processed.get((domain, selector), ()))
+        res = self._reader().execute(
+            'SELECT agent_name, config_txt FROM processed WHERE '
+            'domain=? AND selector=?', (domain, selector)).fetchall()
+        return pending | {(str(agent_name), str(config_txt)) for
+                          (agent_name, config_txt) in res}
 
     def processed_stats(self, domain):
-        # FIXME take domain into account
-        with self._dblock:
-            by_agent = self._cursor.execute(
-                'SELECT agent_name, COUNT(DISTINCT selector) FROM processed '
-                'WHERE domain=? GROUP BY agent_name',
-                (domain,)).fetchall()
-            total = self._cursor.execute(
-                'SELECT COUNT(DISTINCT selector) FROM processed '
-                'WHERE domain=?',
-                (domain,)).fetchone()[0]
-        return ([(str(agent_name), count) for agent_name, count in by_agent],
-                total)
-
-    def list_unprocessed_by_agent(self, agent_name, config_txt):
+        """
+        Returns ([(agent name, number of processed selectors), ...], number
+        of descriptors in domain), read from counters that are maintained by
+        add_descriptor and add_processed.
+        """
         with self._dblock:
-            unprocessed = self._cursor.execute(
-                'SELECT domain, selector FROM selectors '
-                'GROUP BY domain, selector EXCEPT '
-                'SELECT domain, selector FROM processed '
-                'WHERE agent_name=? AND config_txt=? '
-                'GROUP BY domain, selector',
-                (agent_name, config_txt)).fetchall()
-        return [(str(domain), str(selector)) for domain, selector in
-                unprocessed]
+            rows = self._cursor.execute(
+                'SELECT agent_name, count FROM processed_counts '
+                'WHERE domain=? AND count > 0', (domain,)).fetchall()
+        total = 0
+        by_agent = []
+        for agent_name, count in rows:
+            if agent_name:
+                by_agent.append((str(agent_name), count))
+            else:
+                total = count
+        return sorted(by_agent), total
+
+    def iter_unprocessed_by_agent(self, agent_name, config_txt,
+                                  chunk_size=1000):
+        """
+        Returns a generator of (domain, uuid, selector) of descriptors that
+        have not been processed by this agent, from oldest to newest.
+        Descriptors indexed after this method has been called are not
+        generated.
+
+        Rows are read by chunks of chunk_size; no read transaction is kept
+        open between chunks.
+        """
+        self.flush()
+        max_id = self._reader().execute(
+            'SELECT MAX(id) FROM descriptors').fetchone()[0]
+        return self._iter_unprocessed(agent_name, config_txt, max_id or 0,
+                                      chunk_size)
+
+    def _iter_unprocessed(self, agent_name, config_txt, max_id, chunk_size):
+        last_id = 0
+        while last_id < max_id:
+            # descriptors may have been marked as processed meanwhile
+            self.flush()
+            rows = self._reader().execute(
+                'SELECT id, domain, uuid, selector FROM descriptors AS d '
+                'WHERE id > ? AND id <= ? AND NOT EXISTS ('
+                'SELECT 1 FROM processed AS p WHERE p.domain=d.domain AND '
+                'p.selector=d.selector AND agent_name=? AND config_txt=?) '
+                'ORDER BY id LIMIT ?',
+                (last_id, max_id, agent_name, config_txt,
+                 chunk_size)).fetchall()
+            if not rows:
+                return
+            for _, domain, uuid, selector in rows:
+                yield str(domain), str(uuid), str(selector)
+            last_id = rows[-1][0]
 
     def find(self, domain, selector_regex, limit, offset):
+        """
+        Returns selectors matching selector_regex, from newest to oldest.
+        Only descriptors having the literal prefix of selector_regex are
+        read from the (domain, selector) index, then verified.
+        """
+        regex = re.compile(selector_regex)
+        cond, params = _prefix_range(regex_literal_prefix(selector_regex))
+        result = []
+        with self._dblock:
+            res = self._db.execute(
+                'SELECT selector FROM descriptors WHERE domain=? AND ' +
+                cond + ' ORDER BY id DESC', (domain,) + params)
+            for (selector,) in res:
+                if not regex.match(selector):
+                    continue
+                if offset > 0:
+                    offset -= 1
+                    continue
+                result.append(str(selector))
+                if limit != 0 and len(result) >= limit:
+                    break
+        return result
+
+    def find_by_selector(self, domain, selector_prefix, limit, offset):
+        """
+        Returns serialized metadata of descriptors whose selector starts with
+        selector_prefix, from oldest to newest.
+        """
         if limit == 0:
             # no limit
             limit = -1
+        cond, params = _prefix_range(selector_prefix)
         with self._dblock:
             res = self._cursor.execute(
-                'SELECT selector FROM processed '
-                'WHERE selector REGEXP ? AND DOMAIN=? '
-                'ORDER BY _rowid_ DESC '
-                'LIMIT ? OFFSET ?',
-                (domain, selector_regex, limit, offset)
-            ).fetchall()
-        return [str(selector) for selector in res]
+                'SELECT meta FROM descriptors WHERE domain=? AND ' + cond +
+                ' ORDER BY id LIMIT ? OFFSET ?',
+                (domain,) + params + (limit, offset)).fetchall()
+        return [str(meta) for (meta,) in res]
+
+
+#: (length, crc32) header of records of agent state delta logs
+STATE_DELTA_HEADER = struct.Struct('<II')
+
+
+def append_state_delta(path, delta):
+    """
+    Durably appends a record containing delta to the agent state delta log
+    file at path.
+    """
+    with open(path, 'ab') as fp:
+        fp.write(STATE_DELTA_HEADER.pack(len(delta),
+                                         zlib.crc32(delta) & 0xffffffff))
+        fp.write(delta)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def read_state_deltas(path, position, max_bytes):
+    """
+    Reads records of the agent state delta log file at path, starting at byte
+    offset position, until more than max_bytes have been read.
+    Returns (deltas, next position). Reading stops at the first incomplete or
+    corrupted record, such as a record whose append has been interrupted.
+    """
+    deltas = []
+    if not os.path.isfile(path):
+        return deltas, position
+    size = 0
+    with open(path, 'rb') as fp:
+        fp.seek(position)
+        while size <= max_bytes:
+            header = fp.read(STATE_DELTA_HEADER.size)
+            if len(header) < STATE_DELTA_HEADER.size:
+                break
+            length, crc = STATE_DELTA_HEADER.unpack(header)
+            delta = fp.read(length)
+            if len(delta) < length or zlib.crc32(delta) & 0xffffffff != crc:
+                log.warning("Ignoring corrupted agent state deltas in %s at "
+                            "offset %d", path, position)
+                break
+            deltas.append(delta)
+            size += length
+            position += STATE_DELTA_HEADER.size + length
+    return deltas, position
+
+
+def write_state_file(path, state):
+    """
+    Atomically replaces the agent state file at path, and discards deltas
+    that had been appended to the previous state.
+    """
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(state)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(path + '.tmp', path)
+    # Deltas may be replayed on top of the new state if the process stops
+    # here, hence agents' deltas must be idempotent.
+    if os.path.exists(path + '.deltas'):
+        os.remove(path + '.deltas')
+
+
+#: Maximum number of distinct levels kept per selector prefix in ancestry
+#: summaries. format_check.processing_depth only needs to know whether a
+#: prefix appears at more than 2 levels.
+ANCESTRY_MAX_LEVELS = 3
+
+
+def make_ancestry(selector, precursor_ancestries):
+    """
+    Returns the ancestry summary of a descriptor, computed from the summaries
+    of its precursors (None for precursors that are not stored).
+
+    A summary is a (depth, levels) couple. depth is the length of the longest
+    precursor chain starting from the descriptor. levels maps selector
+    prefixes (selectors without hash) of the descriptor and its ancestors to
+    a sorted tuple of distances at which they appear: 0 for the descriptor
+    itself, 1 for its precursors, etc. At most ANCESTRY_MAX_LEVELS distances
+    are kept per prefix.
+    """
+    depth = 0
+    levels = defaultdict(set)
+    levels[selector.split('%')[0]].add(0)
+    for ancestry in precursor_ancestries:
+        if ancestry is None:
+            continue
+        depth = max(depth, ancestry[0] + 1)
+        for prefix, plevels in ancestry[1].iteritems():
+            dest = levels[prefix]
+            for level in plevels:
+                if len(dest) >= ANCESTRY_MAX_LEVELS:
+                    break
+                dest.add(level + 1)
+    return depth, dict((prefix, tuple(sorted(dest)[:ANCESTRY_MAX_LEVELS]))
+                       for prefix, dest in levels.iteritems())
+
+
+def resolve_ancestry(selector, cached, list_precursors, save=None):
+    """
+    Returns the ancestry summary of selector (see make_ancestry), computing
+    summaries of its ancestors that are not cached yet. Returns None if
+    selector is not stored.
+
+    :param cached: function returning the cached summary of a selector, or
+        None
+    :param list_precursors: function returning the precursors of a stored
+        selector, None if it is not stored
+    :param save: function called with (selector, summary) for each computed
+        summary
+    """
+    computed = {}
+    # selectors whose precursors are being resolved, guards against cycles
+    pending = set()
+    # (selector, None) entries are to be resolved, (selector, precursors)
+    # entries are computed once their precursors have been resolved
+    stack = [(selector, None)]
+    while stack:
+        current, precursors = stack.pop()
+        if precursors is not None:
+            pending.discard(current)
+            summary = make_ancestry(current,
+                                    [computed.get(p) for p in precursors])
+            computed[current] = summary
+            if save is not None:
+                save(current, summary)
+            continue
+        if current in computed or current in pending:
+            continue
+        summary = cached(current)
+        if summary is not None:
+            computed[current] = summary
+            continue
+        precursors = list_precursors(current)
+        if precursors is None:
+            computed[current] = None
+            continue
+        pending.add(current)
+        stack.append((current, precursors))
+        stack.extend((p, None) for p in precursors
+                     if p not in computed and p not in pending)
+    return computed[selector]
+
+
+def _prefix_range(prefix):
+    """
+    Returns an SQL condition and its parameters, matching selectors that
+    start with prefix using a range scan on the (domain, selector) index.
+    """
+    if not prefix:
+        return '1', ()
+    if prefix[-1] == '\xff':
+        return 'substr(selector, 1, ?)=?', (len(prefix), prefix)
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return 'selector >= ? AND selector < ?', (prefix, upper)
+
+
+def regex_literal_prefix(regex):
+    """
+    Returns a string, possibly empty, which is a prefix of every string
+    matched by re.match(regex).
+    """
+    if '|' in regex:
+        # alternatives may not share a prefix
+        return ''
+    if '(?' in regex:
+        # inline flags, such as (?i), apply to the whole regex wherever they
+        # appear
+        return ''
+    prefix = []
+    for c in regex:
+        if c in '*?{':
+            # previous character is optional
+            if prefix:
+                prefix.pop()
+            break
+        if c in '.^$+}[]\\()':
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+
+class RetentionRule(object):
+    """
+    Retention rule, enforced by storage garbage collectors, which applies to
+    descriptors of a domain ('*' for any domain) whose selector starts with
+    prefix. A descriptor expires when it has been stored more than max_age
+    seconds ago, when more recent descriptors matching the rule amount to
+    max_count descriptors or to max_bytes of values, or when keep_versions
+    more recent versions of it exist. Limits apply to each domain
+    separately; None means no limit.
+    """
+    #: duration suffixes, in seconds
+    DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+    #: size suffixes, in bytes
+    SIZES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    #: option name -> (attribute, unit suffixes)
+    LIMITS = {
+        'max-age': ('max_age', DURATIONS),
+        'max-bytes': ('max_bytes', SIZES),
+        'max-count': ('max_count', {}),
+        'keep-versions': ('keep_versions', {}),
+    }
+
+    def __init__(self, domain, prefix, max_age=None, max_bytes=None,
+                 max_count=None, keep_versions=None):
+        self.domain = domain
+        self.prefix = prefix
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.keep_versions = keep_versions
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parses a rule of the form DOMAIN:PREFIX:LIMIT=VALUE[,LIMIT=VALUE...],
+        e.g. default:/binary/:max-age=7d,keep-versions=2. Durations may be
+        suffixed by s, m, h, d or w; sizes by k, m, g or t.
+        Raises ValueError if text is not a valid rule.
+        """
+        try:
+            domain, prefix, limits = text.split(':')
+        except ValueError:
+            raise ValueError("retention rule %r is not of the form "
+                             "DOMAIN:PREFIX:LIMIT=VALUE,..." % text)
+        if domain != '*' and not format_check.is_valid_domain(domain):
+            raise ValueError("invalid domain in retention rule %r" % text)
+        if not prefix.startswith('/'):
+            raise ValueError("invalid prefix in retention rule %r" % text)
+        rule = cls(domain, prefix)
+        for limit in limits.split(','):
+            name, _, value = limit.partition('=')
+            if name not in cls.LIMITS or not value:
+                raise ValueError("invalid limit %r in retention rule %r" %
+                                 (limit, text))
+            attr, units = cls.LIMITS[name]
+            multiplier = units.get(value[-1].lower())
+            if multiplier is not None:
+                value = value[:-1]
+            try:
+                value = int(value) * (multiplier or 1)
+            except ValueError:
+                raise ValueError("invalid limit %r in retention rule %r" %
+                                 (limit, text))
+            setattr(rule, attr, value)
+        return rule
+
+    def __str__(self):
+        limits = ','.join('%s=%d' % (name, getattr(self, attr))
+                          for name, (attr, _) in sorted(self.LIMITS.items())
+                          if getattr(self, attr) is not None)
+        return '%s:%s:%s' % (self.domain, self.prefix, limits)
+
+    def applies_to(self, domain):
+        return self.domain in ('*', domain)
+
+    def expired(self, records, now):
+        """
+        Generates selectors of descriptors that expire according to this
+        rule.
 
-    def find_by_selector(self, domain, selector_prefix, limit, offset):
-        with self._dblock:
-            selector_prefix.replace('%', '_')  # matches 1 character
-            selector_prefix += '%'
-            res = self._cursor.execute(
-                'SELECT selector FROM processed '
-                'WHERE selector LIKE ? AND DOMAIN=? '
-                'ORDER BY _rowid_ DESC '
-                'LIMIT ? OFFSET ?',
-                (domain, selector_prefix, limit, offset)
-            ).fetchall()
-        return [str(selector) for selector in res]
+        :param records: iterable of (selector, uuid, version, time at which
+            the descriptor has been stored, value size), for descriptors of
+            one domain that start with self.prefix, from newest to oldest
+        :param now: current time
+        """
+        count = 0
+        size = 0
+        #: (uuid, selector prefix) -> number of more recent versions
+        versions = defaultdict(int)
+        for selector, uuid, version, added, value_size in records:
+            if self.max_age is not None and added < now - self.max_age:
+                yield selector
+                continue
+            if self.keep_versions is not None:
+                key = (uuid, selector.split('%')[0])
+                versions[key] += 1
+                if versions[key] > self.keep_versions:
+                    yield selector
+                    continue
+            # only descriptors that are kept count towards limits
+            count += 1
+            size += value_size
+            if (self.max_count is not None and count > self.max_count) or \
+                    (self.max_bytes is not None and size > self.max_bytes):
+                yield selector
+
+
+def _retention_rule_arg(text):
+    try:
+        return RetentionRule.parse(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def add_gc_arguments(subparser):
+    """
+    Adds garbage collection options, shared by storage backends.
+    """
+    subparser.add_argument(
+        "--retention", type=_retention_rule_arg, nargs='*', default=[],
+        metavar='RULE',
+        help="Retention rules, of the form DOMAIN:PREFIX:LIMIT=VALUE,... "
+        "where DOMAIN may be '*' and LIMIT is max-age (s, m, h, d, w "
+        "suffixes), max-bytes (k, m, g, t suffixes), max-count or "
+        "keep-versions. Example: default:/binary/:max-age=30d,keep-versions=2")
+    subparser.add_argument(
+        "--gc-interval", type=int, default=3600,
+        help="Delay between garbage collections enforcing retention rules, "
+        "in seconds (defaults to 3600)")
+    subparser.add_argument(
+        "--gc-rate", type=int, default=1000,
+        help="Maximum number of descriptors deleted per second by the "
+        "garbage collector, 0 for no limit (defaults to 1000)")
+
+
+class BlobStore(object):
+    """
+    Content-addressed storage for serialized descriptor values. Each value is
+    stored once, in a file named after the SHA-256 digest of its contents,
+    under path/ab/abcdef...; this digest is used as a reference to the value.
+    Extensions may be appended to references, to indicate how the value has
+    been encoded, and which compression codec has been applied to it.
+    Reference counts are maintained by MetadataDB.
+    """
+    #: Compression codecs: name -> (compress(data, level), decompress(data))
+    CODECS = {
+        'zlib': (zlib.compress, zlib.decompress),
+        'bz2': (bz2.compress, bz2.decompress),
+    }
+
+    def __init__(self, path):
+        self.path = path
+        #: Set of blob storage directories that are known to exist
+        self.existing_paths = set()
+
+    def get_path(self, ref):
+        return os.path.join(self.path, ref[:2], ref)
+
+    @classmethod
+    def _codec(cls, ref):
+        """
+        Returns the name of the compression codec used for ref, None if it is
+        not compressed.
+        """
+        ext = ref.rsplit('.', 1)[-1]
+        if ext in cls.CODECS:
+            return ext
+        return None
+
+    def put(self, data, ext=None, codec=None, level=6):
+        """
+        Stores data if it is not already present. Returns (reference, size on
+        disk); size is None if data was already present.
+
+        :param ext: encoding of data, appended to the reference
+        :param codec: name of the compression codec to be used, if any. data
+            is stored uncompressed if compression does not reduce its size.
+        :param level: compression level
+        """
+        ref = hashlib.sha256(data).hexdigest()
+        if ext:
+            ref += '.' + ext
+        candidates = [ref]
+        if codec:
+            candidates.insert(0, ref + '.' + codec)
+        for candidate in candidates:
+            # identical data has already been stored, maybe compressed using
+            # different settings
+            if os.path.isfile(self.get_path(candidate)):
+                return candidate, None
+        if codec:
+            compressed = self.CODECS[codec][0](data, level)
+            if len(compressed) < len(data):
+                ref += '.' + codec
+                data = compressed
+        fname = self.get_path(ref)
+        dirname = os.path.dirname(fname)
+        if dirname not in self.existing_paths:
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.args[0] != 17:  # File exists
+                    raise
+            self.existing_paths.add(dirname)
+        # write then rename, so that a blob file is never seen partially
+        # written
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmpname, fname)
+        return ref, len(data)
+
+    def spool(self, chunks):
+        """
+        Writes data, given as an iterable of chunks, to a temporary file,
+        without keeping it in memory. Returns (temporary file name, SHA-256
+        digest, size), to be passed to put_spooled.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmpname = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    fp.write(chunk)
+                    size += len(chunk)
+        except:
+            os.remove(tmpname)
+            raise
+        return tmpname, digest.hexdigest(), size
+
+    def put_spooled(self, tmpname, digest, ext=None):
+        """
+        Stores data that has been written to tmpname by spool, uncompressed,
+        if it is not already present. Returns (reference, size on disk) like
+        put.
+        """
+        ref = digest
+        if ext:
+            ref += '.' + ext
+        for candidate in [ref] + [ref + '.' + codec for codec in self.CODECS]:
+            if os.path.isfile(self.get_path(candidate)):
+                os.remove(tmpname)
+                return candidate, None
+        fname = self.get_path(ref)
+        dirname = os.path.dirname(fname)
+        if dirname not in self.existing_paths:
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.args[0] != 17:  # File exists
+                    raise
+            self.existing_paths.add(dirname)
+        size = os.path.getsize(tmpname)
+        os.rename(tmpname, fname)
+        return ref, size
+
+    def get(self, ref):
+        """
+        Returns stored data, decompressed, None if ref is unknown.
+        """
+        try:
+            with open(self.get_path(ref), 'rb') as fp:
+                data = fp.read()
+        except IOError:
+            log.warning("Missing value blob %s", ref)
+            return None
+        codec = self._codec(ref)
+        if codec:
+            data = self.CODECS[codec][1](data)
+        return data
+
+    def is_mappable(self, ref):
+        """
+        Returns True if the blob file contains the data itself, uncompressed.
+        """
+        return self._codec(ref) is None
+
+    def size(self, ref):
+        """
+        Returns the size of stored data, None if ref is unknown.
+        """
+        try:
+            return os.path.getsize(self.get_path(ref))
+        except OSError:
+            return None
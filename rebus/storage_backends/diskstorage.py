@@ -1,15 +1,72 @@
+import itertools
 import logging
+import multiprocessing
 import os
+import Queue
 import re
+import threading
+import time
 from collections import defaultdict
 from collections import OrderedDict
 from collections import Counter
-from rebus.storage import Storage, MetadataDB
+from rebus.storage import Storage, MetadataDB, BlobStore, add_gc_arguments
+from rebus.storage import append_state_delta, read_state_deltas, \
+    write_state_file
 from rebus.tools import format_check
+from rebus.tools.lrucache import LRUCache
+from rebus.tools.trigram import trigrams, regex_trigrams
+from rebus.tools.valuefile import map_value_file, read_value_file
 from rebus.descriptor import Descriptor
 from rebus.tools.serializer import picklev2 as store_serializer
 log = logging.getLogger("rebus.storage.diskstorage")
 
+#: Maximum number of hash-prefix subdirectory levels
+MAX_SHARD_LEVELS = 4
+
+
+def selector_path(basepath, domain, selector, shard_levels):
+    """
+    Returns the full path of a descriptor's files, without extension:
+    basepath/domain/sel/ector/%hash if shard_levels is 0,
+    basepath/domain/sel/ector/ha/sh/%hash if shard_levels is 2.
+    """
+    prefix, hashval = selector.rsplit('%', 1)
+    parts = [basepath, domain] + [p for p in prefix.split('/') if p]
+    parts += [hashval[2*i:2*i+2] for i in xrange(shard_levels)]
+    return os.path.join(*parts) + '/%' + hashval
+
+
+def _match_blob(task):
+    """
+    Returns True if the value stored in a BlobStore blob is a str matching a
+    regex. Runs in search pool processes.
+
+    :param task: (BlobStore path, value reference, value regex)
+    """
+    blobs_path, value_ref, value_regex = task
+    blobs = BlobStore(blobs_path)
+    if value_ref.endswith('.' + DiskStorage.RAW_EXT):
+        # match without reading the whole value
+        contents = map_value_file(blobs.get_path(value_ref))
+        if contents is None:
+            return re.match(value_regex, '') is not None
+        try:
+            return re.match(value_regex, contents) is not None
+        finally:
+            contents.close()
+    data = blobs.get(value_ref)
+    if data is None:
+        return False
+    if DiskStorage.RAW_EXT not in value_ref.split('.')[1:]:
+        # serialized value, stored by a previous version
+        try:
+            data = Descriptor.unserialize_value(store_serializer, data)
+        except Exception:
+            return False
+        if not isinstance(data, str):
+            return False
+    return re.match(value_regex, data) is not None
+
 
 @Storage.register
 class DiskStorage(Storage):
@@ -20,6 +77,28 @@ class DiskStorage(Storage):
     _name_ = "diskstorage"
     STORES_INTSTATE = True
 
+    #: Version of the on-disk layout. Storage directories having a different
+    #: version are walked and migrated when they are opened.
+    #: 1: descriptor value in /domain/sel/ector/%hash.value
+    #: 2: values are deduplicated in /_values/; /domain/sel/ector/%hash.ref
+    #: contains the reference to the value
+    LAYOUT_VERSION = 2
+
+    #: Extension of value blobs containing raw str values, which are not
+    #: serialized. Other blobs contain serialized values.
+    RAW_EXT = 'raw'
+
+    #: Values of descriptors having these selector prefixes are never
+    #: compressed, since they usually already are
+    NEVER_COMPRESS = ('/compressed/', '/archive/')
+
+    #: Number of find_by_value candidates verified at once
+    SEARCH_BATCH = 256
+
+    #: Delay between two lookups of blobs to be indexed by trigrams, in
+    #: seconds, when the index is up to date
+    TRIGRAM_INDEX_INTERVAL = 1
+
     def __init__(self, options):
         self.basepath = options.path.rstrip('/')
 
@@ -28,101 +107,268 @@ class DiskStorage(Storage):
         if not os.path.isdir(self.basepath + '/agent_intstate'):
             os.makedirs(self.basepath + '/agent_intstate')
 
-        #: Set of existing descriptor storage directories, all starting and
-        #: ending with '/'
+        #: Set of descriptor storage directories that are known to exist, all
+        #: starting and ending with '/'. Filled lazily.
         self.existing_paths = set((self.basepath + '/',))
 
-        #: self.version_cache['domain']['/selector/'][version] = /selector/%123
-        #: where 1234 is the hash of this selector's version 42
-        #: Mostly useful for descriptors that have several versions
-        self.version_cache = defaultdict(lambda: defaultdict(dict))
-
-        #: self.edges['domain']['selectorA'] is a set of selectors of
-        #: descriptors that were spawned from selectorA.
-        self.edges = defaultdict(lambda: defaultdict(set))
-
         #: self.processable['domain']['/selector/%hash'] is a set of (agent
         #: name, configuration text) that are running in interactive mode, and
         #: are able to process this descriptor.
         #: This attribute is not saved to disk.
         self.processable = defaultdict(lambda: defaultdict(set))
 
-        #: self.uuids['domain']['uuid'] is the set of selectors that belong to
-        #: descriptors having this uuid
-        self.uuids = defaultdict(lambda: defaultdict(set))
-
-        #: self.labels['domain']['uuid'] is the label of descriptors having
-        #: this UUID
-        self.labels = defaultdict(lambda: defaultdict(str))
-
         # A sqlite3 database records which (agent name, configuration text)
         # have finished processing each (domain, /selector/%hash). This allows
         # stopping and resuming the bus when some of the descriptors have not
         # been processed by all agents.
+        # It also indexes descriptor metadata (versions, edges, uuids, labels),
+        # so that existing descriptors do not have to be read when the storage
+        # is opened.
+        # Writes to this database are grouped, and committed at most
+        # commit_interval milliseconds later.
         # TODO maybe also store processable?
         self.db = MetadataDB(
-            os.path.join(self.basepath, 'diskstorage.sqlite3'))
+            os.path.join(self.basepath, 'diskstorage.sqlite3'),
+            options.commit_interval / 1000., options.commit_rows)
+
+        #: Deduplicated descriptor values. Directory names starting with '_'
+        #: cannot clash with domain names.
+        self.blobs = BlobStore(os.path.join(self.basepath, '_values'))
+
+        #: Value compression settings
+        self.compression = options.compression
+        if self.compression == 'none':
+            self.compression = None
+        self.compression_level = options.compression_level
+        self.compression_min_size = options.compression_min_size
+        self.compress_include = tuple(options.compress_include)
+        self.compress_exclude = tuple(options.compress_exclude) + \
+            self.NEVER_COMPRESS
+
+        #: Recently used descriptors (metadata only) and values. Keys are
+        #: ('meta' or 'value', domain, /sel/ector/%hash). Descriptors are
+        #: immutable, so entries never have to be invalidated.
+        self.cache = LRUCache(options.cache_bytes, options.cache_entries)
+
+        #: Raw values up to this size are added to the value trigram index,
+        #: which is used by find_by_value. Values are indexed by a background
+        #: thread, rather than by add(); 0 disables indexing.
+        self.trigram_max_size = options.trigram_max_size
+        #: Number of processes used to verify find_by_value candidates. The
+        #: process pool is created on first use.
+        self.search_processes = options.search_processes
+        self.search_pool = None
+
+        if self.db.get_info('layout_version') != str(self.LAYOUT_VERSION):
+            # Storage created by a previous version, or index creation has
+            # been interrupted: enumerate existing files & dirs, migrate
+            # values to the blob store
+            log.info("Building descriptor index from %s", self.basepath)
+            self._discover('/')
+            self.db.set_info('layout_version', self.LAYOUT_VERSION)
+            log.info("Descriptor index has been built")
+            unclean_shutdown = False
+        else:
+            unclean_shutdown = self.db.get_info('clean_shutdown') == '0'
+        self.db.set_info('clean_shutdown', 0)
+
+        #: Number of hash-prefix subdirectory levels used for descriptor
+        #: files, which limits the number of entries in each directory.
+        #: Descriptor files are only read when the index is rebuilt, so files
+        #: using a different number of levels may coexist.
+        self.shard_levels = int(self.db.get_info('shard_levels', 0))
+        if options.shard_levels is not None and \
+                options.shard_levels != self.shard_levels:
+            if next(self.db.iter_descriptors(1), None) is not None:
+                log.warning("Descriptor files will be stored using %d levels "
+                            "of subdirectories instead of %d. Run "
+                            "'rebus_storage reshard' to move existing files.",
+                            options.shard_levels, self.shard_levels)
+            self.shard_levels = options.shard_levels
+            self.db.set_info('shard_levels', self.shard_levels)
+
+        if unclean_shutdown:
+            self._recover_writes()
 
-        # Enumerate existing files & dirs
-        self._discover('/')
+        #: Write-behind: descriptors are indexed by add(), their files are
+        #: written by background threads. Values of descriptors whose files
+        #: are being written are kept in self.pending_values[(domain,
+        #: selector)].
+        self.write_queue = Queue.Queue()
+        self.pending_values = {}
+        #: Total size of pending values. add() blocks while it exceeds
+        #: max_pending_bytes.
+        self.pending_bytes = 0
+        self.max_pending_bytes = options.write_queue_bytes
+        self.pending_cond = threading.Condition()
+        for _ in xrange(options.write_threads):
+            t = threading.Thread(target=self._writer_loop)
+            t.daemon = True
+            t.start()
+        self.write_behind = options.write_threads > 0
 
-    def _discover(self, relpath):
+        if options.verify_index or unclean_shutdown:
+            # Descriptors that have been written during the last
+            # commit_interval before a crash may be missing from the index
+            t = threading.Thread(target=self._verify_index)
+            t.daemon = True
+            t.start()
+
+        #: Garbage collection: descriptors that expire according to retention
+        #: rules are deleted by a background thread every gc_interval
+        #: seconds
+        self.retention = options.retention
+        self.gc_interval = options.gc_interval
+        self.gc_rate = options.gc_rate
+        #: counters of deleted descriptors, blobs and reclaimed bytes
+        self.gc_stats = Counter()
+        #: Protects blobs from being reclaimed between the moment they are
+        #: stored (or found to be already stored) and the moment the
+        #: descriptor referencing them is indexed. pinned_refs counts
+        #: descriptors being stored, for each value reference.
+        self.gc_lock = threading.Lock()
+        self.pinned_refs = Counter()
+        if self.retention and self.gc_interval > 0:
+            t = threading.Thread(target=self._gc_loop)
+            t.daemon = True
+            t.start()
+        if self.trigram_max_size > 0:
+            t = threading.Thread(target=self._index_loop)
+            t.daemon = True
+            t.start()
+
+    def _recover_writes(self):
+        """
+        Called after a crash. Fixes descriptors that have been indexed, but
+        whose files were being written by a background thread: their value
+        reference is restored if their files are complete, else they are
+        removed from the index.
+        """
+        for domain, selector in self.db.list_unstored():
+            for levels in xrange(MAX_SHARD_LEVELS + 1):
+                basename = selector_path(self.basepath, domain, selector,
+                                         levels)
+                if os.path.isfile(basename + '.meta') and \
+                        os.path.isfile(basename + '.ref'):
+                    with open(basename + '.ref', 'rb') as fp:
+                        value_ref = fp.read().strip()
+                    if self.blobs.size(value_ref) is not None:
+                        self.db.set_value_ref(domain, selector, value_ref)
+                        break
+            else:
+                log.warning("Descriptor %s:%s has been lost before being "
+                            "written to disk", domain, selector)
+                self.db.remove_descriptor(domain, selector)
+        self.db.flush()
+
+    def _verify_index(self):
+        """
+        Runs in a background thread. Adds descriptors whose metadata files are
+        present, but are missing from the index.
+        """
+        log.info("Verifying descriptor index")
+        try:
+            added = self._discover('/', concurrent=True)
+        except Exception:
+            log.error("Descriptor index verification failed", exc_info=1)
+            return
+        log.info("Descriptor index verified, %d missing descriptors have been "
+                 "added", added)
+
+    def _discover(self, relpath, concurrent=False):
         """
         Recursively add existing files to storage.
+        Returns the number of descriptors that were missing from the index.
 
         :param relpath: starts and ends with a '/', relative to self.basepath
+        :param concurrent: True if descriptors may be added or deleted while
+            files are enumerated. Files of such descriptors may be incomplete;
+            they are skipped.
         """
-        if relpath == '/agent_intstate/':
-            # Ignore internal state of agents
-            return
+        if relpath in ('/agent_intstate/', '/_values/'):
+            # Ignore internal state of agents, value blobs
+            return 0
 
         path = self.basepath + relpath
         self.existing_paths.add(path)
+        added = 0
 
         for elem in os.listdir(path):
             name = path + elem
             relname = relpath + elem
             if os.path.isdir(name):
-                self._discover(relname + '/')
+                added += self._discover(relname + '/', concurrent)
             elif os.path.isfile(name):
                 basename = name.rsplit('.', 1)[0]
-                if name.endswith('.value'):
-                    # Serialized descriptor value
-                    if not os.path.isfile(basename + '.meta'):
-                        raise Exception(
-                            'Missing associated metadata for %s' % relname)
+                if name.endswith('.value') or name.endswith('.ref'):
+                    # Serialized descriptor value (layout 1), or reference
+                    # to the value. Metadata is written after, and removed
+                    # before this file.
+                    if not os.path.isfile(basename + '.meta') and \
+                            not concurrent:
+                        log.warning("Skipping %s, which has no associated "
+                                    "metadata", relname)
                 elif name.endswith('.meta'):
                     # Serialized descriptor metadata
-                    if not os.path.isfile(basename + '.value'):
+                    value_ref = self._migrate_value(basename)
+                    if value_ref is None:
+                        log.warning("Skipping %s, which has no associated "
+                                    "value", relname)
+                        continue
+                    try:
+                        with open(name, 'rb') as fp:
+                            meta = fp.read()
+                    except IOError:
+                        if concurrent:
+                            # deleted by the garbage collector
+                            continue
+                        raise
+                    try:
+                        desc = Descriptor.unserialize(store_serializer, meta)
+                    except:
+                        if concurrent:
+                            # being written
+                            continue
+                        log.error(
+                            "Could not unserialize metadata from file %s",
+                            name)
+                        raise
+                    fname_selector = relname.rsplit('.')[0]
+                    # check consistency between file name and serialized
+                    # metadata
+                    fname_domain = fname_selector.split('/')[1]
+                    if fname_domain != desc.domain:
                         raise Exception(
-                            'Missing associated value for %s' % relname)
-                    with open(name, 'rb') as fp:
-                        try:
-                            desc = Descriptor.unserialize(store_serializer,
-                                                          fp.read())
-                        except:
-                            log.error(
-                                "Could not unserialize metadata from file %s",
-                                name)
-                            raise
-                        fname_selector = relname.rsplit('.')[0]
-                        # check consistency between file name and serialized
-                        # metadata
-                        fname_domain = fname_selector.split('/')[1]
-                        if fname_domain != desc.domain:
-                            raise Exception(
-                                'Filename domain %s does not match metadata '
-                                'domain %s for descriptor %s' %
-                                (fname_domain, desc.domain, fname_selector))
-                        fname_hash = fname_selector.rsplit('%', 1)[1]
-                        if fname_hash != desc.hash:
-                            raise Exception(
-                                'Filename hash %s does not match metadata hash'
-                                ' %s for descriptor %s' %
-                                (fname_hash, desc.domain, fname_selector))
-
-                        self._register_meta(desc)
-                elif relpath == '/' and elem == 'diskstorage.sqlite3':
+                            'Filename domain %s does not match metadata '
+                            'domain %s for descriptor %s' %
+                            (fname_domain, desc.domain, fname_selector))
+                    fname_hash = fname_selector.rsplit('%', 1)[1]
+                    if fname_hash != desc.hash:
+                        raise Exception(
+                            'Filename hash %s does not match metadata hash'
+                            ' %s for descriptor %s' %
+                            (fname_hash, desc.domain, fname_selector))
+
+                    if concurrent and (desc.domain, desc.selector) in \
+                            self.pending_values:
+                        # files may not have been synced yet, the
+                        # writer thread sets the value reference
+                        continue
+                    if self.db.add_descriptor(desc, meta, value_ref):
+                        if concurrent and not os.path.isfile(name):
+                            # deleted by the garbage collector meanwhile
+                            self.db.delete_descriptor(desc.domain,
+                                                      desc.selector)
+                        else:
+                            added += 1
+                    else:
+                        self.db.set_value_ref(desc.domain, desc.selector,
+                                              value_ref)
+                elif name.endswith('.ref.tmp'):
+                    # interrupted write, unless a writer is running
+                    if not concurrent:
+                        os.remove(name)
+                elif relpath == '/' and elem.startswith('diskstorage.sqlite3'):
                     continue
                 elif relpath == '/' and elem == '_processed.cfg':
                     # Former _processed.cfg storage file
@@ -140,75 +386,141 @@ class DiskStorage(Storage):
                 else:
                     raise Exception(
                         'Invalid file name - %s has an invalid extension '
-                        '(must be .value, .meta or .cfg)' % relname)
+                        '(must be .ref, .value, .meta or .cfg)' % relname)
+            elif not os.path.lexists(name):
+                # .value file that has just been migrated
+                continue
             else:
                 raise Exception(
                     'Invalid file type - %s is neither a regular file nor a '
                     'directory' % name)
+        return added
 
-    def _register_meta(self, desc):
+    def _migrate_value(self, basename):
         """
-        :param desc: Descriptor instance
+        Moves the value stored in basename.value (layout 1) to the blob store,
+        if present. Returns the reference of the value, None if it is missing.
+
+        :param basename: full path of the descriptor's files, without extension
         """
+        value_ref = None
+        if os.path.isfile(basename + '.ref'):
+            with open(basename + '.ref', 'rb') as fp:
+                value_ref = fp.read().strip()
+            size = self.blobs.size(value_ref)
+            # size before compression is unknown
+            self.db.add_blob(value_ref, size, size if
+                             self.blobs.is_mappable(value_ref) else None)
+        if os.path.isfile(basename + '.value'):
+            if value_ref is None:
+                with open(basename + '.value', 'rb') as fp:
+                    data = fp.read()
+                value_ref, size = self.blobs.put(data)
+                if size is not None:
+                    self.db.add_blob(value_ref, size, len(data))
+                self._write_ref(basename, value_ref)
+            # else interrupted migration: value has already been moved
+            os.remove(basename + '.value')
+        return value_ref
 
-        domain = desc.domain
-        selector = desc.selector
-        self.db.add_selector(domain, selector)
-        self.version_cache[domain][selector.split('%')[0]][desc.version]\
-            = selector
-        for precursor in desc.precursors:
-            self.edges[domain][precursor].add(selector)
-        self.uuids[domain][desc.uuid].add(selector)
-        if not self.labels[domain][desc.uuid] or not desc.precursors:
-            # Heuristic for choosing uuid label : prefer label of a descriptor
-            # that has no precursor
-            self.labels[domain][desc.uuid] = desc.label
+    def _write_ref(self, basename, value_ref):
+        with open(basename + '.ref.tmp', 'wb') as fp:
+            fp.write(value_ref)
+        os.rename(basename + '.ref.tmp', basename + '.ref')
+
+    def _descriptors_from_metas(self, metas):
+        return [Descriptor.unserialize(store_serializer, meta, trusted=True)
+                for meta in metas]
 
     def find(self, domain, selector_regex, limit=0, offset=0):
         return self.db.find(domain, selector_regex, limit, offset)
 
     def find_by_selector(self, domain, selector_prefix, limit=0, offset=0):
-        return self.db.find_by_selector(domain, selector_prefix, limit, offset)
+        return self._descriptors_from_metas(
+            self.db.find_by_selector(domain, selector_prefix, limit, offset))
 
     def find_by_uuid(self, domain, uuid):
-        result = []
-        for selector in self.uuids[domain][uuid]:
-            desc = self.get_descriptor(domain, selector)
-            if desc is None:
-                # that would be a bug
-                log.warning(
-                    "Descriptor %s:%s could not be retrieved in "
-                    "find_by_uuid (%s)", domain, selector, uuid)
+        return self._descriptors_from_metas(
+            self.db.list_metas_by_uuid(domain, uuid))
+
+    def find_by_value(self, domain, selector_prefix, value_regex, limit=0,
+                      offset=0):
+        matches = self.iter_find_by_value(domain, selector_prefix,
+                                          value_regex)
+        return list(itertools.islice(matches, offset,
+                                     offset + limit if limit else None))
+
+    def iter_find_by_value(self, domain, selector_prefix, value_regex):
+        """
+        Generates descriptors matching find_by_value criteria, from oldest to
+        newest.
+
+        Candidates are selected using the value trigram index, then verified
+        in batches, using the search process pool if one is configured. Each
+        value is verified once, even if several descriptors share it.
+        """
+        candidates = self.db.iter_value_candidates(
+            domain, selector_prefix, regex_trigrams(value_regex))
+        #: value_ref -> True if value matches
+        verified = {}
+        while True:
+            batch = list(itertools.islice(candidates, self.SEARCH_BATCH))
+            if not batch:
+                return
+            tasks = set((self.blobs.path, value_ref, value_regex)
+                        for _, value_ref in batch
+                        if value_ref is not None and value_ref not in verified)
+            tasks = list(tasks)
+            if self.search_processes > 0 and len(tasks) > 1:
+                if self.search_pool is None:
+                    self.search_pool = multiprocessing.Pool(
+                        self.search_processes)
+                results = self.search_pool.map(_match_blob, tasks)
             else:
-                result.append(desc)
-        return result
+                results = map(_match_blob, tasks)
+            for task, result in zip(tasks, results):
+                verified[task[1]] = result
+            for selector, value_ref in batch:
+                if value_ref is None:
+                    # value is being written by a background thread
+                    if not self._match_pending(domain, selector, value_regex):
+                        continue
+                elif not verified[value_ref]:
+                    continue
+                desc = self.get_descriptor(domain, selector)
+                if desc:
+                    yield desc
 
-    def find_by_value(self, domain, selector_prefix, value_regex):
-        result = []
-        # File paths to explore
-        pathprefix = self.basepath + '/' + domain + selector_prefix
-        paths = [path for path in self.existing_paths if
-                 path.startswith(pathprefix)]
-        for path in paths:
-            # open and run re.match() on every file matching *.value
-            for name in os.listdir(path):
-                if os.path.isfile(path + name) and name.endswith('.value'):
-                    contents = Descriptor.unserialize_value(
-                        store_serializer,
-                        open(path + name, 'rb').read())
-                    if re.match(value_regex, contents):
-                        selector = path[len(self.basepath)+len(domain)+1:] +\
-                            name.split('.')[0]
-                        desc = self.get_descriptor(domain, selector)
-                        if desc:
-                            result.append(desc)
-        return result
+    def _match_pending(self, domain, selector, value_regex):
+        with self.pending_cond:
+            value = self.pending_values.get((domain, selector))
+        if value is None:
+            value_ref = self.db.get_value_ref(domain, selector)
+            if value_ref is None:
+                return False
+            return _match_blob((self.blobs.path, value_ref, value_regex))
+        return isinstance(value, str) and \
+            re.match(value_regex, value) is not None
+
+    def _get_value_ref(self, domain, selector):
+        """
+        Returns the value reference of this descriptor, None if it is unknown,
+        or self.pending_values if its value is still being written.
+        """
+        value_ref = self.db.get_value_ref(domain, selector)
+        if value_ref is not None:
+            return value_ref
+        with self.pending_cond:
+            if (domain, selector) in self.pending_values:
+                return self.pending_values
+        # files may have been written in the meantime
+        return self.db.get_value_ref(domain, selector)
+
+    def _is_raw(self, value_ref):
+        return self.RAW_EXT in value_ref.split('.')[1:]
 
     def list_uuids(self, domain):
-        result = dict()
-        for uuid in self.uuids[domain].keys():
-            result[uuid] = self.labels[domain][uuid]
-        return result
+        return self.db.list_uuids(domain)
 
     def _version_lookup(self, domain, selector):
         """
@@ -222,14 +534,10 @@ class DiskStorage(Storage):
             selprefix, version = selector.split('~')
             try:
                 intversion = int(version)
-                if intversion < 0:
-                    maxversion = max(self.version_cache[domain][selprefix])
-                    intversion = maxversion + intversion + 1
-                selector = self.version_cache[domain][selprefix][intversion]
-            except (KeyError, ValueError):
-                # ValueError: invalid version integer
-                # KeyError: unknown version
-                selector = None
+            except ValueError:
+                # invalid version integer
+                return None
+            selector = self.db.version_lookup(domain, selprefix, intversion)
         return selector
 
     def get_descriptor(self, domain, selector):
@@ -240,11 +548,15 @@ class DiskStorage(Storage):
         if not selector:
             return None
 
-        fullpath = self._pathFromSelector(domain, selector) + ".meta"
-        if not fullpath or not os.path.isfile(fullpath):
+        desc = self.cache.get(('meta', domain, selector))
+        if desc is not None:
+            return desc
+        meta = self.db.get_meta(domain, selector)
+        if meta is None:
             return None
-        return Descriptor.unserialize(store_serializer,
-                                      open(fullpath, "rb").read())
+        desc = Descriptor.unserialize(store_serializer, meta, trusted=True)
+        self.cache.put(('meta', domain, selector), desc, len(meta))
+        return desc
 
     def get_value(self, domain, selector):
         """
@@ -254,30 +566,54 @@ class DiskStorage(Storage):
         if not selector:
             return None
 
-        fullpath = self._pathFromSelector(domain, selector) + ".value"
-        if not fullpath or not os.path.isfile(fullpath):
+        key = ('value', domain, selector)
+        # None is a valid value: use a different default
+        value = self.cache.get(key, self.cache)
+        if value is not self.cache:
+            return value
+        value_ref = self._get_value_ref(domain, selector)
+        if value_ref is None:
             return None
+        if value_ref is self.pending_values:
+            with self.pending_cond:
+                return self.pending_values.get((domain, selector))
+        if value_ref.endswith('.' + self.RAW_EXT):
+            value = read_value_file(self.blobs.get_path(value_ref))
+            if value is not None:
+                self.cache.put(key, value, len(value))
+            return value
+        data = self.blobs.get(value_ref)
+        if data is None:
+            return None
+        if self._is_raw(value_ref):
+            # compressed raw value
+            self.cache.put(key, data, len(data))
+            return data
         try:
-            value = Descriptor.unserialize_value(store_serializer,
-                                                 open(fullpath, "rb").read())
+            value = Descriptor.unserialize_value(store_serializer, data)
         except:
-            log.warning("Could not unserialize value from file %s", fullpath)
+            log.warning("Could not unserialize value from blob %s", value_ref)
             return
+        self.cache.put(key, value, len(data))
         return value
 
-    def get_children(self, domain, selector, recurse=True):
-        result = set()
-        if domain not in self.edges:
-            return result
-        if selector not in self.edges[domain]:
-            return result
-        for child in self.edges[domain][selector]:
-            desc = self.get_descriptor(domain, child)
-            if desc:
-                result.add(desc)
-            if recurse:
-                result |= self.get_children(child, domain, recurse)
-        return result
+    def get_value_path(self, domain, selector):
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+        value_ref = self.db.get_value_ref(domain, selector)
+        if value_ref is None or not value_ref.endswith('.' + self.RAW_EXT):
+            return None
+        return self.blobs.get_path(value_ref)
+
+    def _list_children(self, domain, selector):
+        return self.db.list_children(domain, selector)
+
+    def _list_precursors(self, domain, selector):
+        return self.db.list_precursors(domain, selector)
+
+    def get_ancestry(self, domain, selector):
+        return self.db.get_ancestry(domain, selector)
 
     def _mkdirs(self, domain, selector):
         """
@@ -315,36 +651,328 @@ class DiskStorage(Storage):
                       "characters", domain.encode('hex'))
             return
 
-        if '/%' not in selector:
-            # no trailing '/' before the hash - add it
-            selector = selector.replace('%', '/%')
-        path = os.path.join(self.basepath, domain, selector[1:])
-        return path
+        return selector_path(self.basepath, domain, selector,
+                             self.shard_levels)
 
     def add(self, descriptor):
         selector = descriptor.selector
         domain = descriptor.domain
+        if self.db.get_meta(domain, selector) is not None:
+            # Descriptor already exists
+            return False
         fname = self._mkdirs(domain, selector)
         if not fname:
             # error occurred while making directories
             return False
-        if os.path.isfile(fname + '.meta'):
-            # File already exists
-            return False
-
-        self._register_meta(descriptor)
 
         serialized_meta = descriptor.serialize_meta(store_serializer)
-        serialized_value = descriptor.serialize_value(store_serializer)
+        if descriptor.file_value is not None:
+            return self._add_file_value(descriptor, fname, serialized_meta)
+        if type(descriptor.value) is str:
+            # Store raw, so that it can be memory-mapped
+            serialized_value = descriptor.value
+            ext = self.RAW_EXT
+        else:
+            serialized_value = descriptor.serialize_value(store_serializer)
+            ext = None
 
-        # Write meta
-        with open(fname + '.meta', 'wb') as fp:
-            fp.write(serialized_meta)
+        if self.write_behind:
+            size = len(serialized_value)
+            with self.pending_cond:
+                # backpressure
+                while self.pending_bytes and \
+                        self.pending_bytes + size > self.max_pending_bytes:
+                    self.pending_cond.wait()
+                # value reference will be set once files have been written
+                if not self.db.add_descriptor(descriptor, serialized_meta):
+                    return False
+                self.pending_values[(domain, selector)] = descriptor.value
+                self.pending_bytes += size
+            self.write_queue.put((domain, selector, fname, serialized_meta,
+                                  serialized_value, ext))
+        else:
+            value_ref = self._write_files(selector, fname, serialized_meta,
+                                          serialized_value, ext)
+            try:
+                if not self.db.add_descriptor(descriptor, serialized_meta,
+                                              value_ref):
+                    return False
+            finally:
+                self._unpin(value_ref)
+        # agents are about to fetch this new descriptor
+        self.cache.put(('meta', domain, selector),
+                       Descriptor.unserialize(store_serializer,
+                                              serialized_meta, trusted=True),
+                       len(serialized_meta))
+        self.cache.put(('value', domain, selector), descriptor.value,
+                       len(serialized_value))
+        return True
 
-        # Write value
-        with open(fname + '.value', 'wb') as fp:
-            fp.write(serialized_value)
+    def _add_file_value(self, descriptor, fname, serialized_meta):
+        """
+        Adds a descriptor created by Descriptor.from_file. Its value is copied
+        by chunks to an uncompressed blob, without being loaded in memory.
+        """
+        domain, selector = descriptor.domain, descriptor.selector
+        tmpname, digest, size = self.blobs.spool(
+            descriptor.file_value.iter_chunks())
+        with self.gc_lock:
+            value_ref, stored_size = self.blobs.put_spooled(tmpname, digest,
+                                                            self.RAW_EXT)
+            self.pinned_refs[value_ref] += 1
+        try:
+            if stored_size is not None:
+                self.db.add_blob(value_ref, stored_size, size)
+            self._write_ref(fname, value_ref)
+            with open(fname + '.meta', 'wb') as fp:
+                fp.write(serialized_meta)
+            if not self.db.add_descriptor(descriptor, serialized_meta,
+                                          value_ref):
+                return False
+        finally:
+            self._unpin(value_ref)
+        self.cache.put(('meta', domain, selector),
+                       Descriptor.unserialize(store_serializer,
+                                              serialized_meta, trusted=True),
+                       len(serialized_meta))
+        return True
+
+    def _write_files(self, selector, fname, serialized_meta,
+                     serialized_value, ext):
+        """
+        Writes value blob, .ref and .meta files of a descriptor. Returns the
+        value reference, which is pinned until the caller unpins it.
+        """
+        # Write value, unless an identical value has already been stored
+        codec = None
+        if self._should_compress(selector, serialized_value):
+            codec = self.compression
+        with self.gc_lock:
+            value_ref, size = self.blobs.put(serialized_value, ext, codec,
+                                             self.compression_level)
+            # unpinned once the descriptor has been indexed
+            self.pinned_refs[value_ref] += 1
+        try:
+            if size is not None:
+                self.db.add_blob(value_ref, size, len(serialized_value))
+            self._write_ref(fname, value_ref)
+
+            # Write meta
+            with open(fname + '.meta', 'wb') as fp:
+                fp.write(serialized_meta)
+        except Exception:
+            self._unpin(value_ref)
+            raise
+        return value_ref
+
+    def _writer_loop(self):
+        """
+        Runs in background threads, writes files of queued descriptors.
+        Files are synced to disk before value references are added to the
+        index, so that the index never references incomplete files.
+        Descriptors whose files could not be written are removed from the
+        index.
+        """
+        while True:
+            jobs = [self.write_queue.get()]
+            while len(jobs) < 100:
+                try:
+                    jobs.append(self.write_queue.get_nowait())
+                except Queue.Empty:
+                    break
+            written = []
+            for domain, selector, fname, serialized_meta, serialized_value, \
+                    ext in jobs:
+                try:
+                    value_ref = self._write_files(
+                        selector, fname, serialized_meta, serialized_value,
+                        ext)
+                    written.append((domain, selector, fname, value_ref))
+                except Exception:
+                    log.error("Could not write files for %s:%s", domain,
+                              selector, exc_info=1)
+                    self._discard_unwritten(domain, selector, fname)
+            for domain, selector, fname, value_ref in written:
+                try:
+                    for path in (self.blobs.get_path(value_ref),
+                                 fname + '.ref', fname + '.meta'):
+                        fd = os.open(path, os.O_RDONLY)
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            os.close(fd)
+                    self.db.set_value_ref(domain, selector, value_ref)
+                except Exception:
+                    log.error("Could not sync files of %s:%s", domain,
+                              selector, exc_info=1)
+                    self._discard_unwritten(domain, selector, fname)
+                finally:
+                    self._unpin(value_ref)
+            with self.pending_cond:
+                for job in jobs:
+                    del self.pending_values[job[:2]]
+                    self.pending_bytes -= len(job[4])
+                self.pending_cond.notify_all()
+            for _ in jobs:
+                self.write_queue.task_done()
+
+    def _discard_unwritten(self, domain, selector, fname):
+        """
+        Removes a descriptor whose files could not be written from the index,
+        together with files that may have been partially written.
+        """
+        log.error("Descriptor %s:%s has been lost before being written to "
+                  "disk", domain, selector)
+        for ext in ('.meta', '.ref', '.ref.tmp'):
+            try:
+                os.remove(fname + ext)
+            except OSError:
+                pass
+        try:
+            self._delete_descriptor(domain, selector)
+        except Exception:
+            log.error("Could not remove %s:%s from the index", domain,
+                      selector, exc_info=1)
+
+    def _unpin(self, value_ref):
+        with self.gc_lock:
+            self.pinned_refs[value_ref] -= 1
+            if self.pinned_refs[value_ref] <= 0:
+                del self.pinned_refs[value_ref]
+
+    def _gc_loop(self):
+        while True:
+            time.sleep(self.gc_interval)
+            try:
+                self.collect_garbage()
+            except Exception:
+                log.error("Garbage collection failed", exc_info=1)
+
+    def collect_garbage(self, dry_run=False):
+        report = {'descriptors': 0, 'blobs': 0, 'bytes': 0, 'rules': {}}
+        start = time.time()
+        #: value_ref -> number of expired descriptors referencing it
+        expired_refs = Counter()
+        for domain in self.db.list_domains():
+            expired = set()
+            for rule in self.retention:
+                if not rule.applies_to(domain):
+                    continue
+                records = self.db.iter_retention_records(domain, rule.prefix)
+                selectors = set(rule.expired(records, start))
+                report['rules'][str(rule)] = \
+                    report['rules'].get(str(rule), 0) + len(selectors)
+                expired |= selectors
+            for selector in expired:
+                if dry_run:
+                    value_ref = self.db.get_value_ref(domain, selector)
+                    if value_ref is not None:
+                        expired_refs[value_ref] += 1
+                else:
+                    self._delete_descriptor(domain, selector)
+                    self._gc_throttle(start, report['descriptors'])
+                report['descriptors'] += 1
+        if dry_run:
+            # blobs that are only referenced by expired descriptors
+            for value_ref, count in expired_refs.items():
+                refcount, size = self.db.blob_info(value_ref)
+                if refcount <= count:
+                    report['blobs'] += 1
+                    report['bytes'] += size or 0
+            for value_ref, size in self.db.list_orphan_blobs():
+                report['blobs'] += 1
+                report['bytes'] += size
+        else:
+            report['blobs'], report['bytes'] = self._reclaim_blobs()
+            self.db.flush()
+            self.gc_stats.update(runs=1, descriptors=report['descriptors'],
+                                 blobs=report['blobs'],
+                                 bytes_reclaimed=report['bytes'])
+            log.info("Garbage collection: deleted %d descriptors and %d "
+                     "value blobs, reclaimed %d bytes", report['descriptors'],
+                     report['blobs'], report['bytes'])
+        return report
+
+    def _gc_throttle(self, start, deleted):
+        """
+        Sleeps so that at most gc_rate descriptors are deleted per second.
+        """
+        if self.gc_rate > 0:
+            delay = start + float(deleted) / self.gc_rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _delete_descriptor(self, domain, selector):
+        # files may use another number of subdirectory levels
+        for levels in [self.shard_levels] + range(MAX_SHARD_LEVELS + 1):
+            fname = selector_path(self.basepath, domain, selector, levels)
+            if os.path.exists(fname + '.meta'):
+                for ext in ('.meta', '.ref'):
+                    try:
+                        os.remove(fname + ext)
+                    except OSError:
+                        pass
+                break
+        self.db.delete_descriptor(domain, selector)
+        self.cache.discard(('meta', domain, selector))
+        self.cache.discard(('value', domain, selector))
+        self.processable[domain].pop(selector, None)
+
+    def _reclaim_blobs(self):
+        """
+        Removes value blobs that are not referenced anymore. Returns the
+        number of removed blobs and their total size on disk.
+        """
+        count = 0
+        size = 0
+        for value_ref, blob_size in self.db.list_orphan_blobs():
+            with self.gc_lock:
+                if value_ref in self.pinned_refs:
+                    # being referenced by a new descriptor
+                    continue
+                if not self.db.remove_blob(value_ref):
+                    continue
+                try:
+                    os.remove(self.blobs.get_path(value_ref))
+                except OSError:
+                    log.warning("Could not remove value blob %s", value_ref)
+            count += 1
+            size += blob_size
+        return count, size
+
+    def _index_loop(self):
+        while True:
+            try:
+                if self._index_trigrams():
+                    continue
+            except Exception:
+                log.error("Trigram indexing failed", exc_info=1)
+            time.sleep(self.TRIGRAM_INDEX_INTERVAL)
+
+    def _index_trigrams(self, count=100):
+        """
+        Adds at most count blobs that have not been examined yet to the value
+        trigram index. Only raw values up to trigram_max_size bytes are
+        indexed. Returns the number of examined blobs.
+        """
+        blobs = self.db.list_unindexed_blobs(count)
+        for value_ref, size in blobs:
+            value_trigrams = None
+            if self._is_raw(value_ref) and \
+                    (size is None or size <= self.trigram_max_size):
+                data = self.blobs.get(value_ref)
+                if data is not None and len(data) <= self.trigram_max_size:
+                    value_trigrams = trigrams(data)
+            self.db.add_trigrams(value_ref, value_trigrams)
+        return len(blobs)
 
+    def _should_compress(self, selector, data):
+        if not self.compression or len(data) < self.compression_min_size:
+            return False
+        if selector.startswith(self.compress_exclude):
+            return False
+        if self.compress_include:
+            return selector.startswith(self.compress_include)
         return True
 
     def mark_processed(self, domain, selector, agent_name, config_txt):
@@ -361,6 +989,9 @@ class DiskStorage(Storage):
     def mark_processable(self, domain, selector, agent_name, config_txt):
         result = False
         key = (agent_name, config_txt)
+        if not self.db.has_descriptor(domain, selector):
+            # deleted by the garbage collector
+            return False
         if key not in self.processable[domain][selector]:
             self.processable[domain][selector].add((agent_name, config_txt))
             if not self.db.is_processed(
@@ -374,7 +1005,7 @@ class DiskStorage(Storage):
         return self.db.list_processed(domain, selector)
 
     def get_processable(self, domain, selector):
-        return self.processable[domain][selector]
+        return self.processable[domain].get(selector, set())
 
     def processed_stats(self, domain):
         """
@@ -386,8 +1017,18 @@ class DiskStorage(Storage):
     def store_agent_state(self, agent_name, state):
         fname = os.path.join(self.basepath, 'agent_intstate', agent_name +
                              '.intstate')
-        with open(fname, 'wb') as fp:
-            fp.write(state)
+        write_state_file(fname, state)
+
+    def append_agent_state(self, agent_name, delta):
+        fname = os.path.join(self.basepath, 'agent_intstate', agent_name +
+                             '.intstate.deltas')
+        append_state_delta(fname, delta)
+
+    def load_agent_state_deltas(self, agent_name, position=0,
+                                max_bytes=1 << 20):
+        fname = os.path.join(self.basepath, 'agent_intstate', agent_name +
+                             '.intstate.deltas')
+        return read_state_deltas(fname, position, max_bytes)
 
     def load_agent_state(self, agent_name):
         fname = os.path.join(self.basepath, 'agent_intstate', agent_name +
@@ -397,22 +1038,186 @@ class DiskStorage(Storage):
         with open(fname, 'rb') as fp:
             return fp.read()
 
+    def list_agent_states(self):
+        names = set()
+        for fname in os.listdir(os.path.join(self.basepath,
+                                             'agent_intstate')):
+            for suffix in ('.intstate', '.intstate.deltas'):
+                if fname.endswith(suffix):
+                    names.add(fname[:-len(suffix)])
+        return list(names)
+
+    def list_domains(self):
+        return self.db.list_domains()
+
+    def iter_selectors(self, domain):
+        for _, selector in self.db.iter_descriptors(domain=domain):
+            yield selector
+
+    def bulk_load(self):
+        return self.db.deferred_commits()
+
+    def store_state(self):
+        # wait for background writes
+        self.write_queue.join()
+        if self.search_pool is not None:
+            self.search_pool.terminate()
+            self.search_pool = None
+        self.db.flush()
+        self.db.set_info('clean_shutdown', 1)
+        log.info("Storage statistics: %s", ', '.join(
+            '%s=%s' % item for item in sorted(self.storage_stats().items())))
+
+    def storage_stats(self):
+        count, size, data_size = self.db.blob_stats()
+        stats = {
+            'value_blobs': count,
+            'value_bytes_on_disk': size,
+            'value_bytes': data_size,
+            # > 1 when compression saves space
+            'compression_ratio': float(data_size) / size if size else 1.,
+        }
+        for k, v in self.cache.stats().items():
+            stats['cache_' + k] = v
+        for k in ('runs', 'descriptors', 'blobs', 'bytes_reclaimed'):
+            stats['gc_' + k] = self.gc_stats[k]
+        return stats
+
     def list_unprocessed_by_agent(self, agent_name, config_txt):
-        dom_sel = self.db.list_unprocessed_by_agent(agent_name, config_txt)
-        res = []
-        for domain, selector in dom_sel:
-            desc = self.get_descriptor(domain, selector)
-            if not desc:
-                # file has been deleted?
-                log.warning("Could not get data for %s:%s, files may have "
-                            "been deleted.", domain, selector)
-                continue
-            uuid = desc.uuid
-            res.append((domain, uuid, selector))
-        return res
+        return list(self.iter_unprocessed_by_agent(agent_name, config_txt))
+
+    def iter_unprocessed_by_agent(self, agent_name, config_txt):
+        # uuids are read from the index, descriptor files are not opened
+        return self.db.iter_unprocessed_by_agent(agent_name, config_txt)
 
     @staticmethod
     def add_arguments(subparser):
         subparser.add_argument(
             "--path", help="Disk storage path (defaults to /tmp/rebus)",
             default="/tmp/rebus")
+        subparser.add_argument(
+            "--verify-index", action='store_true',
+            help="Walk the storage directory in a background thread once the "
+            "bus has started, adding descriptors missing from the index")
+        subparser.add_argument(
+            "--commit-interval", type=int, default=100,
+            help="Maximum delay before metadata database writes are "
+            "committed, in milliseconds. Writes performed during this "
+            "interval may be lost on crash. 0 commits every write "
+            "(defaults to 100)")
+        subparser.add_argument(
+            "--commit-rows", type=int, default=1000,
+            help="Maximum number of uncommitted metadata database writes "
+            "(defaults to 1000)")
+        subparser.add_argument(
+            "--compression", choices=['none'] + sorted(BlobStore.CODECS),
+            default='none', help="Codec used to compress stored values "
+            "(defaults to none)")
+        subparser.add_argument(
+            "--compression-level", type=int, default=6,
+            help="Compression level, from 1 to 9 (defaults to 6)")
+        subparser.add_argument(
+            "--compression-min-size", type=int, default=1024,
+            help="Values smaller than this number of bytes are not compressed "
+            "(defaults to 1024)")
+        subparser.add_argument(
+            "--compress-include", nargs='*', default=[], metavar='PREFIX',
+            help="Only compress values of descriptors having one of these "
+            "selector prefixes, such as /binary/ (defaults to all "
+            "descriptors)")
+        subparser.add_argument(
+            "--compress-exclude", nargs='*', default=[], metavar='PREFIX',
+            help="Never compress values of descriptors having one of these "
+            "selector prefixes. %s are always excluded" %
+            ', '.join(DiskStorage.NEVER_COMPRESS))
+        subparser.add_argument(
+            "--cache-bytes", type=int, default=64 * 1024 * 1024,
+            help="Maximum total size of descriptors and values kept in the "
+            "in-memory cache, in bytes. 0 disables the cache (defaults to "
+            "64 MiB)")
+        subparser.add_argument(
+            "--cache-entries", type=int, default=10000,
+            help="Maximum number of descriptors and values kept in the "
+            "in-memory cache (defaults to 10000)")
+        subparser.add_argument(
+            "--shard-levels", type=int, choices=range(MAX_SHARD_LEVELS + 1),
+            help="Number of hash-prefix subdirectory levels used to store "
+            "descriptor files. Use for storages containing many descriptors "
+            "having the same selector prefix. Remembered by the storage "
+            "(defaults to 0 for new storages)")
+        subparser.add_argument(
+            "--write-threads", type=int, default=0,
+            help="Number of background threads writing descriptor files. "
+            "Descriptors are available as soon as they have been added, "
+            "files are synced to disk in batches. 0 writes files before "
+            "returning from add (defaults to 0)")
+        subparser.add_argument(
+            "--write-queue-bytes", type=int, default=256 * 1024 * 1024,
+            help="Maximum total size of values waiting to be written by "
+            "background threads; adding descriptors blocks when it is reached "
+            "(defaults to 256 MiB)")
+        add_gc_arguments(subparser)
+        subparser.add_argument(
+            "--trigram-max-size", type=int, default=0,
+            help="Raw values up to this size, in bytes, are added to the "
+            "trigram index used to speed up value searches, by a background "
+            "thread. Larger values, and values containing too many distinct "
+            "trigrams, are always read when searching. 0 disables indexing "
+            "(defaults to 0)")
+        subparser.add_argument(
+            "--search-processes", type=int, default=0,
+            help="Number of processes used to match values when searching. 0 "
+            "matches values in the bus master process (defaults to 0)")
+
+
+def reshard(basepath, shard_levels):
+    """
+    Moves descriptor files of the DiskStorage located at basepath to
+    shard_levels levels of hash-prefix subdirectories. This may be performed
+    while the bus master is running; descriptors added in the meantime may
+    have to be moved by running reshard again after the master has been
+    restarted.
+
+    Returns the number of descriptors whose files have been moved.
+    """
+    basepath = basepath.rstrip('/')
+    db = MetadataDB(os.path.join(basepath, 'diskstorage.sqlite3'))
+    if db.get_info('layout_version') != str(DiskStorage.LAYOUT_VERSION):
+        raise Exception("%s has not been opened by this version of the "
+                        "storage yet" % basepath)
+    # descriptors added from now on use the new layout
+    db.set_info('shard_levels', shard_levels)
+    moved = 0
+    for domain, selector in db.iter_descriptors():
+        target = selector_path(basepath, domain, selector, shard_levels)
+        if os.path.isfile(target + '.meta'):
+            continue
+        for levels in xrange(MAX_SHARD_LEVELS + 1):
+            source = selector_path(basepath, domain, selector, levels)
+            if os.path.isfile(source + '.meta'):
+                break
+        else:
+            log.warning("Missing files for descriptor %s:%s", domain,
+                        selector)
+            continue
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError as e:
+            if e.args[0] != 17:  # File exists
+                raise
+        # .meta is moved last, so that it is found at its old location if
+        # this is interrupted
+        for ext in ('.ref', '.meta'):
+            if os.path.isfile(source + ext):
+                os.rename(source + ext, target + ext)
+        # remove subdirectories that have become empty
+        srcdir = os.path.dirname(source)
+        for _ in xrange(levels):
+            try:
+                os.rmdir(srcdir)
+            except OSError:
+                break
+            srcdir = os.path.dirname(srcdir)
+        moved += 1
+    db.close()
+    return moved
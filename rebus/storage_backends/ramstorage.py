@@ -1,8 +1,61 @@
-from rebus.storage import Storage
+from rebus.storage import Storage, add_gc_arguments, regex_literal_prefix
+from rebus.storage import make_ancestry
+from rebus.tools.lrucache import LRUCache
+from rebus.tools.serializer import picklev2 as store_serializer
+import atexit
+import bisect
+import copy
+import functools
+import heapq
+import logging
+import os
 import re
+import shutil
+import tempfile
+import threading
+import time
 from collections import defaultdict
 from collections import OrderedDict
 from collections import Counter
+log = logging.getLogger("rebus.storage.ramstorage")
+
+
+def _locked(method):
+    """
+    Runs method while holding the lock of the storage, which is shared with
+    the garbage collection thread.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _iter_bucket(bucket, newest_first):
+    """
+    Generates (sort key, selector) couples from a bucket of
+    RAMStorage.by_prefix, in order of addition, or in reverse order.
+    """
+    if newest_first:
+        for selector in reversed(bucket):
+            yield -bucket[selector], selector
+    else:
+        for selector, seq in bucket.iteritems():
+            yield seq, selector
+
+
+class SpillLoader(object):
+    """
+    Used as the bus of descriptors whose value has been spilled to disk by
+    RAMStorage: their value is reloaded when it is accessed.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get_value(self, agent_id, domain, selector):
+        return self.storage.get_value(domain, selector)
 
 
 @Storage.register
@@ -14,10 +67,36 @@ class RAMStorage(Storage):
     _name_ = "ramstorage"
     STORES_INTSTATE = False
 
+    #: Number of compiled selector and value regexes that are kept
+    REGEX_CACHE_SIZE = 256
+
+    #: Descriptors that are being processed are not deleted by the garbage
+    #: collector, unless they have been locked for more than this number of
+    #: seconds without being marked as processed
+    PROCESSING_TIMEOUT = 3600
+
     def __init__(self, options=None):
         #: self.dstore['domain']['/selector/%hash'] is a descriptor
         self.dstore = defaultdict(OrderedDict)
 
+        #: Secondary indexes, maintained by add() and _delete_descriptor().
+        #: self.by_prefix['domain']['/selector/'] maps '/selector/%hash' to
+        #: its sequence number, increasing with time of addition, in order of
+        #: addition
+        self.by_prefix = defaultdict(dict)
+        #: self.prefixes['domain'] is the sorted list of keys of
+        #: self.by_prefix['domain'], used for prefix range lookups
+        self.prefixes = defaultdict(list)
+        self.next_seq = 0
+        #: self.by_uuid['domain'][uuid] has selectors having this uuid as
+        #: keys, in order of addition
+        self.by_uuid = defaultdict(lambda: defaultdict(OrderedDict))
+        #: self.uuid_labels['domain'][uuid] is the label of this uuid
+        self.uuid_labels = defaultdict(dict)
+        #: compiled regexes
+        self.regex_cache = LRUCache(self.REGEX_CACHE_SIZE,
+                                    self.REGEX_CACHE_SIZE)
+
         #: self.version_cache['domain']['/selector/'][42] = /selector/%1234
         #: where 1234 is the hash of this selector's version 42
         self.version_cache = defaultdict(lambda: defaultdict(dict))
@@ -26,6 +105,10 @@ class RAMStorage(Storage):
         #: descriptors that were spawned from selectorA.
         self.edges = defaultdict(lambda: defaultdict(set))
 
+        #: self.ancestry['domain']['/selector/%hash'] is the ancestry summary
+        #: of this descriptor, see make_ancestry
+        self.ancestry = defaultdict(dict)
+
         #: self.processed['domain']['/selector/%hash'] is a set of (agent name,
         #: configuration text) that have finished processing, or declined to
         #: process this descriptor.
@@ -33,6 +116,11 @@ class RAMStorage(Storage):
         #: {RAM,Disk}storage implementations.
         self.processed = defaultdict(OrderedDict)
 
+        #: self.processed_counts['domain'][agent name] is the number of
+        #: selectors that have been processed by this agent, using any
+        #: configuration
+        self.processed_counts = defaultdict(Counter)
+
         #: self.processable['domain']['/selector/%hash'] is a set of (agent
         #: name, configuration text) that are running in interactive mode, and
         #: are able to process this descriptor.
@@ -40,10 +128,95 @@ class RAMStorage(Storage):
 
         #: internal state of agents
         self.internal_state = {}
+        #: self.internal_state_deltas[agent_name] is a list of changes
+        #: appended to internal_state[agent_name]
+        self.internal_state_deltas = defaultdict(list)
+
+        #: self.added['domain']['/selector/%hash'] is the time at which the
+        #: descriptor has been stored
+        self.added = defaultdict(dict)
+
+        #: Garbage collection: descriptors that expire according to retention
+        #: rules are deleted every gc_interval seconds, by a background
+        #: thread. Storage methods hold self.lock while they run.
+        self.retention = getattr(options, 'retention', [])
+        self.gc_interval = getattr(options, 'gc_interval', 0)
+        self.gc_rate = getattr(options, 'gc_rate', 0)
+        #: counters of deleted descriptors and reclaimed bytes
+        self.gc_stats = Counter()
+        #: self.processing[('domain', '/selector/%hash')] is (number of
+        #: agents processing this descriptor, time of the last lock)
+        self.processing = {}
+        self.lock = threading.RLock()
+
+        #: Memory budget: values are kept in memory up to max_value_bytes (0
+        #: for no limit). Least recently used values are then spilled to
+        #: files in a temporary directory created in spill_path, and replaced
+        #: in self.dstore by a descriptor whose value is reloaded when
+        #: accessed. Descriptor metadata always stays in memory.
+        self.max_value_bytes = getattr(options, 'max_value_bytes', 0)
+        self.spill_path = getattr(options, 'spill_path', None)
+        #: temporary directory containing spilled values, created on first
+        #: spill
+        self.spill_dir = None
+        self.spill_loader = SpillLoader(self)
+        #: (domain, selector) -> size of values held in memory, least
+        #: recently used first
+        self.resident = OrderedDict()
+        self.resident_bytes = 0
+        #: (domain, selector) -> name of the file containing the value, for
+        #: values that have been spilled at least once. Values never change,
+        #: so these files are kept when values are reloaded.
+        self.spilled = {}
+        #: counters of spilled and reloaded values
+        self.spill_stats = Counter()
+        #: self.value_sizes['domain']['/selector/%hash'] is the size of this
+        #: descriptor's value, recorded when it is added if the memory budget
+        #: or max-bytes retention rules need it
+        self.value_sizes = defaultdict(dict)
+        self.track_sizes = self.max_value_bytes > 0 or any(
+            rule.max_bytes is not None for rule in self.retention)
+
+        if self.retention and self.gc_interval > 0:
+            t = threading.Thread(target=self._gc_loop)
+            t.daemon = True
+            t.start()
 
+    def _regex(self, pattern):
+        regex = self.regex_cache.get(pattern)
+        if regex is None:
+            regex = re.compile(pattern)
+            self.regex_cache.put(pattern, regex, 1)
+        return regex
+
+    def _iter_prefix(self, domain, selector_prefix, newest_first=False):
+        """
+        Generates selectors that may start with selector_prefix, in order of
+        addition. Only descriptors whose selector, up to its hash, starts
+        with selector_prefix or is a prefix of it, are generated; callers
+        must check that generated selectors do start with selector_prefix.
+        """
+        by_prefix = self.by_prefix.get(domain, {})
+        if '%' in selector_prefix:
+            buckets = [by_prefix.get(selector_prefix.split('%')[0], {})]
+        else:
+            prefixes = self.prefixes.get(domain, [])
+            start = bisect.bisect_left(prefixes, selector_prefix)
+            buckets = []
+            for prefix in prefixes[start:]:
+                if not prefix.startswith(selector_prefix):
+                    break
+                buckets.append(by_prefix[prefix])
+        lists = [_iter_bucket(bucket, newest_first) for bucket in buckets]
+        if len(lists) == 1:
+            return (selector for _, selector in lists[0])
+        return (selector for _, selector in heapq.merge(*lists))
+
+    @_locked
     def find(self, domain, selector_regex, limit=0, offset=0):
-        regex = re.compile(selector_regex)
-        sel_list = reversed(self.processed[domain].keys())
+        regex = self._regex(selector_regex)
+        sel_list = self._iter_prefix(
+            domain, regex_literal_prefix(selector_regex), newest_first=True)
         result = []
 
         for k in sel_list:
@@ -56,42 +229,86 @@ class RAMStorage(Storage):
                     return result
         return result
 
+    @_locked
     def find_by_selector(self, domain, selector_prefix, limit=0, offset=0):
         result = []
-        for selector in self.processed[domain].keys():
+        for selector in self._iter_prefix(domain, selector_prefix):
             if selector.startswith(selector_prefix):
                 if offset > 0:
                     offset -= 1
                     continue
-                desc = self.dstore[domain][selector]
-                result.append(desc)
+                result.append(self._descriptor(domain, selector))
                 if limit != 0 and len(result) >= limit:
                     return result
         return result
 
+    @_locked
     def find_by_uuid(self, domain, uuid):
-        result = []
-        for _, desc in self.dstore[domain].iteritems():
-            if desc.uuid == uuid:
-                result.append(desc)
-        return result
+        return [self._descriptor(domain, selector) for selector in
+                self.by_uuid.get(domain, {}).get(uuid, ())]
 
-    def find_by_value(self, domain, selector_prefix, value_regex):
+    @_locked
+    def find_by_value(self, domain, selector_prefix, value_regex, limit=0,
+                      offset=0):
+        regex = self._regex(value_regex)
         result = []
-        for _, desc in self.dstore[domain].iteritems():
-            if desc.selector.startswith(selector_prefix) and \
-                    re.match(value_regex, desc.value):
-                result.append(desc)
+        for selector in self._iter_prefix(domain, selector_prefix):
+            if not selector.startswith(selector_prefix):
+                continue
+            value = self._peek_value(domain, selector)
+            if isinstance(value, str) and regex.match(value):
+                if offset > 0:
+                    offset -= 1
+                    continue
+                result.append(self._descriptor(domain, selector))
+                if limit != 0 and len(result) >= limit:
+                    return result
         return result
 
+    @_locked
     def list_uuids(self, domain):
-        result = dict()
-        for desc in self.dstore[domain].values():
-            # Heuristic for choosing uuid label : prefer label of a descriptor
-            # that has no precursor
-            if desc.uuid not in result or not desc.precursors:
-                result[desc.uuid] = desc.label
-        return result
+        return dict(self.uuid_labels.get(domain, {}))
+
+    def _index(self, domain, selector, desc):
+        """
+        Adds a descriptor to secondary indexes.
+        """
+        prefix = selector.split('%')[0]
+        by_prefix = self.by_prefix[domain]
+        if prefix not in by_prefix:
+            by_prefix[prefix] = OrderedDict()
+            bisect.insort(self.prefixes[domain], prefix)
+        by_prefix[prefix][selector] = self.next_seq
+        self.next_seq += 1
+        self.by_uuid[domain][desc.uuid][selector] = None
+        # Heuristic for choosing uuid label : prefer label of a descriptor
+        # that has no precursor
+        if desc.uuid not in self.uuid_labels[domain] or not desc.precursors:
+            self.uuid_labels[domain][desc.uuid] = desc.label
+
+    def _unindex(self, domain, selector, desc):
+        """
+        Removes a descriptor from secondary indexes.
+        """
+        prefix = selector.split('%')[0]
+        entries = self.by_prefix[domain][prefix]
+        del entries[selector]
+        if not entries:
+            del self.by_prefix[domain][prefix]
+            prefixes = self.prefixes[domain]
+            del prefixes[bisect.bisect_left(prefixes, prefix)]
+        selectors = self.by_uuid[domain][desc.uuid]
+        del selectors[selector]
+        if not selectors:
+            del self.by_uuid[domain][desc.uuid]
+            del self.uuid_labels[domain][desc.uuid]
+            return
+        label = None
+        for sel in selectors:
+            other = self.dstore[domain][sel]
+            if label is None or not other.precursors:
+                label = other.label
+        self.uuid_labels[domain][desc.uuid] = label
 
     def _version_lookup(self, domain, selector):
         """
@@ -115,52 +332,314 @@ class RAMStorage(Storage):
                 selector = None
         return selector
 
+    @_locked
     def get_descriptor(self, domain, selector):
         selector = self._version_lookup(domain, selector)
 
         # Check whether domain & selector are known
         if domain not in self.dstore or selector not in self.dstore[domain]:
             return None
-        return self.dstore[domain][selector]
+        self._touch(domain, selector)
+        return self._descriptor(domain, selector)
 
+    @_locked
     def get_value(self, domain, selector):
         selector = self._version_lookup(domain, selector)
 
         # Check whether domain & selector are known
         if domain not in self.dstore or selector not in self.dstore[domain]:
             return None
-        return self.dstore[domain][selector].value
+        if self.max_value_bytes <= 0:
+            return self.dstore[domain][selector].value
+        if self._touch(domain, selector):
+            return self.dstore[domain][selector].value
+        return self._reload(domain, selector)
 
-    def get_children(self, domain, selector, recurse=True):
-        result = set()
-        if selector not in self.dstore[domain]:
-            return result
-        for child in self.edges[domain][selector]:
-            result.add(self.dstore[domain][child])
-            if recurse:
-                result |= self.get_children(child, domain, recurse)
-        return result
+    def _descriptor(self, domain, selector):
+        """
+        Returns the descriptor of selector. A copy is returned if its value
+        has been spilled, so that loading this value does not keep it in
+        memory.
+        """
+        desc = self.dstore[domain][selector]
+        if desc.bus is self.spill_loader:
+            desc = copy.copy(desc)
+        return desc
+
+    def _touch(self, domain, selector):
+        """
+        Marks the value of selector as recently used. Returns False if it has
+        been spilled.
+        """
+        key = (domain, selector)
+        if self.max_value_bytes <= 0:
+            return True
+        size = self.resident.pop(key, None)
+        if size is None:
+            return False
+        self.resident[key] = size
+        return True
+
+    def _keep_value(self, domain, selector, size):
+        """
+        Accounts for a value that is held in memory, then spills least
+        recently used values while the memory budget is exceeded.
+        """
+        self.resident[(domain, selector)] = size
+        self.resident_bytes += size
+        while self.resident_bytes > self.max_value_bytes:
+            (domain, selector), size = self.resident.popitem(last=False)
+            self.resident_bytes -= size
+            self._spill(domain, selector)
+
+    def _spill(self, domain, selector):
+        desc = self.dstore[domain][selector]
+        key = (domain, selector)
+        if key not in self.spilled:
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix='rebus-ramstorage-',
+                                                  dir=self.spill_path)
+                atexit.register(shutil.rmtree, self.spill_dir, True)
+            fname = os.path.join(self.spill_dir,
+                                 str(self.spill_stats['spilled']))
+            value = desc.value
+            with open(fname, 'wb') as fp:
+                if isinstance(value, str):
+                    fp.write('r')
+                    fp.write(value)
+                else:
+                    fp.write('s')
+                    fp.write(store_serializer.dumps(value))
+            self.spilled[key] = fname
+            self.spill_stats['spilled'] += 1
+        # the stored descriptor does not reference its value anymore
+        stub = copy.copy(desc)
+        stub.value = None
+        stub.bus = self.spill_loader
+        self.dstore[domain][selector] = stub
+
+    def _read_spilled(self, domain, selector):
+        with open(self.spilled[(domain, selector)], 'rb') as fp:
+            data = fp.read()
+        self.spill_stats['reloaded'] += 1
+        if data[0] == 'r':
+            return data[1:]
+        return store_serializer.loads(data[1:])
+
+    def _reload(self, domain, selector):
+        """
+        Reads a spilled value, and keeps it in memory again.
+        """
+        value = self._read_spilled(domain, selector)
+        desc = copy.copy(self.dstore[domain][selector])
+        desc.bus = None
+        desc.value = value
+        self.dstore[domain][selector] = desc
+        self._keep_value(domain, selector, self.value_sizes[domain][selector])
+        return value
 
+    def _peek_value(self, domain, selector):
+        """
+        Returns the value of selector, without changing whether it is held
+        in memory.
+        """
+        desc = self.dstore[domain][selector]
+        if desc.bus is self.spill_loader:
+            return self._read_spilled(domain, selector)
+        return desc.value
+
+    @_locked
+    def _list_children(self, domain, selector):
+        return list(self.edges[domain].get(selector, ()))
+
+    @_locked
+    def _list_precursors(self, domain, selector):
+        desc = self.dstore[domain].get(selector)
+        if desc is None:
+            return []
+        return desc.precursors
+
+    @_locked
+    def get_ancestry(self, domain, selector):
+        return self.ancestry[domain].get(selector)
+
+    @_locked
     def add(self, descriptor):
         selector = descriptor.selector
         domain = descriptor.domain
         if selector in self.dstore[domain]:
             return False
+        if descriptor.file_value is not None:
+            # the file may be modified or removed once the descriptor has
+            # been added, e.g. after a chunked transfer
+            descriptor.value = descriptor.value
         self.dstore[domain][selector] = descriptor
         self.version_cache[domain][selector.split('%')[0]][descriptor.version]\
             = selector
         for precursor in descriptor.precursors:
             self.edges[domain][precursor].add(selector)
+        self.ancestry[domain][selector] = make_ancestry(
+            selector, [self.ancestry[domain].get(precursor)
+                       for precursor in descriptor.precursors])
+        self._index(domain, selector, descriptor)
         self.processed[domain][selector] = set()
+        self.added[domain][selector] = time.time()
+        if self.track_sizes:
+            size = self._value_size(descriptor.value)
+            self.value_sizes[domain][selector] = size
+            if self.max_value_bytes > 0:
+                self._keep_value(domain, selector, size)
         return True
 
+    def _gc_loop(self):
+        while True:
+            time.sleep(self.gc_interval)
+            try:
+                self.collect_garbage()
+            except Exception:
+                log.error("Garbage collection failed", exc_info=1)
+
+    def collect_garbage(self, dry_run=False):
+        report = {'descriptors': 0, 'blobs': 0, 'bytes': 0, 'rules': {}}
+        start = time.time()
+        with self.lock:
+            domains = self.dstore.keys()
+        for domain in domains:
+            expired = set()
+            with self.lock:
+                for rule in self.retention:
+                    if not rule.applies_to(domain):
+                        continue
+                    records = self._retention_records(
+                        domain, rule.prefix, rule.max_bytes is not None)
+                    selectors = set(
+                        selector for selector in rule.expired(records, start)
+                        if not self._is_processing(domain, selector))
+                    report['rules'][str(rule)] = \
+                        report['rules'].get(str(rule), 0) + len(selectors)
+                    expired |= selectors
+            # the lock is released between deletions, so that the bus is not
+            # blocked during the whole collection
+            for selector in expired:
+                with self.lock:
+                    if selector not in self.dstore[domain] or \
+                            self._is_processing(domain, selector):
+                        # processing has started in the meantime
+                        continue
+                    report['descriptors'] += 1
+                    report['bytes'] += self._stored_size(domain, selector)
+                    if not dry_run:
+                        self._delete_descriptor(domain, selector)
+                if not dry_run:
+                    self._gc_throttle(start, report['descriptors'])
+        if not dry_run:
+            self.gc_stats.update(runs=1, descriptors=report['descriptors'],
+                                 bytes_reclaimed=report['bytes'])
+            log.info("Garbage collection: deleted %d descriptors, reclaimed "
+                     "%d bytes", report['descriptors'], report['bytes'])
+        return report
+
+    def _gc_throttle(self, start, deleted):
+        """
+        Sleeps so that at most gc_rate descriptors are deleted per second.
+        """
+        if self.gc_rate > 0:
+            delay = start + float(deleted) / self.gc_rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _is_processing(self, domain, selector):
+        processing = self.processing.get((domain, selector))
+        return processing is not None and \
+            time.time() - processing[1] < self.PROCESSING_TIMEOUT
+
+    @_locked
+    def set_processing(self, domain, selector, processing):
+        key = (domain, selector)
+        if processing:
+            count = self.processing.get(key, (0, 0))[0]
+            self.processing[key] = (count + 1, time.time())
+        else:
+            self._end_processing(key)
+
+    def _end_processing(self, key):
+        count, locked = self.processing.pop(key, (0, 0))
+        if count > 1:
+            self.processing[key] = (count - 1, locked)
+
+    def _retention_records(self, domain, prefix, with_size):
+        for selector in reversed(self.dstore[domain].keys()):
+            if not selector.startswith(prefix):
+                continue
+            desc = self.dstore[domain][selector]
+            size = self._stored_size(domain, selector) if with_size else 0
+            yield (selector, desc.uuid, desc.version,
+                   self.added[domain][selector], size)
+
+    @staticmethod
+    def _value_size(value):
+        if isinstance(value, str):
+            return len(value)
+        return len(store_serializer.dumps(value))
+
+    def _stored_size(self, domain, selector):
+        size = self.value_sizes[domain].get(selector)
+        if size is not None:
+            return size
+        return self._value_size(self.dstore[domain][selector].value)
+
+    def _delete_descriptor(self, domain, selector):
+        desc = self.dstore[domain].pop(selector)
+        self._unindex(domain, selector, desc)
+        versions = self.version_cache[domain][selector.split('%')[0]]
+        if versions.get(desc.version) == selector:
+            del versions[desc.version]
+        for precursor in desc.precursors:
+            self.edges[domain][precursor].discard(selector)
+        self.edges[domain].pop(selector, None)
+        del self.ancestry[domain][selector]
+        agent_names = set(name for name, _ in
+                          self.processed[domain].pop(selector, ()))
+        for agent_name in agent_names:
+            self.processed_counts[domain][agent_name] -= 1
+        self.processable[domain].pop(selector, None)
+        self.processing.pop((domain, selector), None)
+        self.value_sizes[domain].pop(selector, None)
+        del self.added[domain][selector]
+        size = self.resident.pop((domain, selector), None)
+        if size is not None:
+            self.resident_bytes -= size
+        fname = self.spilled.pop((domain, selector), None)
+        if fname is not None:
+            os.remove(fname)
+
+    @_locked
+    def storage_stats(self):
+        stats = dict(('gc_' + k, self.gc_stats[k]) for k in
+                     ('runs', 'descriptors', 'bytes_reclaimed'))
+        if self.max_value_bytes > 0:
+            stats['resident_values'] = len(self.resident)
+            stats['resident_value_bytes'] = self.resident_bytes
+            stats['spill_files'] = len(self.spilled)
+            for k in ('spilled', 'reloaded'):
+                stats['values_' + k] = self.spill_stats[k]
+        return stats
+
+    @_locked
     def mark_processed(self, domain, selector, agent_name, config_txt):
         result = False
         key = (agent_name, config_txt)
+        self._end_processing((domain, selector))
+        if selector not in self.dstore[domain]:
+            # deleted by the garbage collector
+            return False
         # Add to processed if not already there
-        if key not in self.processed[domain][selector]:
+        processed = self.processed[domain][selector]
+        if key not in processed:
             result = True
-            self.processed[domain][selector].add(key)
+            if not any(name == agent_name for name, _ in processed):
+                self.processed_counts[domain][agent_name] += 1
+            processed.add(key)
         # Remove from processable
         if selector in self.processable[domain]:
             if key in self.processable[domain][selector]:
@@ -168,9 +647,12 @@ class RAMStorage(Storage):
                 self.processable[domain][selector].discard(key)
         return result
 
+    @_locked
     def mark_processable(self, domain, selector, agent_name, config_txt):
         result = False
         key = (agent_name, config_txt)
+        if selector not in self.dstore[domain]:
+            return False
         if key not in self.processable[domain][selector]:
             self.processable[domain][selector].add((agent_name, config_txt))
             if key not in self.processed[domain][selector]:
@@ -179,38 +661,89 @@ class RAMStorage(Storage):
                 result = True
         return result
 
+    @_locked
     def get_processed(self, domain, selector):
-        return self.processed[domain][selector]
+        return set(self.processed[domain].get(selector, ()))
 
+    @_locked
     def get_processable(self, domain, selector):
-        return self.processable[domain][selector]
+        return set(self.processable[domain].get(selector, ()))
 
+    @_locked
     def processed_stats(self, domain):
         """
         Returns a list of couples, (agent names, number of processed selectors)
         and the total amount of selectors in this domain.
         """
-        result = Counter()
-        processed = self.processed[domain]
-        for agentlist in processed.values():
-            result.update([name for name, _ in agentlist])
-        return result.items(), len(processed)
+        return sorted(item for item in self.processed_counts[domain].items()
+                      if item[1] > 0), len(self.dstore[domain])
 
     def list_unprocessed_by_agent(self, agent_name, config_txt):
-        result = []
-        for domain in self.dstore.keys():
-            selectors = set(self.dstore[domain].keys())
-            processed_selectors = set([sel for sel, name_confs in
-                                       self.processed[domain].items() if
-                                       (agent_name, config_txt) in
-                                       name_confs])
-            unprocessed_sels = selectors - processed_selectors
-            result.extend([(domain, self.dstore[domain][sel].uuid, sel)
-                           for sel in unprocessed_sels])
-        return result
+        return list(self.iter_unprocessed_by_agent(agent_name, config_txt))
+
+    @_locked
+    def iter_unprocessed_by_agent(self, agent_name, config_txt):
+        # Selectors known when this method is called
+        selectors = [(domain, self.dstore[domain].keys()) for domain in
+                     self.dstore.keys()]
+        return self._iter_unprocessed(selectors, (agent_name, config_txt))
+
+    def _iter_unprocessed(self, selectors, name_config):
+        for domain, domain_selectors in selectors:
+            for sel in domain_selectors:
+                with self.lock:
+                    desc = self.dstore[domain].get(sel)
+                    if desc is None:
+                        # deleted by the garbage collector
+                        continue
+                    if name_config in self.processed[domain].get(sel, ()):
+                        continue
+                yield (domain, desc.uuid, sel)
+
+    @staticmethod
+    def add_arguments(subparser):
+        subparser.add_argument(
+            "--max-value-bytes", type=int, default=0,
+            help="Maximum total size of descriptor values kept in memory, in "
+            "bytes. Least recently used values are then spilled to temporary "
+            "files, and reloaded when needed. 0 keeps all values in memory "
+            "(defaults to 0)")
+        subparser.add_argument(
+            "--spill-path", default=None,
+            help="Directory in which a temporary directory containing spilled "
+            "values is created (defaults to the system temporary directory)")
+        add_gc_arguments(subparser)
 
     def store_agent_state(self, agent_name, state):
         self.internal_state[agent_name] = state
+        self.internal_state_deltas.pop(agent_name, None)
 
     def load_agent_state(self, agent_name):
         return self.internal_state.get(agent_name, "")
+
+    def append_agent_state(self, agent_name, delta):
+        self.internal_state_deltas[agent_name].append(delta)
+
+    def load_agent_state_deltas(self, agent_name, position=0,
+                                max_bytes=1 << 20):
+        deltas = []
+        size = 0
+        for delta in self.internal_state_deltas.get(agent_name, ())[
+                position:]:
+            if size > max_bytes:
+                break
+            deltas.append(delta)
+            size += len(delta)
+        return deltas, position + len(deltas)
+
+    def list_agent_states(self):
+        return list(set(self.internal_state) |
+                    set(self.internal_state_deltas))
+
+    @_locked
+    def list_domains(self):
+        return [domain for domain, descs in self.dstore.items() if descs]
+
+    @_locked
+    def iter_selectors(self, domain):
+        return iter(list(self.dstore.get(domain, ())))
@@ -0,0 +1,1071 @@
+"""
+Log-structured storage backend: descriptors (metadata and value), processed
+marks and deletions are appended as records to large segment files. An
+in-memory index maps selectors to record offsets; it is saved to an index
+file when segments are sealed and when the storage is closed, so that opening
+a storage only loads this file, then replays records that have been appended
+since it was saved.
+
+Space used by deleted descriptors is reclaimed by a background thread, which
+copies live records of mostly-dead sealed segments to the active segment,
+then removes them.
+"""
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from collections import namedtuple
+from collections import OrderedDict
+from collections import Counter
+from rebus.storage import Storage, add_gc_arguments, regex_literal_prefix
+from rebus.storage import append_state_delta, read_state_deltas, \
+    write_state_file, resolve_ancestry
+from rebus.tools.lrucache import LRUCache
+from rebus.descriptor import Descriptor
+from rebus.tools.serializer import picklev2 as store_serializer
+log = logging.getLogger("rebus.storage.segmentstorage")
+
+#: Record header: record type, payload length, payload CRC32. The payload is
+#: a sequence of fields, each preceded by its length.
+HEADER = struct.Struct('<cII')
+FIELD = struct.Struct('<I')
+
+#: Record types
+#: descriptor: domain, selector, time added, value encoding, meta, value
+DESCRIPTOR = 'D'
+#: processed mark: domain, selector, agent name, configuration text
+PROCESSED = 'P'
+#: deleted descriptor: domain, selector
+DELETED = 'X'
+RECORD_TYPES = (DESCRIPTOR, PROCESSED, DELETED)
+
+#: Value encodings
+RAW = 'raw'
+SERIALIZED = ''
+
+#: Location and metadata of an indexed descriptor record. Offsets are
+#: relative to the beginning of the segment file.
+SegmentEntry = namedtuple('SegmentEntry', [
+    'segment', 'offset', 'length', 'meta_offset', 'meta_length',
+    'value_offset', 'value_length', 'raw', 'uuid', 'version', 'label',
+    'precursors', 'added'])
+
+
+def _iter_bucket(bucket, newest_first):
+    """
+    Generates (sort key, selector) couples from a bucket of
+    SegmentStorage.by_prefix, in order of addition, or in reverse order.
+    """
+    if newest_first:
+        for selector in reversed(bucket):
+            yield -bucket[selector], selector
+    else:
+        for selector, seq in bucket.iteritems():
+            yield seq, selector
+
+
+def read_record(fp):
+    """
+    Reads the record starting at the current position of fp.
+
+    Returns (record type, list of fields, list of field offsets relative to
+    the beginning of the record, record data), or None if the end of the file
+    has been reached or the record is incomplete or corrupted.
+    """
+    header = fp.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    rtype, length, crc = HEADER.unpack(header)
+    if rtype not in RECORD_TYPES:
+        return None
+    payload = fp.read(length)
+    if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+        return None
+    fields = []
+    offsets = []
+    pos = 0
+    while pos < length:
+        size, = FIELD.unpack_from(payload, pos)
+        pos += FIELD.size
+        offsets.append(HEADER.size + pos)
+        fields.append(payload[pos:pos+size])
+        pos += size
+    return rtype, fields, offsets, header + payload
+
+
+@Storage.register
+class SegmentStorage(Storage):
+    """
+    Append-only segment file storage of descriptor objects.
+    """
+
+    _name_ = "segmentstorage"
+    STORES_INTSTATE = True
+
+    #: Version of the index file format. Index files having another version
+    #: are ignored, and the index is rebuilt from segment files.
+    INDEX_FORMAT = 2
+
+    def __init__(self, options):
+        self.basepath = options.path.rstrip('/')
+
+        if not os.path.isdir(self.basepath):
+            raise IOError('Directory %s does not exist' % self.basepath)
+        for subdir in ('agent_intstate', 'segments'):
+            if not os.path.isdir(os.path.join(self.basepath, subdir)):
+                os.makedirs(os.path.join(self.basepath, subdir))
+
+        #: Segments are sealed once they have reached this size, in bytes
+        self.segment_size = options.segment_size
+        #: Sealed segments whose proportion of live bytes is lower than this
+        #: are compacted
+        self.compact_ratio = options.compact_ratio
+
+        #: Protects the index and segment files, which are accessed by the bus
+        #: thread, the compaction thread and the garbage collection thread
+        self.lock = threading.RLock()
+        #: Only one compaction runs at a time
+        self.compact_lock = threading.Lock()
+
+        #: self.entries['domain']['/selector/%hash'] is a SegmentEntry, in
+        #: order of addition
+        self.entries = defaultdict(OrderedDict)
+
+        #: self.by_prefix['domain']['/selector/'] maps '/selector/%hash' to
+        #: its sequence number, increasing with time of addition, in order of
+        #: addition
+        self.by_prefix = defaultdict(dict)
+        #: self.prefixes['domain'] is the sorted list of keys of
+        #: self.by_prefix['domain'], used for prefix range lookups
+        self.prefixes = defaultdict(list)
+        self.next_seq = 0
+
+        #: self.version_cache['domain']['/selector/'][42] = /selector/%1234
+        #: where 1234 is the hash of this selector's version 42
+        self.version_cache = defaultdict(lambda: defaultdict(dict))
+
+        #: self.edges['domain']['selectorA'] is a set of selectors of
+        #: descriptors that were spawned from selectorA.
+        self.edges = defaultdict(lambda: defaultdict(set))
+
+        #: self.ancestry['domain']['/selector/%hash'] is the ancestry summary
+        #: of this descriptor, see make_ancestry. Computed when descriptors
+        #: are added, or on first lookup for replayed descriptors.
+        self.ancestry = defaultdict(dict)
+
+        #: self.processed['domain']['/selector/%hash'] is a set of (agent name,
+        #: configuration text) that have finished processing, or declined to
+        #: process this descriptor.
+        self.processed = defaultdict(dict)
+
+        #: self.processed_counts['domain'][agent name] is the number of
+        #: selectors that have been processed by this agent, using any
+        #: configuration
+        self.processed_counts = defaultdict(Counter)
+
+        #: self.processable['domain']['/selector/%hash'] is a set of (agent
+        #: name, configuration text) that are running in interactive mode, and
+        #: are able to process this descriptor.
+        #: This attribute is not saved to disk.
+        self.processable = defaultdict(lambda: defaultdict(set))
+
+        #: self.live_bytes[segment] is the total size of records of this
+        #: segment that are still in use: descriptors that have not been
+        #: deleted, processed marks, and live deletion records
+        self.live_bytes = Counter()
+
+        #: self.tombstones[segment][offset] is the length of a deletion
+        #: record that is still in use: older segments, which may contain
+        #: the deleted descriptor record, still exist. Such records are kept
+        #: by compaction, so that deleted descriptors are not restored if the
+        #: index is rebuilt from segments.
+        self.tombstones = defaultdict(dict)
+
+        #: Recently used descriptors and values
+        self.cache = LRUCache(options.cache_bytes, options.cache_entries)
+
+        #: segment number -> file object used to read records
+        self.readers = {}
+        #: file object used to append records to the active segment, None if
+        #: it has not been opened yet
+        self.writer = None
+        #: if True, appended records are not flushed individually
+        self.deferred_flush = False
+        #: number and size of the segment records are appended to
+        self.active = 0
+        self.active_size = 0
+
+        #: counters of compactions and reclaimed bytes
+        self.compact_stats = Counter()
+
+        #: Garbage collection: descriptors that expire according to retention
+        #: rules are deleted every gc_interval seconds, by a background thread.
+        self.retention = options.retention
+        self.gc_interval = options.gc_interval
+        self.gc_rate = options.gc_rate
+        #: counters of deleted descriptors and reclaimed bytes
+        self.gc_stats = Counter()
+
+        start = time.time()
+        replayed = self._load()
+        log.info("Loaded index of %d descriptors in %.2fs, %d records "
+                 "replayed", sum(len(e) for e in self.entries.values()),
+                 time.time() - start, replayed)
+
+        if options.compact_interval > 0:
+            t = threading.Thread(target=self._compact_loop,
+                                 args=(options.compact_interval,))
+            t.daemon = True
+            t.start()
+        if self.retention and self.gc_interval > 0:
+            t = threading.Thread(target=self._gc_loop)
+            t.daemon = True
+            t.start()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.basepath, 'segments', '%08d.seg' % segment)
+
+    def _list_segments(self):
+        """
+        Returns the sorted list of numbers of existing segments.
+        """
+        result = []
+        for fname in os.listdir(os.path.join(self.basepath, 'segments')):
+            name, ext = os.path.splitext(fname)
+            if ext == '.seg' and name.isdigit():
+                result.append(int(name))
+        return sorted(result)
+
+    def _load(self):
+        """
+        Loads the index file, then replays records that have been appended
+        to segments after it has been saved. The whole index is rebuilt from
+        segments if the index file is missing or unusable.
+        Returns the number of replayed records.
+        """
+        segment, offset = 0, 0
+        index_path = os.path.join(self.basepath, 'index')
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path, 'rb') as fp:
+                    index = store_serializer.loads(fp.read())
+                if index['format'] != self.INDEX_FORMAT:
+                    raise ValueError("unsupported index format %s" %
+                                     index['format'])
+            except Exception:
+                log.warning("Could not load index file, rebuilding index "
+                            "from segments", exc_info=1)
+            else:
+                segment, offset = index['position']
+                for domain, entries in index['entries'].items():
+                    for item in entries:
+                        self._index(domain, item[0], SegmentEntry(*item[1:]))
+                for domain, processed in index['processed'].items():
+                    for selector, keys in processed:
+                        for key in keys:
+                            self._add_processed(domain, selector, key)
+                for seg, tombstones in index['tombstones'].items():
+                    self.tombstones[seg].update(tombstones)
+                self.live_bytes.update(index['live_bytes'])
+
+        replayed = 0
+        segments = [s for s in self._list_segments() if s >= segment]
+        for seg in segments:
+            replayed += self._replay(seg, offset if seg == segment else 0)
+        if segment == 0 and offset == 0:
+            # deletion records are not kept by compaction: drop processed
+            # marks of descriptors that have been deleted
+            for domain, processed in self.processed.items():
+                for selector in processed.keys():
+                    if selector not in self.entries[domain]:
+                        self._remove_processed(domain, selector)
+        self._expire_tombstones()
+        if segments:
+            self.active = segments[-1]
+            self.active_size = os.path.getsize(self._segment_path(self.active))
+        else:
+            self.active = segment
+        return replayed
+
+    def _replay(self, segment, offset):
+        """
+        Applies records of segment, starting at offset, to the index.
+        Incomplete or corrupted records, which may have been written during a
+        crash, are truncated.
+        """
+        count = 0
+        with open(self._segment_path(segment), 'r+b') as fp:
+            fp.seek(offset)
+            while True:
+                record = read_record(fp)
+                if record is None:
+                    break
+                rtype, fields, offsets, data = record
+                self._apply(segment, offset, rtype, fields, offsets,
+                            len(data))
+                offset += len(data)
+                count += 1
+            fp.seek(0, os.SEEK_END)
+            if fp.tell() > offset:
+                log.warning("Truncating %d bytes of incomplete records from "
+                            "segment %d", fp.tell() - offset, segment)
+                fp.truncate(offset)
+        return count
+
+    def _apply(self, segment, offset, rtype, fields, offsets, length):
+        """
+        Updates the index according to a replayed record.
+        """
+        if rtype == DESCRIPTOR:
+            domain, selector, added, encoding, meta, _ = fields
+            if selector in self.entries[domain]:
+                # copy made by an interrupted compaction
+                return
+            desc = store_serializer.loads(meta)
+            self._index(domain, selector, SegmentEntry(
+                segment, offset, length, offset + offsets[4], len(meta),
+                offset + offsets[5], len(fields[5]), encoding == RAW,
+                desc['uuid'], desc['version'], desc['label'],
+                tuple(desc['precursors']), float(added)))
+            self.live_bytes[segment] += length
+        elif rtype == PROCESSED:
+            domain, selector, agent_name, config_txt = fields
+            if self._add_processed(domain, selector,
+                                   (agent_name, config_txt)):
+                self.live_bytes[segment] += length
+        elif rtype == DELETED:
+            domain, selector = fields
+            if selector in self.entries[domain]:
+                self._unindex(domain, selector)
+                self.tombstones[segment][offset] = length
+                self.live_bytes[segment] += length
+            else:
+                # processed marks may precede copied descriptor records
+                self._remove_processed(domain, selector)
+
+    def _index(self, domain, selector, entry):
+        self.entries[domain][selector] = entry
+        prefix = selector.split('%')[0]
+        by_prefix = self.by_prefix[domain]
+        if prefix not in by_prefix:
+            by_prefix[prefix] = OrderedDict()
+            bisect.insort(self.prefixes[domain], prefix)
+        by_prefix[prefix][selector] = self.next_seq
+        self.next_seq += 1
+        self.version_cache[domain][prefix][entry.version] = selector
+        for precursor in entry.precursors:
+            self.edges[domain][precursor].add(selector)
+        self.processed[domain].setdefault(selector, set())
+
+    def _unindex(self, domain, selector):
+        entry = self.entries[domain].pop(selector)
+        self.live_bytes[entry.segment] -= entry.length
+        prefix = selector.split('%')[0]
+        selectors = self.by_prefix[domain][prefix]
+        del selectors[selector]
+        if not selectors:
+            del self.by_prefix[domain][prefix]
+            prefixes = self.prefixes[domain]
+            del prefixes[bisect.bisect_left(prefixes, prefix)]
+        versions = self.version_cache[domain][prefix]
+        if versions.get(entry.version) == selector:
+            del versions[entry.version]
+        for precursor in entry.precursors:
+            self.edges[domain][precursor].discard(selector)
+        self.edges[domain].pop(selector, None)
+        self.ancestry[domain].pop(selector, None)
+        self._remove_processed(domain, selector)
+        self.processable[domain].pop(selector, None)
+        self.cache.discard(('meta', domain, selector))
+        self.cache.discard(('value', domain, selector))
+
+    def _remove_processed(self, domain, selector):
+        agent_names = set(name for name, _ in
+                          self.processed[domain].pop(selector, ()))
+        for agent_name in agent_names:
+            self.processed_counts[domain][agent_name] -= 1
+
+    def _add_processed(self, domain, selector, key):
+        """
+        Returns True if key had not already been marked as processed.
+        """
+        processed = self.processed[domain].setdefault(selector, set())
+        if key in processed:
+            return False
+        if not any(name == key[0] for name, _ in processed):
+            self.processed_counts[domain][key[0]] += 1
+        processed.add(key)
+        return True
+
+    def _expire_tombstones(self):
+        """
+        Deletion records of the oldest segment are no longer in use: the
+        records of descriptors they delete are in the same segment.
+        """
+        segments = self._list_segments()
+        for segment in self.tombstones.keys():
+            if not segments or segment <= segments[0]:
+                tombstones = self.tombstones.pop(segment)
+                self.live_bytes[segment] -= sum(tombstones.values())
+
+    def _save_index(self):
+        """
+        Atomically writes the index file. Records appended to segments before
+        this call do not have to be replayed when the storage is opened.
+        """
+        if self.writer is not None:
+            os.fsync(self.writer.fileno())
+        index = {
+            'format': self.INDEX_FORMAT,
+            'position': (self.active, self.active_size),
+            'entries': dict(
+                (domain, [(sel,) + tuple(entry) for sel, entry in
+                          entries.iteritems()])
+                for domain, entries in self.entries.iteritems()),
+            'processed': dict(
+                (domain, [(sel, list(keys)) for sel, keys in
+                          processed.iteritems() if keys])
+                for domain, processed in self.processed.iteritems()),
+            'tombstones': dict((seg, tombstones.items()) for seg, tombstones
+                               in self.tombstones.iteritems() if tombstones),
+            'live_bytes': dict(self.live_bytes),
+        }
+        index_path = os.path.join(self.basepath, 'index')
+        with open(index_path + '.tmp', 'wb') as fp:
+            fp.write(store_serializer.dumps(index))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(index_path + '.tmp', index_path)
+
+    def _append(self, rtype, fields):
+        """
+        Appends a record to the active segment.
+        Returns (segment, offset of the record, list of field offsets relative
+        to the segment, record length).
+        """
+        self._prepare_append()
+        offset = self.active_size
+        crc = 0
+        length = 0
+        offsets = []
+        for field in fields:
+            crc = zlib.crc32(FIELD.pack(len(field)), crc)
+            crc = zlib.crc32(field, crc)
+            offsets.append(offset + HEADER.size + length + FIELD.size)
+            length += FIELD.size + len(field)
+        self.writer.write(HEADER.pack(rtype, length, crc & 0xffffffff))
+        for field in fields:
+            self.writer.write(FIELD.pack(len(field)))
+            self.writer.write(field)
+        if not self.deferred_flush:
+            self.writer.flush()
+        self.active_size += HEADER.size + length
+        return self.active, offset, offsets, HEADER.size + length
+
+    def _append_raw(self, data):
+        """
+        Appends a record read from another segment to the active segment.
+        Returns (segment, offset of the record).
+        """
+        self._prepare_append()
+        offset = self.active_size
+        self.writer.write(data)
+        self.writer.flush()
+        self.active_size += len(data)
+        return self.active, offset
+
+    def _prepare_append(self):
+        """
+        Opens the active segment, sealing it first if it is full.
+        """
+        if self.active_size >= self.segment_size:
+            if self.writer is not None:
+                os.fsync(self.writer.fileno())
+                self.writer.close()
+                self.writer = None
+            self.active += 1
+            self.active_size = 0
+            # records of sealed segments never have to be replayed
+            self._save_index()
+        if self.writer is None:
+            self.writer = open(self._segment_path(self.active), 'ab')
+
+    def _read(self, segment, offset, length):
+        if segment == self.active and self.deferred_flush and \
+                self.writer is not None:
+            self.writer.flush()
+        fp = self.readers.get(segment)
+        if fp is None:
+            fp = open(self._segment_path(segment), 'rb')
+            self.readers[segment] = fp
+        fp.seek(offset)
+        return fp.read(length)
+
+    def _close_files(self):
+        if self.writer is not None:
+            os.fsync(self.writer.fileno())
+            self.writer.close()
+            self.writer = None
+        for fp in self.readers.values():
+            fp.close()
+        self.readers.clear()
+
+    def _entry(self, domain, selector):
+        """
+        Returns (/selector/%hash, SegmentEntry), or (None, None) if selector
+        is not known.
+        """
+        selector = self._version_lookup(domain, selector)
+        entry = self.entries[domain].get(selector) if selector else None
+        if entry is None:
+            return None, None
+        return selector, entry
+
+    def _version_lookup(self, domain, selector):
+        """
+        :param selector: selector, containing either a version (/selector/~12)
+        or a hash (/selector/%1234)
+        Perform version lookup if needed.
+        Returns a selector containing a hash value /selector/%1234
+        """
+        # if version is specified, but no hash
+        if '%' not in selector and '~' in selector:
+            selprefix, version = selector.split('~')
+            try:
+                intversion = int(version)
+                if intversion < 0:
+                    maxversion = max(self.version_cache[domain][selprefix])
+                    intversion = maxversion + intversion + 1
+                selector = self.version_cache[domain][selprefix][intversion]
+            except (KeyError, ValueError):
+                # ValueError: invalid version integer
+                # KeyError: unknown version
+                selector = None
+        return selector
+
+    def _descriptor(self, domain, selector, entry):
+        desc = self.cache.get(('meta', domain, selector))
+        if desc is not None:
+            return desc
+        meta = self._read(entry.segment, entry.meta_offset, entry.meta_length)
+        desc = Descriptor.unserialize(store_serializer, meta, trusted=True)
+        self.cache.put(('meta', domain, selector), desc, len(meta))
+        return desc
+
+    def _value(self, domain, selector, entry):
+        value = self.cache.get(('value', domain, selector))
+        if value is not None:
+            return value
+        data = self._read(entry.segment, entry.value_offset,
+                          entry.value_length)
+        if entry.raw:
+            value = data
+        else:
+            value = Descriptor.unserialize_value(store_serializer, data)
+        self.cache.put(('value', domain, selector), value, len(data))
+        return value
+
+    def _list_prefix(self, domain, selector_prefix, newest_first=False,
+                     count=0):
+        """
+        Must be called with self.lock held. Returns selectors starting with
+        selector_prefix, in order of addition or in reverse order; at most
+        count of them unless count is 0.
+        """
+        by_prefix = self.by_prefix.get(domain, {})
+        if '%' in selector_prefix:
+            buckets = [by_prefix.get(selector_prefix.split('%')[0], {})]
+        else:
+            prefixes = self.prefixes.get(domain, [])
+            start = bisect.bisect_left(prefixes, selector_prefix)
+            buckets = []
+            for prefix in prefixes[start:]:
+                if not prefix.startswith(selector_prefix):
+                    break
+                buckets.append(by_prefix[prefix])
+        lists = [_iter_bucket(bucket, newest_first) for bucket in buckets]
+        selectors = (selector for _, selector in heapq.merge(*lists)
+                     if selector.startswith(selector_prefix))
+        return list(itertools.islice(selectors, count or None))
+
+    def find(self, domain, selector_regex, limit=0, offset=0):
+        regex = re.compile(selector_regex)
+        with self.lock:
+            selectors = self._list_prefix(
+                domain, regex_literal_prefix(selector_regex),
+                newest_first=True)
+        matches = (sel for sel in selectors if regex.match(sel))
+        return list(itertools.islice(matches, offset,
+                                     offset + limit if limit else None))
+
+    def find_by_selector(self, domain, selector_prefix, limit=0, offset=0):
+        with self.lock:
+            selectors = self._list_prefix(domain, selector_prefix,
+                                          count=offset + limit if limit else 0)
+        result = []
+        # descriptors are read one at a time, so that the storage is not
+        # locked during the whole lookup
+        for selector in selectors[offset:]:
+            with self.lock:
+                entry = self.entries[domain].get(selector)
+                if entry is None:
+                    # deleted by the garbage collector
+                    continue
+                result.append(self._descriptor(domain, selector, entry))
+        return result
+
+    def find_by_uuid(self, domain, uuid):
+        with self.lock:
+            return [self._descriptor(domain, selector, entry) for
+                    selector, entry in self.entries.get(domain, {}).iteritems()
+                    if entry.uuid == uuid]
+
+    def find_by_value(self, domain, selector_prefix, value_regex, limit=0,
+                      offset=0):
+        regex = re.compile(value_regex)
+        with self.lock:
+            # serialized values are not str
+            entries = self.entries.get(domain, {})
+            candidates = [selector for selector in
+                          self._list_prefix(domain, selector_prefix)
+                          if entries[selector].raw]
+        matches = (desc for desc in (self._match_value(domain, selector, regex)
+                                     for selector in candidates)
+                   if desc is not None)
+        return list(itertools.islice(matches, offset,
+                                     offset + limit if limit else None))
+
+    def _match_value(self, domain, selector, regex):
+        """
+        Returns the descriptor of selector if its value matches regex, else
+        None.
+        """
+        with self.lock:
+            entry = self.entries[domain].get(selector)
+            if entry is None:
+                # deleted by the garbage collector
+                return None
+            if regex.match(self._value(domain, selector, entry)):
+                return self._descriptor(domain, selector, entry)
+
+    def list_uuids(self, domain):
+        result = dict()
+        with self.lock:
+            for entry in self.entries.get(domain, {}).itervalues():
+                # Heuristic for choosing uuid label : prefer label of a
+                # descriptor that has no precursor
+                if entry.uuid not in result or not entry.precursors:
+                    result[entry.uuid] = entry.label
+        return result
+
+    def get_descriptor(self, domain, selector):
+        with self.lock:
+            selector, entry = self._entry(domain, selector)
+            if entry is None:
+                return None
+            return self._descriptor(domain, selector, entry)
+
+    def get_value(self, domain, selector):
+        with self.lock:
+            selector, entry = self._entry(domain, selector)
+            if entry is None:
+                return None
+            return self._value(domain, selector, entry)
+
+    def _list_children(self, domain, selector):
+        with self.lock:
+            return list(self.edges[domain].get(selector, ()))
+
+    def _list_precursors(self, domain, selector):
+        with self.lock:
+            entry = self.entries[domain].get(selector)
+            if entry is None:
+                return []
+            return entry.precursors
+
+    def get_ancestry(self, domain, selector):
+        entries = self.entries[domain]
+
+        def list_precursors(sel):
+            entry = entries.get(sel)
+            if entry is None:
+                return None
+            return entry.precursors
+        with self.lock:
+            return resolve_ancestry(selector, self.ancestry[domain].get,
+                                    list_precursors,
+                                    self.ancestry[domain].__setitem__)
+
+    def add(self, descriptor):
+        selector = descriptor.selector
+        domain = descriptor.domain
+        value = descriptor.value
+        with self.lock:
+            if selector in self.entries[domain]:
+                return False
+            if isinstance(value, str):
+                encoding = RAW
+            else:
+                encoding = SERIALIZED
+                value = descriptor.serialize_value(store_serializer)
+            meta = descriptor.serialize_meta(store_serializer)
+            added = time.time()
+            segment, offset, offsets, length = self._append(
+                DESCRIPTOR, [domain, selector, repr(added), encoding, meta,
+                             value])
+            self._index(domain, selector, SegmentEntry(
+                segment, offset, length, offsets[4], len(meta), offsets[5],
+                len(value), encoding == RAW, descriptor.uuid,
+                descriptor.version, descriptor.label,
+                tuple(descriptor.precursors), added))
+            self.live_bytes[segment] += length
+            self.get_ancestry(domain, selector)
+        return True
+
+    def mark_processed(self, domain, selector, agent_name, config_txt):
+        key = (agent_name, config_txt)
+        with self.lock:
+            if selector not in self.entries[domain]:
+                # deleted by the garbage collector
+                return False
+            result = self._add_processed(domain, selector, key)
+            if result:
+                segment, _, _, length = self._append(
+                    PROCESSED, [domain, selector, agent_name, config_txt])
+                self.live_bytes[segment] += length
+            # Remove from processable
+            if key in self.processable[domain].get(selector, ()):
+                result = False
+                self.processable[domain][selector].discard(key)
+        return result
+
+    def mark_processable(self, domain, selector, agent_name, config_txt):
+        result = False
+        key = (agent_name, config_txt)
+        with self.lock:
+            if selector not in self.entries[domain]:
+                return False
+            if key not in self.processable[domain][selector]:
+                self.processable[domain][selector].add(key)
+                if key not in self.processed[domain].get(selector, ()):
+                    # avoid case where two instances of an agent run in
+                    # different modes
+                    result = True
+        return result
+
+    def get_processed(self, domain, selector):
+        with self.lock:
+            return set(self.processed[domain].get(selector, ()))
+
+    def get_processable(self, domain, selector):
+        with self.lock:
+            return set(self.processable[domain].get(selector, ()))
+
+    def processed_stats(self, domain):
+        with self.lock:
+            return sorted(item for item in
+                          self.processed_counts[domain].items()
+                          if item[1] > 0), len(self.entries.get(domain, {}))
+
+    def list_unprocessed_by_agent(self, agent_name, config_txt):
+        return list(self.iter_unprocessed_by_agent(agent_name, config_txt))
+
+    def iter_unprocessed_by_agent(self, agent_name, config_txt):
+        with self.lock:
+            # Selectors known when this method is called
+            selectors = [(domain, entries.keys()) for domain, entries in
+                         self.entries.items()]
+        return self._iter_unprocessed(selectors, (agent_name, config_txt))
+
+    def _iter_unprocessed(self, selectors, name_config):
+        for domain, domain_selectors in selectors:
+            for sel in domain_selectors:
+                with self.lock:
+                    entry = self.entries[domain].get(sel)
+                    if entry is None:
+                        # deleted by the garbage collector
+                        continue
+                    if name_config in self.processed[domain].get(sel, ()):
+                        continue
+                yield (domain, entry.uuid, sel)
+
+    def _compact_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.compact()
+            except Exception:
+                log.error("Segment compaction failed", exc_info=1)
+
+    def compact(self):
+        """
+        Rewrites sealed segments whose proportion of live bytes is lower than
+        compact_ratio: their live records are appended to the active segment,
+        the index is saved, then these segments are removed.
+
+        Returns the number of reclaimed bytes.
+        """
+        with self.compact_lock:
+            with self.lock:
+                candidates = [
+                    seg for seg in self._list_segments() if seg != self.active
+                    and self.live_bytes[seg] < self.compact_ratio *
+                    os.path.getsize(self._segment_path(seg))]
+            if not candidates:
+                return 0
+            copied = 0
+            for segment in candidates:
+                copied += self._copy_live_records(segment)
+            reclaimed = 0
+            with self.lock:
+                # copies must be indexed before segments are removed
+                self._save_index()
+                for segment in candidates:
+                    fp = self.readers.pop(segment, None)
+                    if fp is not None:
+                        fp.close()
+                    path = self._segment_path(segment)
+                    reclaimed += os.path.getsize(path)
+                    os.remove(path)
+                    del self.live_bytes[segment]
+                    self.tombstones.pop(segment, None)
+                self._expire_tombstones()
+            reclaimed -= copied
+            self.compact_stats.update(runs=1, segments=len(candidates),
+                                      bytes_reclaimed=reclaimed)
+            log.info("Compaction: removed %d segments, reclaimed %d bytes",
+                     len(candidates), reclaimed)
+            return reclaimed
+
+    def _copy_live_records(self, segment):
+        """
+        Appends records of segment that are still in use to the active
+        segment. Returns the number of copied bytes.
+        """
+        copied = 0
+        # sealed segments are never modified, and may be read without holding
+        # the lock
+        with open(self._segment_path(segment), 'rb') as fp:
+            offset = 0
+            while True:
+                record = read_record(fp)
+                if record is None:
+                    break
+                rtype, fields, _, data = record
+                with self.lock:
+                    if rtype == DESCRIPTOR:
+                        domain, selector = fields[:2]
+                        entry = self.entries[domain].get(selector)
+                        if entry is not None and entry.segment == segment \
+                                and entry.offset == offset:
+                            newseg, newoff = self._append_raw(data)
+                            delta = newoff - offset
+                            self.entries[domain][selector] = entry._replace(
+                                segment=newseg, offset=newoff,
+                                meta_offset=entry.meta_offset + delta,
+                                value_offset=entry.value_offset + delta)
+                            self.live_bytes[segment] -= len(data)
+                            self.live_bytes[newseg] += len(data)
+                            copied += len(data)
+                    elif rtype == PROCESSED:
+                        domain, selector, agent_name, config_txt = fields
+                        if (agent_name, config_txt) in \
+                                self.processed[domain].get(selector, ()):
+                            newseg, _ = self._append_raw(data)
+                            self.live_bytes[segment] -= len(data)
+                            self.live_bytes[newseg] += len(data)
+                            copied += len(data)
+                    elif rtype == DELETED:
+                        domain, selector = fields
+                        tombstones = self.tombstones.get(segment, {})
+                        if tombstones.pop(offset, None) is not None:
+                            self.live_bytes[segment] -= len(data)
+                            # deletion records become useless once the
+                            # descriptor has been added again
+                            if selector not in self.entries[domain]:
+                                newseg, newoff = self._append_raw(data)
+                                self.tombstones[newseg][newoff] = len(data)
+                                self.live_bytes[newseg] += len(data)
+                                copied += len(data)
+                offset += len(data)
+        return copied
+
+    def _gc_loop(self):
+        while True:
+            time.sleep(self.gc_interval)
+            try:
+                self.collect_garbage()
+            except Exception:
+                log.error("Garbage collection failed", exc_info=1)
+
+    def collect_garbage(self, dry_run=False):
+        report = {'descriptors': 0, 'blobs': 0, 'bytes': 0, 'rules': {}}
+        start = time.time()
+        with self.lock:
+            domains = self.entries.keys()
+        for domain in domains:
+            expired = set()
+            for rule in self.retention:
+                if not rule.applies_to(domain):
+                    continue
+                with self.lock:
+                    selectors = set(rule.expired(
+                        self._retention_records(domain, rule.prefix), start))
+                report['rules'][str(rule)] = \
+                    report['rules'].get(str(rule), 0) + len(selectors)
+                expired |= selectors
+            for selector in expired:
+                with self.lock:
+                    entry = self.entries[domain].get(selector)
+                    if entry is None:
+                        continue
+                    report['descriptors'] += 1
+                    report['bytes'] += entry.value_length
+                    if dry_run:
+                        continue
+                    # space is reclaimed when the segment is compacted
+                    segment, offset, _, length = self._append(
+                        DELETED, [domain, selector])
+                    self.tombstones[segment][offset] = length
+                    self.live_bytes[segment] += length
+                    self._unindex(domain, selector)
+                self._gc_throttle(start, report['descriptors'])
+        if not dry_run:
+            self.gc_stats.update(runs=1, descriptors=report['descriptors'],
+                                 bytes_reclaimed=report['bytes'])
+            log.info("Garbage collection: deleted %d descriptors, %d bytes "
+                     "will be reclaimed by compaction", report['descriptors'],
+                     report['bytes'])
+        return report
+
+    def _retention_records(self, domain, prefix):
+        for selector in self._list_prefix(domain, prefix, newest_first=True):
+            entry = self.entries[domain][selector]
+            yield (selector, entry.uuid, entry.version, entry.added,
+                   entry.value_length)
+
+    def _gc_throttle(self, start, deleted):
+        """
+        Sleeps so that at most gc_rate descriptors are deleted per second.
+        """
+        if self.gc_rate > 0:
+            delay = start + float(deleted) / self.gc_rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def store_agent_state(self, agent_name, state):
+        fname = os.path.join(self.basepath, 'agent_intstate', agent_name +
+                             '.intstate')
+        write_state_file(fname, state)
+
+    def append_agent_state(self, agent_name, delta):
+        fname = os.path.join(self.basepath, 'agent_intstate', agent_name +
+                             '.intstate.deltas')
+        append_state_delta(fname, delta)
+
+    def load_agent_state_deltas(self, agent_name, position=0,
+                                max_bytes=1 << 20):
+        fname = os.path.join(self.basepath, 'agent_intstate', agent_name +
+                             '.intstate.deltas')
+        return read_state_deltas(fname, position, max_bytes)
+
+    def load_agent_state(self, agent_name):
+        fname = os.path.join(self.basepath, 'agent_intstate', agent_name +
+                             '.intstate')
+        if not os.path.isfile(fname):
+            return ""
+        with open(fname, 'rb') as fp:
+            return fp.read()
+
+    def list_agent_states(self):
+        names = set()
+        for fname in os.listdir(os.path.join(self.basepath,
+                                             'agent_intstate')):
+            for suffix in ('.intstate', '.intstate.deltas'):
+                if fname.endswith(suffix):
+                    names.add(fname[:-len(suffix)])
+        return list(names)
+
+    def list_domains(self):
+        with self.lock:
+            return [domain for domain, entries in self.entries.items()
+                    if entries]
+
+    def iter_selectors(self, domain):
+        with self.lock:
+            selectors = list(self.entries.get(domain, ()))
+        return iter(selectors)
+
+    @contextmanager
+    def bulk_load(self):
+        with self.lock:
+            self.deferred_flush = True
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.deferred_flush = False
+                if self.writer is not None:
+                    self.writer.flush()
+
+    def store_state(self):
+        with self.lock:
+            self._save_index()
+            # files are reopened if the storage is used again
+            self._close_files()
+        log.info("Storage statistics: %s", ', '.join(
+            '%s=%s' % item for item in sorted(self.storage_stats().items())))
+
+    def storage_stats(self):
+        with self.lock:
+            segments = self._list_segments()
+            size = sum(os.path.getsize(self._segment_path(seg))
+                       for seg in segments)
+            stats = {
+                'segments': len(segments),
+                'segment_bytes': size,
+                'live_bytes': sum(self.live_bytes[seg] for seg in segments),
+            }
+        for k, v in self.cache.stats().items():
+            stats['cache_' + k] = v
+        for k in ('runs', 'segments', 'bytes_reclaimed'):
+            stats['compact_' + k] = self.compact_stats[k]
+        for k in ('runs', 'descriptors', 'bytes_reclaimed'):
+            stats['gc_' + k] = self.gc_stats[k]
+        return stats
+
+    @staticmethod
+    def add_arguments(subparser):
+        subparser.add_argument(
+            "--path", help="Segment storage path (defaults to "
+            "/tmp/rebus-segments)", default="/tmp/rebus-segments")
+        subparser.add_argument(
+            "--segment-size", type=int, default=256 * 1024 * 1024,
+            help="Size in bytes above which the active segment file is "
+            "sealed, and a new one is started (defaults to 256 MiB)")
+        subparser.add_argument(
+            "--compact-interval", type=int, default=300,
+            help="Delay between background compactions of sealed segments, "
+            "in seconds. 0 disables compaction (defaults to 300)")
+        subparser.add_argument(
+            "--compact-ratio", type=float, default=0.5,
+            help="Sealed segments in which the proportion of bytes used by "
+            "live records is lower than this are compacted (defaults to 0.5)")
+        subparser.add_argument(
+            "--cache-bytes", type=int, default=64 * 1024 * 1024,
+            help="Maximum total size of descriptors and values kept in the "
+            "in-memory cache, in bytes. 0 disables the cache (defaults to "
+            "64 MiB)")
+        subparser.add_argument(
+            "--cache-entries", type=int, default=10000,
+            help="Maximum number of descriptors and values kept in the "
+            "in-memory cache (defaults to 10000)")
+        add_gc_arguments(subparser)
@@ -0,0 +1,576 @@
+import hashlib
+import itertools
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from collections import Counter
+from rebus.storage import Storage, MetadataDB, BlobStore, add_gc_arguments
+from rebus.tools.trigram import trigrams, regex_trigrams
+from rebus.descriptor import Descriptor
+from rebus.tools.serializer import picklev2 as store_serializer
+log = logging.getLogger("rebus.storage.sqlitestorage")
+
+
+class ValueDB(MetadataDB):
+    """
+    MetadataDB that also contains descriptor values, as BLOBs identified by
+    the same references as BlobStore blobs, and the internal state of agents.
+    """
+
+    def __init__(self, db_path, commit_interval=0, commit_rows=1000):
+        super(ValueDB, self).__init__(db_path, commit_interval, commit_rows)
+        with self._dblock:
+            #: blob_data(ref, data): values that are stored in the database
+            #: rather than in a BlobStore
+            self._cursor.execute(
+                'CREATE TABLE IF NOT EXISTS blob_data(ref TEXT PRIMARY KEY, '
+                'data BLOB)')
+            self._cursor.execute(
+                'CREATE TABLE IF NOT EXISTS intstate(agent_name TEXT PRIMARY '
+                'KEY, state BLOB)')
+            #: intstate_deltas(id, agent_name, delta): changes appended to
+            #: the internal state of agent_name, in id order
+            self._cursor.execute(
+                'CREATE TABLE IF NOT EXISTS intstate_deltas(id INTEGER '
+                'PRIMARY KEY, agent_name TEXT, delta BLOB)')
+            self._cursor.execute(
+                'CREATE INDEX IF NOT EXISTS intstate_deltas_by_agent ON '
+                'intstate_deltas(agent_name, id)')
+            self._db.commit()
+
+    def add_descriptor_value(self, desc, meta, ref, size, data=None):
+        """
+        Adds a descriptor to the metadata index, together with its value.
+        Returns False if it was already present.
+
+        :param ref: reference of the value
+        :param size: size of the value
+        :param data: value, if it is to be stored in the database. Else it
+            must already have been stored in a BlobStore.
+        """
+        with self._dblock:
+            if self.has_descriptor(desc.domain, desc.selector):
+                return False
+            if data is not None:
+                self._cursor.execute(
+                    'INSERT OR IGNORE INTO blob_data(ref, data) VALUES (?, ?)',
+                    (ref, sqlite3.Binary(data)))
+            self.add_blob(ref, size, size)
+            return self.add_descriptor(desc, meta, ref)
+
+    def get_blob_data(self, ref):
+        """
+        Returns a value stored in the database, None if it is stored
+        elsewhere.
+        """
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT data FROM blob_data WHERE ref=?', (ref,)).fetchone()
+        if res is None:
+            return None
+        return str(res[0])
+
+    def remove_blob(self, ref):
+        with self._dblock:
+            if not super(ValueDB, self).remove_blob(ref):
+                return False
+            self._cursor.execute('DELETE FROM blob_data WHERE ref=?', (ref,))
+            self._written()
+            return True
+
+    def inline_stats(self):
+        """
+        Returns (number of values stored in the database, their total size).
+        """
+        with self._dblock:
+            count, size = self._cursor.execute(
+                'SELECT COUNT(1), SUM(LENGTH(data)) FROM blob_data'
+            ).fetchone()
+        return count, size or 0
+
+    def set_intstate(self, agent_name, state):
+        with self._dblock:
+            self._cursor.execute(
+                'INSERT OR REPLACE INTO intstate(agent_name, state) '
+                'VALUES (?, ?)', (agent_name, sqlite3.Binary(state)))
+            self._cursor.execute(
+                'DELETE FROM intstate_deltas WHERE agent_name=?',
+                (agent_name,))
+            self._commit()
+
+    def append_intstate_delta(self, agent_name, delta):
+        with self._dblock:
+            self._cursor.execute(
+                'INSERT INTO intstate_deltas(agent_name, delta) VALUES (?, ?)',
+                (agent_name, sqlite3.Binary(delta)))
+            self._commit()
+
+    def get_intstate_deltas(self, agent_name, last_id, max_bytes):
+        """
+        Returns (deltas, id of the last returned delta) of deltas appended
+        after last_id, until more than max_bytes have been read.
+        """
+        deltas = []
+        size = 0
+        with self._dblock:
+            rows = self._cursor.execute(
+                'SELECT id, delta FROM intstate_deltas WHERE agent_name=? AND '
+                'id>? ORDER BY id', (agent_name, last_id))
+            for last_id, delta in rows:
+                deltas.append(str(delta))
+                size += len(delta)
+                if size > max_bytes:
+                    break
+        return deltas, last_id
+
+    def get_intstate(self, agent_name):
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT state FROM intstate WHERE agent_name=?',
+                (agent_name,)).fetchone()
+        if res is None:
+            return ""
+        return str(res[0])
+
+    def list_intstates(self):
+        with self._dblock:
+            res = self._cursor.execute(
+                'SELECT agent_name FROM intstate UNION '
+                'SELECT agent_name FROM intstate_deltas').fetchall()
+        return [str(agent_name) for (agent_name,) in res]
+
+
+@Storage.register
+class SQLiteStorage(Storage):
+    """
+    Storage of descriptor objects, values and agents' internal state in a
+    single sqlite3 database. Values larger than out_of_line_size may be
+    stored in files instead.
+    """
+
+    _name_ = "sqlitestorage"
+    STORES_INTSTATE = True
+
+    #: Extension of references of raw str values, which are not serialized
+    RAW_EXT = 'raw'
+
+    #: Delay between two lookups of values to be indexed by trigrams, in
+    #: seconds, when the index is up to date
+    TRIGRAM_INDEX_INTERVAL = 1
+
+    def __init__(self, options):
+        self.basepath = options.path.rstrip('/')
+
+        if not os.path.isdir(self.basepath):
+            raise IOError('Directory %s does not exist' % self.basepath)
+
+        #: self.processable['domain']['/selector/%hash'] is a set of (agent
+        #: name, configuration text) that are running in interactive mode, and
+        #: are able to process this descriptor.
+        #: This attribute is not saved to disk.
+        self.processable = defaultdict(lambda: defaultdict(set))
+
+        # Descriptor metadata is stored in indexed columns, values in a
+        # separate table, so that scanning metadata does not read values.
+        self.db = ValueDB(
+            os.path.join(self.basepath, 'sqlitestorage.sqlite3'),
+            options.commit_interval / 1000., options.commit_rows)
+
+        #: Values larger than this number of bytes are stored in self.blobs,
+        #: 0 stores all values in the database
+        self.out_of_line_size = options.out_of_line_size
+        self.blobs = BlobStore(os.path.join(self.basepath, '_values'))
+
+        #: Raw values up to this size are added to the trigram index by a
+        #: background thread; 0 disables indexing
+        self.trigram_max_size = options.trigram_max_size
+
+        #: Garbage collection: descriptors that expire according to retention
+        #: rules are deleted every gc_interval seconds, by a background thread.
+        self.retention = options.retention
+        self.gc_interval = options.gc_interval
+        self.gc_rate = options.gc_rate
+        #: counters of deleted descriptors, removed values and reclaimed bytes
+        self.gc_stats = Counter()
+        #: Prevents values stored in files from being reclaimed while they
+        #: are being referenced by new descriptors
+        self.gc_lock = threading.Lock()
+        if self.retention and self.gc_interval > 0:
+            t = threading.Thread(target=self._gc_loop)
+            t.daemon = True
+            t.start()
+        if self.trigram_max_size > 0:
+            t = threading.Thread(target=self._index_loop)
+            t.daemon = True
+            t.start()
+
+    def _descriptors_from_metas(self, metas):
+        return [Descriptor.unserialize(store_serializer, meta, trusted=True)
+                for meta in metas]
+
+    def find(self, domain, selector_regex, limit=0, offset=0):
+        return self.db.find(domain, selector_regex, limit, offset)
+
+    def find_by_selector(self, domain, selector_prefix, limit=0, offset=0):
+        return self._descriptors_from_metas(
+            self.db.find_by_selector(domain, selector_prefix, limit, offset))
+
+    def find_by_uuid(self, domain, uuid):
+        return self._descriptors_from_metas(
+            self.db.list_metas_by_uuid(domain, uuid))
+
+    def find_by_value(self, domain, selector_prefix, value_regex, limit=0,
+                      offset=0):
+        matches = self.iter_find_by_value(domain, selector_prefix,
+                                          value_regex)
+        return list(itertools.islice(matches, offset,
+                                     offset + limit if limit else None))
+
+    def iter_find_by_value(self, domain, selector_prefix, value_regex):
+        """
+        Generates descriptors matching find_by_value criteria, from oldest to
+        newest. Candidates are selected using the value trigram index, then
+        verified; each value is verified once, even if several descriptors
+        share it.
+        """
+        regex = re.compile(value_regex)
+        candidates = self.db.iter_value_candidates(
+            domain, selector_prefix, regex_trigrams(value_regex))
+        #: value_ref -> True if value matches
+        verified = {}
+        for selector, value_ref in candidates:
+            if value_ref not in verified:
+                # serialized values are not str
+                data = None
+                if self._is_raw(value_ref):
+                    data = self._get_data(value_ref)
+                verified[value_ref] = data is not None and \
+                    regex.match(data) is not None
+            if verified[value_ref]:
+                desc = self.get_descriptor(domain, selector)
+                if desc:
+                    yield desc
+
+    def list_uuids(self, domain):
+        return self.db.list_uuids(domain)
+
+    def _version_lookup(self, domain, selector):
+        """
+        :param selector: selector, containing either a version (/selector/~12)
+        or a hash (/selector/%1234)
+        Perform version lookup if needed.
+        Returns a selector containing a hash value /selector/%1234
+        """
+        # if version is specified, but no hash
+        if '%' not in selector and '~' in selector:
+            selprefix, version = selector.split('~')
+            try:
+                intversion = int(version)
+            except ValueError:
+                # invalid version integer
+                return None
+            selector = self.db.version_lookup(domain, selprefix, intversion)
+        return selector
+
+    def get_descriptor(self, domain, selector):
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+        meta = self.db.get_meta(domain, selector)
+        if meta is None:
+            return None
+        return Descriptor.unserialize(store_serializer, meta, trusted=True)
+
+    def _is_raw(self, value_ref):
+        return value_ref.endswith('.' + self.RAW_EXT)
+
+    def _get_data(self, value_ref):
+        data = self.db.get_blob_data(value_ref)
+        if data is None:
+            data = self.blobs.get(value_ref)
+        return data
+
+    def get_value(self, domain, selector):
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+        value_ref = self.db.get_value_ref(domain, selector)
+        if value_ref is None:
+            return None
+        data = self._get_data(value_ref)
+        if data is None or self._is_raw(value_ref):
+            return data
+        try:
+            return Descriptor.unserialize_value(store_serializer, data)
+        except:
+            log.warning("Could not unserialize value %s", value_ref)
+
+    def get_value_path(self, domain, selector):
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+        value_ref = self.db.get_value_ref(domain, selector)
+        if value_ref is None or not self._is_raw(value_ref) or \
+                self.db.get_blob_data(value_ref) is not None:
+            return None
+        return self.blobs.get_path(value_ref)
+
+    def _list_children(self, domain, selector):
+        return self.db.list_children(domain, selector)
+
+    def _list_precursors(self, domain, selector):
+        return self.db.list_precursors(domain, selector)
+
+    def get_ancestry(self, domain, selector):
+        return self.db.get_ancestry(domain, selector)
+
+    def add(self, descriptor):
+        if self.db.has_descriptor(descriptor.domain, descriptor.selector):
+            return False
+        file_value = descriptor.file_value
+        if file_value is not None and self.out_of_line_size and \
+                file_value.size() > self.out_of_line_size:
+            # copied by chunks, without being loaded in memory
+            meta = descriptor.serialize_meta(store_serializer)
+            tmpname, digest, size = self.blobs.spool(file_value.iter_chunks())
+            with self.gc_lock:
+                ref, _ = self.blobs.put_spooled(tmpname, digest, self.RAW_EXT)
+                return self.db.add_descriptor_value(descriptor, meta, ref,
+                                                    size)
+        value = descriptor.value
+        if isinstance(value, str):
+            data, ext = value, self.RAW_EXT
+        else:
+            data, ext = descriptor.serialize_value(store_serializer), None
+        meta = descriptor.serialize_meta(store_serializer)
+        if not self.out_of_line_size or len(data) <= self.out_of_line_size:
+            ref = hashlib.sha256(data).hexdigest()
+            if ext:
+                ref += '.' + ext
+            return self.db.add_descriptor_value(descriptor, meta, ref,
+                                                len(data), data)
+        with self.gc_lock:
+            ref, _ = self.blobs.put(data, ext)
+            return self.db.add_descriptor_value(descriptor, meta, ref,
+                                                len(data))
+
+    def _index_loop(self):
+        while True:
+            try:
+                if self._index_trigrams():
+                    continue
+            except Exception:
+                log.error("Trigram indexing failed", exc_info=1)
+            time.sleep(self.TRIGRAM_INDEX_INTERVAL)
+
+    def _index_trigrams(self, count=100):
+        """
+        Adds at most count values that have not been examined yet to the
+        trigram index. Only raw values up to trigram_max_size bytes are
+        indexed. Returns the number of examined values.
+        """
+        values = self.db.list_unindexed_blobs(count)
+        for value_ref, size in values:
+            value_trigrams = None
+            if self._is_raw(value_ref) and \
+                    (size is None or size <= self.trigram_max_size):
+                data = self._get_data(value_ref)
+                if data is not None and len(data) <= self.trigram_max_size:
+                    value_trigrams = trigrams(data)
+            self.db.add_trigrams(value_ref, value_trigrams)
+        return len(values)
+
+    def _gc_loop(self):
+        while True:
+            time.sleep(self.gc_interval)
+            try:
+                self.collect_garbage()
+            except Exception:
+                log.error("Garbage collection failed", exc_info=1)
+
+    def collect_garbage(self, dry_run=False):
+        report = {'descriptors': 0, 'blobs': 0, 'bytes': 0, 'rules': {}}
+        start = time.time()
+        #: value_ref -> number of expired descriptors referencing it
+        expired_refs = Counter()
+        for domain in self.db.list_domains():
+            expired = set()
+            for rule in self.retention:
+                if not rule.applies_to(domain):
+                    continue
+                records = self.db.iter_retention_records(domain, rule.prefix)
+                selectors = set(rule.expired(records, start))
+                report['rules'][str(rule)] = \
+                    report['rules'].get(str(rule), 0) + len(selectors)
+                expired |= selectors
+            for selector in expired:
+                if dry_run:
+                    value_ref = self.db.get_value_ref(domain, selector)
+                    if value_ref is not None:
+                        expired_refs[value_ref] += 1
+                else:
+                    self.db.delete_descriptor(domain, selector)
+                    self.processable[domain].pop(selector, None)
+                    self._gc_throttle(start, report['descriptors'])
+                report['descriptors'] += 1
+        if dry_run:
+            # values that are only referenced by expired descriptors
+            for value_ref, count in expired_refs.items():
+                refcount, size = self.db.blob_info(value_ref)
+                if refcount <= count:
+                    report['blobs'] += 1
+                    report['bytes'] += size or 0
+            return report
+        report['blobs'], report['bytes'] = self._reclaim_values()
+        self.db.flush()
+        self.gc_stats.update(runs=1, descriptors=report['descriptors'],
+                             blobs=report['blobs'],
+                             bytes_reclaimed=report['bytes'])
+        log.info("Garbage collection: deleted %d descriptors and %d values, "
+                 "reclaimed %d bytes", report['descriptors'], report['blobs'],
+                 report['bytes'])
+        return report
+
+    def _gc_throttle(self, start, deleted):
+        """
+        Sleeps so that at most gc_rate descriptors are deleted per second.
+        """
+        if self.gc_rate > 0:
+            delay = start + float(deleted) / self.gc_rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _reclaim_values(self):
+        """
+        Removes values that are not referenced anymore. Returns the number of
+        removed values and their total size.
+        """
+        count = 0
+        size = 0
+        for value_ref, value_size in self.db.list_orphan_blobs():
+            with self.gc_lock:
+                if not self.db.remove_blob(value_ref):
+                    continue
+                if os.path.exists(self.blobs.get_path(value_ref)):
+                    os.remove(self.blobs.get_path(value_ref))
+            count += 1
+            size += value_size
+        return count, size
+
+    def mark_processed(self, domain, selector, agent_name, config_txt):
+        result = self.db.add_processed(domain, selector, agent_name,
+                                       config_txt)
+        # Remove from processable
+        if selector in self.processable[domain]:
+            key = (agent_name, config_txt)
+            if key in self.processable[domain][selector]:
+                result = False
+                self.processable[domain][selector].discard(key)
+        return result
+
+    def mark_processable(self, domain, selector, agent_name, config_txt):
+        result = False
+        key = (agent_name, config_txt)
+        if not self.db.has_descriptor(domain, selector):
+            # deleted by the garbage collector
+            return False
+        if key not in self.processable[domain][selector]:
+            self.processable[domain][selector].add((agent_name, config_txt))
+            if not self.db.is_processed(
+                    domain, selector, agent_name, config_txt):
+                # avoid case where two instances of an agent run in
+                # different modes
+                result = True
+        return result
+
+    def get_processed(self, domain, selector):
+        return self.db.list_processed(domain, selector)
+
+    def get_processable(self, domain, selector):
+        return self.processable[domain].get(selector, set())
+
+    def processed_stats(self, domain):
+        return self.db.processed_stats(domain)
+
+    def store_agent_state(self, agent_name, state):
+        self.db.set_intstate(agent_name, state)
+
+    def load_agent_state(self, agent_name):
+        return self.db.get_intstate(agent_name)
+
+    def append_agent_state(self, agent_name, delta):
+        self.db.append_intstate_delta(agent_name, delta)
+
+    def load_agent_state_deltas(self, agent_name, position=0,
+                                max_bytes=1 << 20):
+        return self.db.get_intstate_deltas(agent_name, position, max_bytes)
+
+    def list_agent_states(self):
+        return self.db.list_intstates()
+
+    def list_domains(self):
+        return self.db.list_domains()
+
+    def iter_selectors(self, domain):
+        for _, selector in self.db.iter_descriptors(domain=domain):
+            yield selector
+
+    def bulk_load(self):
+        return self.db.deferred_commits()
+
+    def store_state(self):
+        self.db.flush()
+        log.info("Storage statistics: %s", ', '.join(
+            '%s=%s' % item for item in sorted(self.storage_stats().items())))
+
+    def storage_stats(self):
+        count, size, _ = self.db.blob_stats()
+        inline_count, inline_size = self.db.inline_stats()
+        stats = {
+            'values': count,
+            'value_bytes': size,
+            'inline_values': inline_count,
+            'inline_value_bytes': inline_size,
+        }
+        for k in ('runs', 'descriptors', 'blobs', 'bytes_reclaimed'):
+            stats['gc_' + k] = self.gc_stats[k]
+        return stats
+
+    def list_unprocessed_by_agent(self, agent_name, config_txt):
+        return list(self.iter_unprocessed_by_agent(agent_name, config_txt))
+
+    def iter_unprocessed_by_agent(self, agent_name, config_txt):
+        return self.db.iter_unprocessed_by_agent(agent_name, config_txt)
+
+    @staticmethod
+    def add_arguments(subparser):
+        subparser.add_argument(
+            "--path", help="Directory containing the database (defaults to "
+            "/tmp/rebus-sqlite)", default="/tmp/rebus-sqlite")
+        subparser.add_argument(
+            "--out-of-line-size", type=int, default=0,
+            help="Values larger than this number of bytes are stored in "
+            "files next to the database, and may be read by agents without "
+            "being copied through the bus. 0 stores all values in the "
+            "database (defaults to 0)")
+        subparser.add_argument(
+            "--commit-interval", type=int, default=100,
+            help="Maximum delay before database writes are committed, in "
+            "milliseconds. Writes performed during this interval may be lost "
+            "on crash. 0 commits every write (defaults to 100)")
+        subparser.add_argument(
+            "--commit-rows", type=int, default=1000,
+            help="Maximum number of uncommitted database writes (defaults to "
+            "1000)")
+        subparser.add_argument(
+            "--trigram-max-size", type=int, default=0,
+            help="Raw values up to this size, in bytes, are added to the "
+            "trigram index used to speed up value searches, by a background "
+            "thread. Larger values, and values containing too many distinct "
+            "trigrams, are always read when searching. 0 disables indexing "
+            "(defaults to 0)")
+        add_gc_arguments(subparser)
@@ -0,0 +1,225 @@
+"""
+Streaming archives of storage contents, used to move descriptors between
+storage backends or bus masters.
+
+An archive is a sequence of records, each made of a type byte, a payload
+length and a payload. A descriptor record (metadata) is followed by a value
+record, then by an optional processed record listing (agent name, config_txt)
+couples that have processed it. Agent internal state records, each followed
+by records of deltas that have been appended to this state, may follow. An
+end record, containing record counts, terminates the archive, so that
+truncated archives can be detected.
+
+Archives are written and read one record at a time: memory use is bounded by
+the size of the largest value.
+"""
+import os
+import struct
+from rebus.descriptor import Descriptor
+from rebus.tools.serializer import picklev2 as store_serializer
+
+MAGIC = 'REBUSARCHIVE1\n'
+
+#: (record type, payload length)
+HEADER = struct.Struct('<cQ')
+
+#: Record types
+DESCRIPTOR = 'D'
+RAW_VALUE = 'R'
+SERIALIZED_VALUE = 'S'
+PROCESSED = 'P'
+INTSTATE = 'I'
+INTSTATE_DELTA = 'J'
+END = 'E'
+
+#: Size of chunks used to copy value files
+COPY_CHUNK = 1 << 20
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class ArchiveWriter(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.counts = dict.fromkeys(('descriptors', 'processed', 'intstates',
+                                     'bytes'), 0)
+        self.fp.write(MAGIC)
+
+    def _record(self, rtype, payload):
+        self.fp.write(HEADER.pack(rtype, len(payload)))
+        self.fp.write(payload)
+
+    def add_descriptor(self, store, desc):
+        """
+        Writes desc, its value and processed marks, read from store.
+        Raw values stored in local files are copied by chunks.
+        """
+        domain, selector = desc.domain, desc.selector
+        self._record(DESCRIPTOR, desc.serialize_meta(store_serializer))
+        path = store.get_value_path(domain, selector)
+        if path is not None:
+            with open(path, 'rb') as vfp:
+                size = os.fstat(vfp.fileno()).st_size
+                self.fp.write(HEADER.pack(RAW_VALUE, size))
+                remaining = size
+                while remaining > 0:
+                    chunk = vfp.read(min(COPY_CHUNK, remaining))
+                    if not chunk:
+                        raise ArchiveError("%s has been truncated" % path)
+                    self.fp.write(chunk)
+                    remaining -= len(chunk)
+        else:
+            value = store.get_value(domain, selector)
+            if isinstance(value, str):
+                size = len(value)
+                self._record(RAW_VALUE, value)
+            else:
+                data = store_serializer.dumps(value)
+                size = len(data)
+                self._record(SERIALIZED_VALUE, data)
+        processed = list(store.get_processed(domain, selector))
+        if processed:
+            self._record(PROCESSED, store_serializer.dumps(processed))
+        self.counts['descriptors'] += 1
+        self.counts['processed'] += len(processed)
+        self.counts['bytes'] += size
+
+    def add_intstate(self, store, agent_name):
+        """
+        Writes the internal state of agent_name and its deltas, read from
+        store.
+        """
+        state = store.load_agent_state(agent_name)
+        self._record(INTSTATE, store_serializer.dumps((agent_name, state)))
+        position = 0
+        while True:
+            deltas, position = store.load_agent_state_deltas(agent_name,
+                                                             position)
+            if not deltas:
+                break
+            for delta in deltas:
+                self._record(INTSTATE_DELTA,
+                             store_serializer.dumps((agent_name, delta)))
+        self.counts['intstates'] += 1
+
+    def close(self):
+        """
+        Writes the end record and flushes. Does not close the file.
+        """
+        self._record(END, store_serializer.dumps(self.counts))
+        self.fp.flush()
+
+
+def _read_record(fp):
+    header = fp.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ArchiveError("Truncated archive")
+    rtype, length = HEADER.unpack(header)
+    payload = fp.read(length)
+    if len(payload) < length:
+        raise ArchiveError("Truncated archive")
+    return rtype, payload
+
+
+def iter_archive(fp):
+    """
+    Yields ('descriptor', desc, processed) where desc contains its value and
+    processed is a list of (agent_name, config_txt), ('intstate', agent_name,
+    state) and ('intstate_delta', agent_name, delta) records of an archive.
+    Raises ArchiveError if the archive is invalid or truncated.
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ArchiveError("Not a rebus archive")
+    rtype, payload = _read_record(fp)
+    while rtype != END:
+        if rtype == INTSTATE:
+            agent_name, state = store_serializer.loads(payload)
+            yield 'intstate', agent_name, state
+            rtype, payload = _read_record(fp)
+            continue
+        if rtype == INTSTATE_DELTA:
+            agent_name, delta = store_serializer.loads(payload)
+            yield 'intstate_delta', agent_name, delta
+            rtype, payload = _read_record(fp)
+            continue
+        if rtype != DESCRIPTOR:
+            raise ArchiveError("Unexpected record type %r" % rtype)
+        desc = Descriptor.unserialize(store_serializer, payload)
+        if desc is None:
+            raise ArchiveError("Invalid descriptor record")
+        rtype, payload = _read_record(fp)
+        if rtype == RAW_VALUE:
+            desc.value = payload
+        elif rtype == SERIALIZED_VALUE:
+            desc.value = store_serializer.loads(payload)
+        else:
+            raise ArchiveError("Missing value of %s" % desc.selector)
+        rtype, payload = _read_record(fp)
+        processed = []
+        if rtype == PROCESSED:
+            processed = store_serializer.loads(payload)
+            rtype, payload = _read_record(fp)
+        yield 'descriptor', desc, processed
+
+
+def export_storage(store, fp, domains=None, uuids=None, intstates=True):
+    """
+    Writes descriptors of store to fp. Returns record counts.
+
+    :param domains: list of domains to export. All domains if None.
+    :param uuids: if not None, only descriptors having one of these uuids
+        are exported
+    :param intstates: export internal states of agents
+    """
+    writer = ArchiveWriter(fp)
+    if domains is None:
+        domains = store.list_domains()
+    for domain in domains:
+        if uuids is None:
+            for selector in store.iter_selectors(domain):
+                desc = store.get_descriptor(domain, selector)
+                if desc is not None:
+                    # may have been deleted meanwhile
+                    writer.add_descriptor(store, desc)
+        else:
+            for uuid in uuids:
+                for desc in store.find_by_uuid(domain, uuid):
+                    writer.add_descriptor(store, desc)
+    if intstates:
+        for agent_name in store.list_agent_states():
+            writer.add_intstate(store, agent_name)
+    writer.close()
+    return writer.counts
+
+
+def import_storage(store, fp):
+    """
+    Adds descriptors, processed marks and agent internal states read from
+    fp to store. Descriptors that are already present are not replaced, but
+    their processed marks are added. Returns counts of imported records.
+    Raises ArchiveError if the archive is invalid or truncated; records read
+    until then have been imported.
+    """
+    counts = dict.fromkeys(('descriptors', 'existing', 'processed',
+                            'intstates'), 0)
+    with store.bulk_load():
+        for record in iter_archive(fp):
+            if record[0] == 'intstate':
+                store.store_agent_state(record[1], record[2])
+                counts['intstates'] += 1
+                continue
+            if record[0] == 'intstate_delta':
+                store.append_agent_state(record[1], record[2])
+                continue
+            _, desc, processed = record
+            if store.add(desc):
+                counts['descriptors'] += 1
+            else:
+                counts['existing'] += 1
+            for agent_name, config_txt in processed:
+                store.mark_processed(desc.domain, desc.selector, agent_name,
+                                     config_txt)
+            counts['processed'] += len(processed)
+    return counts
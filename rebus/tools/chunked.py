@@ -0,0 +1,344 @@
+"""
+Helpers to transfer large descriptor values between bus slaves and the bus
+master in fixed-size chunks, instead of a single message.
+
+Values are transferred either raw, when they are str, or serialized. Pushed
+values are written to a temporary file by the bus master as chunks arrive;
+fetched values are served by ranges, then reassembled by the slave. Both are
+checked against the sha256 digest of the transferred bytes.
+"""
+import hashlib
+import logging
+import tempfile
+import time
+import uuid as m_uuid
+from rebus.descriptor import FileValue
+from rebus.tools.lrucache import LRUCache
+from rebus.tools.serializer import picklev2 as value_serializer
+
+log = logging.getLogger("rebus.tools.chunked")
+
+#: Values larger than this size are transferred in chunks of this size
+CHUNK_SIZE = 1 << 20
+#: Incoming transfers that have not received any chunk for this many seconds
+#: are discarded
+TRANSFER_TIMEOUT = 3600
+
+
+def value_chunks(descriptor):
+    """
+    Returns (raw, size, chunks), where raw is True if the value of descriptor
+    is a str, which is transferred as is, and False if it is serialized; size
+    is the number of bytes to transfer; chunks iterates over them by chunks of
+    at most CHUNK_SIZE bytes. Values of descriptors created by
+    Descriptor.from_file are read by chunks.
+    """
+    file_value = descriptor.file_value
+    if file_value is not None:
+        return True, file_value.size(), file_value.iter_chunks(CHUNK_SIZE)
+    value = descriptor.value
+    raw = isinstance(value, str)
+    data = value if raw else value_serializer.dumps(value)
+    chunks = (data[i:i+CHUNK_SIZE] for i in xrange(0, len(data), CHUNK_SIZE))
+    return raw, len(data), chunks
+
+
+def serialize_small(descriptor, serializer):
+    """
+    Returns descriptor serialized with serializer, to be pushed in a single
+    message, or None if its value is larger than CHUNK_SIZE and must be pushed
+    by chunks. Sizes of str and file values are checked before anything is
+    serialized; other values are serialized once, with their descriptor.
+    """
+    file_value = descriptor.file_value
+    if file_value is not None:
+        if file_value.size() > CHUNK_SIZE:
+            return None
+    elif isinstance(descriptor.value, str):
+        if len(descriptor.value) > CHUNK_SIZE:
+            return None
+    else:
+        data = descriptor.serialize(serializer)
+        return data if len(data) <= CHUNK_SIZE else None
+    return descriptor.serialize(serializer)
+
+
+def push_chunks(size, raw, chunks, begin, send_chunk, commit):
+    """
+    Pushes a value by chunks, as returned by value_chunks.
+
+    :param begin: begin(size, raw) returns a transfer id, "" if the bus master
+        refuses the descriptor
+    :param send_chunk: send_chunk(transfer_id, offset, data) returns False if
+        the bus master rejects the chunk
+    :param commit: commit(transfer_id, digest) returns True if the descriptor
+        has been added
+    """
+    transfer_id = begin(size, raw)
+    if not transfer_id:
+        return False
+    digest = hashlib.sha256()
+    offset = 0
+    for chunk in chunks:
+        if not send_chunk(transfer_id, offset, chunk):
+            log.warning("Transfer %s was aborted by the bus master at offset "
+                        "%d", transfer_id, offset)
+            return False
+        digest.update(chunk)
+        offset += len(chunk)
+    return bool(commit(transfer_id, digest.hexdigest()))
+
+
+def fetch_chunks(read_range):
+    """
+    Fetches a value by chunks, then checks it against its size and digest.
+    Returns None if the value does not exist or has not been received
+    correctly.
+
+    :param read_range: read_range(offset, length) returns the same as
+        ValueChunkReader.read, or None
+    """
+    first = read_range(0, CHUNK_SIZE)
+    if first is None:
+        return None
+    size, raw, digest, data = first
+    chunks = [data]
+    offset = len(data)
+    hashed = hashlib.sha256(data)
+    while offset < size:
+        result = read_range(offset, CHUNK_SIZE)
+        if result is None or not result[3] or result[0] != size:
+            log.warning("Value transfer interrupted at offset %d of %d",
+                        offset, size)
+            return None
+        data = result[3]
+        chunks.append(data)
+        hashed.update(data)
+        offset += len(data)
+    if offset != size or hashed.hexdigest() != digest:
+        log.error("Received value does not match its size or digest")
+        return None
+    data = ''.join(chunks)
+    del chunks
+    if raw:
+        return data
+    return value_serializer.loads(data)
+
+
+class IncomingValue(object):
+    """
+    Value of a pushed descriptor that is being received by chunks, which are
+    written to a temporary file.
+    """
+
+    def __init__(self, agent_id, descriptor, size, raw):
+        """
+        :param descriptor: descriptor built from received metadata, without
+            its value
+        :param size: announced size of the transferred value
+        :param raw: True if the value is a str transferred as is, False if it
+            is serialized
+        """
+        self.agent_id = agent_id
+        self.descriptor = descriptor
+        self.size = size
+        self.raw = raw
+        self.received = 0
+        self.last_chunk_time = time.time()
+        self.fp = tempfile.TemporaryFile(prefix='rebus-value-')
+        self.digest = hashlib.sha256()
+
+    def write(self, offset, data):
+        """
+        Appends data, which must start at offset. Returns False if chunks are
+        received out of order, or exceed the announced size.
+        """
+        if offset != self.received or offset + len(data) > self.size:
+            return False
+        self.fp.write(data)
+        self.digest.update(data)
+        self.received += len(data)
+        self.last_chunk_time = time.time()
+        return True
+
+    def finish(self, digest):
+        """
+        Checks the received value against its announced size and digest.
+        Returns the descriptor, whose value is read from the temporary file,
+        None if checks fail. The descriptor must have been stored before
+        close() is called.
+        """
+        if self.received != self.size:
+            log.warning("Incomplete value for %s:%s: received %d of %d bytes",
+                        self.descriptor.domain, self.descriptor.selector,
+                        self.received, self.size)
+            return None
+        if self.digest.hexdigest() != digest:
+            log.warning("Digest mismatch for the value of %s:%s",
+                        self.descriptor.domain, self.descriptor.selector)
+            return None
+        self.fp.flush()
+        self.fp.seek(0)
+        if self.raw:
+            self.descriptor.bus = FileValue(self.fp)
+        else:
+            self.descriptor.value = value_serializer.loads(self.fp.read())
+        return self.descriptor
+
+    def close(self):
+        self.fp.close()
+
+
+class IncomingTransfers(object):
+    """
+    Values being pushed by chunks to a bus master, by transfer id.
+    """
+
+    def __init__(self):
+        #: transfer id -> IncomingValue
+        self.transfers = {}
+
+    def begin(self, agent_id, descriptor, size, raw):
+        """
+        Returns the id of a new transfer.
+        """
+        self.expire()
+        transfer_id = m_uuid.uuid4().hex
+        self.transfers[transfer_id] = IncomingValue(agent_id, descriptor,
+                                                    size, raw)
+        return transfer_id
+
+    def _get(self, agent_id, transfer_id):
+        incoming = self.transfers.get(transfer_id)
+        if incoming is None or incoming.agent_id != agent_id:
+            log.warning("Unknown transfer %s from %s", transfer_id, agent_id)
+            return None
+        return incoming
+
+    def write(self, agent_id, transfer_id, offset, data):
+        """
+        Returns False, and aborts the transfer, if data cannot be appended.
+        """
+        incoming = self._get(agent_id, transfer_id)
+        if incoming is None:
+            return False
+        if not incoming.write(offset, data):
+            log.warning("Aborting transfer %s from %s: unexpected chunk at "
+                        "offset %d", transfer_id, agent_id, offset)
+            self.discard(transfer_id)
+            return False
+        return True
+
+    def finish(self, agent_id, transfer_id, digest):
+        """
+        Ends a transfer. Returns the IncomingValue, whose finish method has
+        returned a descriptor, or None if the transfer has failed. The caller
+        is responsible for closing it.
+        """
+        incoming = self._get(agent_id, transfer_id)
+        if incoming is None:
+            return None
+        del self.transfers[transfer_id]
+        if incoming.finish(digest) is None:
+            incoming.close()
+            return None
+        return incoming
+
+    def discard(self, transfer_id):
+        incoming = self.transfers.pop(transfer_id, None)
+        if incoming is not None:
+            incoming.close()
+
+    def discard_agent(self, agent_id):
+        """
+        Discards transfers started by agent_id, e.g. when it unregisters.
+        """
+        for transfer_id, incoming in self.transfers.items():
+            if incoming.agent_id == agent_id:
+                self.discard(transfer_id)
+
+    def expire(self):
+        limit = time.time() - TRANSFER_TIMEOUT
+        for transfer_id, incoming in self.transfers.items():
+            if incoming.last_chunk_time < limit:
+                log.warning("Discarding stale transfer %s from %s",
+                            transfer_id, incoming.agent_id)
+                self.discard(transfer_id)
+
+
+class ValueChunkReader(object):
+    """
+    Serves ranges of stored descriptor values to bus slaves. Values stored as
+    raw strings in local files are read from these files; other values are
+    serialized once, and kept in a small LRU cache while they are being
+    transferred. Values that do not fit in this cache are written once to a
+    temporary file, which is removed when its entry is evicted.
+    """
+
+    def __init__(self, store, max_bytes=64 << 20, max_entries=16):
+        self.store = store
+        #: (domain, selector) -> (size, raw, digest, path, data), where data
+        #: is the transferred value, or the temporary file it has been
+        #: written to, at path
+        self.cache = LRUCache(max_bytes, max_entries)
+
+    def _entry(self, domain, selector):
+        key = (domain, selector)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry
+        path = self.store.get_value_path(domain, selector)
+        if path is not None:
+            hashed = hashlib.sha256()
+            size = 0
+            try:
+                for chunk in FileValue(path).iter_chunks(CHUNK_SIZE):
+                    hashed.update(chunk)
+                    size += len(chunk)
+            except (IOError, OSError):
+                path = None
+            else:
+                entry = (size, True, hashed.hexdigest(), path, None)
+                self.cache.put(key, entry, 0)
+                return entry
+        value = self.store.get_value(domain, selector)
+        if value is None:
+            return None
+        raw = isinstance(value, str)
+        data = value if raw else value_serializer.dumps(value)
+        del value
+        digest = hashlib.sha256(data).hexdigest()
+        if len(data) <= self.cache.max_bytes:
+            entry = (len(data), raw, digest, None, data)
+            self.cache.put(key, entry, len(data))
+            return entry
+        spool = tempfile.NamedTemporaryFile(prefix='rebus-value-')
+        spool.write(data)
+        spool.flush()
+        entry = (len(data), raw, digest, spool.name, spool)
+        self.cache.put(key, entry, 0)
+        return entry
+
+    def read(self, domain, selector, offset, length):
+        """
+        Returns (size, raw, digest, data), where data contains at most length
+        bytes of the transferred value, starting at offset; size and digest
+        are the size and sha256 digest of the whole transferred value; raw is
+        False if the value is serialized. Returns None if there is no such
+        descriptor.
+        """
+        entry = self._entry(domain, selector)
+        if entry is None:
+            return None
+        size, raw, digest, path, data = entry
+        length = min(length, CHUNK_SIZE)
+        if path is None:
+            return size, raw, digest, data[offset:offset+length]
+        try:
+            with open(path, 'rb') as fp:
+                fp.seek(offset)
+                return size, raw, digest, fp.read(length)
+        except (IOError, OSError):
+            # value has been deleted
+            self.cache.discard((domain, selector))
+            return None
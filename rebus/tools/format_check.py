@@ -48,23 +48,22 @@ def processing_depth(store, descriptor):
     * Forbid having >3 precursors at different depths (ex. a precursor (parent),
         and a precursor of that precursor (~grandparent)) having the same
         selector (excluding hash) - used to ensure analyses terminate
+
+    Relies on ancestry summaries maintained by store, hence only looks up
+    direct precursors.
     """
     selector_prefix = descriptor.selector.split('%')[0]
     levelset = set()
-    to_review = [(0, sel) for sel in descriptor.precursors]
-    while to_review:
-        l, s = to_review.pop()
-        if l > 1000:
-            # avoid loops
-            return False
-        prefix = s.split('%')[0]
-        if prefix == selector_prefix:
-            levelset.add(l)
-        d = store.get_descriptor(descriptor.domain, s)
-        if not d:
+    for sel in descriptor.precursors:
+        ancestry = store.get_ancestry(descriptor.domain, sel)
+        if ancestry is None:
             # precursor does not exist: refuse this.
             return False
-        to_review.extend([(l+1, sel) for sel in d.precursors])
+        depth, levels = ancestry
+        if depth > 1000:
+            # avoid loops
+            return False
+        levelset.update(levels.get(selector_prefix, ()))
         if len(levelset) > 2:
             return False
     return True
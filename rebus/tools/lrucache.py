@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe least-recently-used cache, bounded both in total size of
+    stored items and in number of entries. Item sizes are provided by the
+    caller.
+    """
+
+    def __init__(self, max_bytes, max_entries):
+        """
+        :param max_bytes: maximum total size of cached items
+        :param max_entries: maximum number of cached items
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        #: key -> (item, size), least recently used first
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        #: total size of cached items
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                item, size = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # move to the most recently used end
+            self._items[key] = (item, size)
+            self.hits += 1
+            return item
+
+    def put(self, key, item, size):
+        """
+        Adds item to the cache, evicting least recently used items if needed.
+        Items larger than max_bytes are not cached.
+        """
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            self._items[key] = (item, size)
+            self.size += size
+            while self.size > self.max_bytes or \
+                    len(self._items) > self.max_entries:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        """
+        Returns a dictionary containing cache counters.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self._items),
+                    'bytes': self.size}
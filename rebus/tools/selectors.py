@@ -89,8 +89,14 @@ def _default_guess(fname=None, buf=None, label=None, magic_txt=""):
         # make sure it's not a PE
         try:
             if fname is not None:
-                buf = open(fname).read()
-            if buf is not None:
+                # only read headers, files may be large
+                with open(fname, 'rb') as fp:
+                    fp.seek(0x3C)
+                    e_lfanew = struct.unpack('<I', fp.read(4))[0]
+                    fp.seek(e_lfanew)
+                    if fp.read(4) == "PE\x00\x00":
+                        return "/binary/pe"
+            elif buf is not None:
                 # MZ.e_lfanew
                 e_lfanew = struct.unpack('<I', buf[0x3C:0x3C+4])[0]
                 if buf[e_lfanew:e_lfanew+4] == "PE\x00\x00":
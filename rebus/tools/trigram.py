@@ -0,0 +1,45 @@
+"""
+Trigram helpers, used to index descriptor values and to narrow the set of
+values that have to be matched against a regular expression.
+
+A value can only match a regex if it contains every trigram of the literal
+strings that the regex requires; a trigram index therefore gives a superset
+of matching values, which must then be verified.
+"""
+import sre_constants
+import sre_parse
+
+
+def trigrams(data):
+    """
+    Returns the set of 3-byte substrings of data.
+    """
+    return set(data[i:i+3] for i in xrange(len(data) - 2))
+
+
+def regex_trigrams(regex):
+    """
+    Returns a set of trigrams that are present in every string matched by
+    re.match(regex). The set is empty if no such trigram could be found, in
+    which case any string may match.
+    """
+    try:
+        parsed = sre_parse.parse(regex)
+    except (sre_constants.error, OverflowError, RuntimeError):
+        return set()
+    if parsed.pattern.flags & sre_parse.SRE_FLAG_IGNORECASE:
+        # literals may match differently cased data
+        return set()
+    result = set()
+    run = []
+    # Only consecutive literals of the top-level sequence are used: they are
+    # required by every match. Anything else (alternatives, repetitions,
+    # character sets, groups) ends the current literal run.
+    for op, av in parsed:
+        if op == sre_constants.LITERAL and av < 256:
+            run.append(chr(av))
+            continue
+        result |= trigrams(''.join(run))
+        run = []
+    result |= trigrams(''.join(run))
+    return result
@@ -0,0 +1,43 @@
+"""
+Helpers to access descriptor values that are stored as raw (unserialized)
+strings in local files, such as DiskStorage value blobs.
+
+The bus master may provide the path of such files to agents running on the
+same host, which then read values directly instead of receiving them through
+the bus.
+"""
+import mmap
+import os
+
+
+def map_value_file(path):
+    """
+    Returns a read-only memory mapping of path, which supports slicing and
+    regular expression matching without reading the whole file. The caller is
+    responsible for closing it.
+    Returns None if path cannot be read, e.g. when it has been provided by a
+    bus master running on another host.
+    """
+    try:
+        with open(path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                # empty files cannot be mapped
+                return None
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def read_value_file(path):
+    """
+    Returns the contents of path as a str, None if it cannot be read.
+    """
+    mm = map_value_file(path)
+    if mm is None:
+        if os.path.isfile(path) and os.path.getsize(path) == 0:
+            return ''
+        return None
+    try:
+        return mm[:]
+    finally:
+        mm.close()
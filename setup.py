@@ -27,7 +27,7 @@ setup(
         'templates/descriptor/*.html']},
     scripts=[
         'bin/rebus_master_dbus', 'bin/rebus_master_rabbit', 'bin/rebus_agent',
-        'bin/rebus_infra', 'bin/rebus_master'],
+        'bin/rebus_infra', 'bin/rebus_master', 'bin/rebus_storage'],
     install_requires=[
         'pika',
         'larch-pickle'
@@ -0,0 +1,127 @@
+import copy
+import hashlib
+import os
+import pickle
+import uuid
+
+import pytest
+
+from rebus.descriptor import Descriptor
+from rebus.tools.serializer import picklev2
+
+
+# Inputs of the selector hash: (selector, value, agent, precursors)
+INPUTS = [
+    ('/binary/elf', '\x7fELF\x02\x01\x01', None, None),
+    ('/binary/', 'MZ' + '\x00' * 64, None, None),
+    ('/signature/md5', u'd41d8cd9 \xe9t\xe9', 'hasher', ['/binary/%aa']),
+    ('/link/linker/type/', {'selector': '/a/%bb', 'reason': 'same'},
+     'linker', ['/a/%bb', '/c/%dd']),
+    ('/counter', 42, 'count', []),
+]
+
+
+class LegacyDescriptor(object):
+    """
+    Descriptor of previous versions, which had no __slots__: it was pickled
+    as its __dict__, and derived its selector and uuid as follows.
+    """
+
+    def __init__(self, label, selector, value, agent, precursors):
+        if agent and precursors:
+            if type(value) is unicode:
+                strvalue = value.encode('utf-8')
+            else:
+                strvalue = str(value)
+            v = str(agent) + str(precursors) + selector + strvalue
+        else:
+            v = str(value)
+        self.label = label
+        self.precursors = precursors if precursors is not None else []
+        self.agent = agent
+        self.bus = None
+        self.hash = hashlib.sha256(v).hexdigest()
+        self.selector = os.path.join(selector, "%" + self.hash)
+        self.value = value
+        self.domain = "default"
+        self.version = 0
+        self.processing_time = -1
+        self.uuid = str(uuid.uuid5(Descriptor.NAMESPACE_REBUS, self.hash))
+
+
+def make_descriptors():
+    return [Descriptor('label %d' % i, selector, value, agent=agent,
+                       precursors=precursors)
+            for i, (selector, value, agent, precursors) in enumerate(INPUTS)]
+
+
+def test_selector_and_uuid():
+    for selector, value, agent, precursors in INPUTS:
+        desc = Descriptor('label', selector, value, agent=agent,
+                          precursors=precursors)
+        legacy = LegacyDescriptor('label', selector, value, agent,
+                                  precursors)
+        assert (desc.selector, desc.hash, desc.uuid) == \
+            (legacy.selector, legacy.hash, legacy.uuid)
+
+
+@pytest.mark.parametrize('protocol', [0, 1, 2])
+def test_pickle_protocols(protocol):
+    for desc in make_descriptors():
+        loaded = pickle.loads(pickle.dumps(desc, protocol))
+        assert loaded == desc
+        assert loaded.value == desc.value
+        assert (loaded.value_size, loaded.value_digest) == \
+            (desc.value_size, desc.value_digest)
+
+
+@pytest.mark.parametrize('protocol', [0, 1, 2])
+def test_legacy_pickle(protocol):
+    for i, (selector, value, agent, precursors) in enumerate(INPUTS):
+        legacy = LegacyDescriptor('label %d' % i, selector, value, agent,
+                                  precursors)
+        pickled = pickle.dumps(legacy, protocol)
+        # as if LegacyDescriptor was rebus.descriptor.Descriptor
+        old_name = '%s\nLegacyDescriptor\n' % __name__
+        assert old_name in pickled
+        pickled = pickled.replace(old_name, 'rebus.descriptor\nDescriptor\n')
+        loaded = pickle.loads(pickled)
+        desc = make_descriptors()[i]
+        assert type(loaded) is Descriptor
+        assert loaded == desc
+        assert loaded.value == value
+        assert (loaded.value_size, loaded.value_digest) == \
+            (desc.value_size, desc.value_digest)
+
+
+def test_serialize_trusted():
+    for desc in make_descriptors():
+        for serialized in (desc.serialize(picklev2),
+                           desc.serialize_meta(picklev2)):
+            checked = Descriptor.unserialize(picklev2, serialized)
+            trusted = Descriptor.unserialize(picklev2, serialized,
+                                             trusted=True)
+            assert trusted.selector == checked.selector == desc.selector
+            assert trusted.uuid == checked.uuid == desc.uuid
+            assert trusted.hash == checked.hash == desc.hash
+        assert Descriptor.unserialize(picklev2, desc.serialize(picklev2),
+                                      trusted=True) == desc
+
+
+def test_eq_copy():
+    descs = make_descriptors()
+    for desc in descs:
+        for copied in (copy.copy(desc), copy.deepcopy(desc)):
+            assert copied is not desc
+            assert copied == desc
+            assert not copied != desc
+            assert hash(copied) == hash(desc)
+    assert descs[0] != descs[1]
+    desc = copy.copy(descs[0])
+    desc.label = 'other'
+    assert desc != descs[0]
+    # value size and digest are not compared: they may not be known yet
+    desc = copy.copy(descs[3])
+    assert desc.value_size is not None
+    assert desc == Descriptor.unserialize(picklev2,
+                                          descs[3].serialize(picklev2))
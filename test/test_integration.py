@@ -32,7 +32,9 @@ rebus.buses.import_all()
 # TODO add argument parsing tests - check that help is displayed
 
 
-@pytest.fixture(scope='function', params=['diskstorage', 'ramstorage'])
+@pytest.fixture(scope='function',
+                params=['diskstorage', 'ramstorage', 'segmentstorage',
+                        'sqlitestorage'])
 def storage(request):
     """
     Returns a string that describes the storage type, and a list containing
@@ -42,9 +44,10 @@ def storage(request):
     # py.test-provided fixture "tmpdir" does not guarantee an empty temp
     # directory, which get re-used when test is run again - rolling our own...
     args = []
-    if request.param == 'diskstorage':
+    if request.param in ('diskstorage', 'segmentstorage',
+                         'sqlitestorage'):
         tmpdir = tempfile.mkdtemp('rebus-test-%s' % request.param)
-        args = ['diskstorage', '--path', tmpdir]
+        args = [request.param, '--path', tmpdir]
 
         def fin():
             shutil.rmtree(tmpdir)
@@ -110,8 +113,8 @@ def bus(request, storage):
             return busclass(bus_options)
     elif request.param == 'localbus':
         # always return the same bus instance
-        if storagetype == 'diskstorage':
-            pytest.skip("diskstorage is not supported by localbus")
+        if storagetype != 'ramstorage':
+            pytest.skip("%s is not supported by localbus" % storagetype)
         bus_options = argparse.Namespace()
         instance = BusRegistry.get(request.param)(bus_options)
 
@@ -0,0 +1,21 @@
+from rebus.tools.lrucache import LRUCache
+
+
+def test_lrucache_bounds():
+    cache = LRUCache(max_bytes=10, max_entries=3)
+    cache.put('a', 'A', 4)
+    cache.put('b', 'B', 4)
+    assert cache.get('a') == 'A'
+    # evicts b, least recently used
+    cache.put('c', 'C', 4)
+    assert cache.get('b') is None
+    assert cache.get('c') == 'C'
+    cache.put('d', 'D', 1)
+    cache.put('e', 'E', 1)
+    # evicts a, entry count bound
+    assert cache.get('a') is None
+    # larger than max_bytes: not cached
+    cache.put('f', 'F', 11)
+    assert cache.get('f') is None
+    assert cache.stats() == {'hits': 2, 'misses': 3, 'evictions': 2,
+                             'entries': 3, 'bytes': 6}
@@ -0,0 +1,1055 @@
+import argparse
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import pytest
+
+from rebus.descriptor import Descriptor
+from rebus.storage import StorageRegistry, RetentionRule
+from rebus.tools.serializer import picklev2 as store_serializer
+import rebus.storage_backends
+from rebus.storage_backends import diskstorage
+from rebus.tools import archive, chunked, format_check
+
+rebus.storage_backends.import_all()
+
+
+# This file tests storage backends directly, without running a bus.
+
+
+def make_storage(storagetype, args):
+    parser = argparse.ArgumentParser()
+    StorageRegistry.get(storagetype).add_arguments(parser)
+    options = parser.parse_args(args)
+    return StorageRegistry.get(storagetype)(options)
+
+
+def storage_factory(request, storagetype):
+    """
+    Returns a function that returns a storage instance. Several instances
+    returned by this function share the same persistent data. The name of
+    the backend is available as its name attribute.
+    """
+    args = []
+    if storagetype in ('diskstorage', 'segmentstorage', 'sqlitestorage'):
+        tmpdir = tempfile.mkdtemp('rebus-test-%s' % storagetype)
+        args = ['--path', tmpdir]
+
+        def fin():
+            shutil.rmtree(tmpdir)
+        request.addfinalizer(fin)
+
+    def factory(*extra):
+        return make_storage(storagetype, args + list(extra))
+    factory.name = storagetype
+    return factory
+
+
+@pytest.fixture(scope='function',
+                params=['diskstorage', 'ramstorage', 'segmentstorage',
+                        'sqlitestorage'])
+def storage(request):
+    """
+    Storage factory, for tests that apply to every backend.
+    """
+    return storage_factory(request, request.param)
+
+
+@pytest.fixture
+def disk_storage(request):
+    return storage_factory(request, 'diskstorage')
+
+
+@pytest.fixture
+def ram_storage(request):
+    return storage_factory(request, 'ramstorage')
+
+
+@pytest.fixture
+def segment_storage(request):
+    return storage_factory(request, 'segmentstorage')
+
+
+@pytest.fixture
+def sqlite_storage(request):
+    return storage_factory(request, 'sqlitestorage')
+
+
+def selector(desc):
+    return desc.selector if desc is not None else None
+
+
+def remove_db(store):
+    store.db.close()
+    for suffix in ('', '-wal', '-shm'):
+        fname = os.path.join(store.basepath, 'diskstorage.sqlite3' + suffix)
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+def populate(store):
+    """
+    Adds a small descriptor tree to store. Returns (root, child, version1)
+    """
+    root = Descriptor('sample', '/binary/elf', '\x7fELF' + 'A' * 100,
+                      agent='inject')
+    child = root.spawn_descriptor('/signature/md5', 'abcdef', 'hasher')
+    version1 = child.new_version('sample', 'fedcba', root.selector)
+    for desc in (root, child, version1):
+        assert store.add(desc)
+    return root, child, version1
+
+
+def test_add_get(storage):
+    store = storage()
+    root, child, version1 = populate(store)
+    assert not store.add(root)
+    assert selector(store.get_descriptor('default', root.selector)) == \
+        root.selector
+    assert store.get_value('default', child.selector) == 'abcdef'
+    assert store.get_descriptor('default', '/nonexistent/%' + 'a' * 64) \
+        is None
+    assert store.get_descriptor('otherdomain', root.selector) is None
+    assert store.get_value_path('default', '/nonexistent/%' + 'a' * 64) \
+        is None
+
+
+def test_versions(storage):
+    store = storage()
+    root, child, version1 = populate(store)
+    prefix = child.selector.split('%')[0]
+    assert selector(store.get_descriptor('default', prefix + '~0')) == \
+        child.selector
+    assert selector(store.get_descriptor('default', prefix + '~1')) == \
+        version1.selector
+    assert selector(store.get_descriptor('default', prefix + '~-1')) == \
+        version1.selector
+    assert selector(store.get_descriptor('default', prefix + '~-2')) == \
+        child.selector
+    assert store.get_descriptor('default', prefix + '~2') is None
+
+
+def test_uuids_children(storage):
+    store = storage()
+    root, child, version1 = populate(store)
+    assert store.list_uuids('default') == {root.uuid: 'sample'}
+    assert sorted(d.selector for d in
+                  store.find_by_uuid('default', root.uuid)) == \
+        sorted((root.selector, child.selector, version1.selector))
+    assert set(d.selector for d in
+               store.get_children('default', root.selector, False)) == \
+        set((child.selector, version1.selector))
+    assert len(store.find_by_value('default', '/binary', '\x7fELF')) == 1
+
+
+def test_lineage(storage):
+    store = storage()
+    root, child, version1 = populate(store)
+    # spawned from both child and version1
+    report = Descriptor('sample', '/report/summary', 'ok', agent='report',
+                        precursors=[child.selector, version1.selector],
+                        uuid=root.uuid)
+    assert store.add(report)
+
+    def lineage(sel, **kwargs):
+        return [(depth, desc.selector) for depth, desc in
+                store.get_lineage('default', sel, **kwargs)]
+
+    assert sorted(lineage(root.selector)) == sorted([
+        (1, child.selector), (1, version1.selector), (2, report.selector)])
+    assert len(lineage(root.selector, max_depth=1)) == 2
+    assert len(lineage(root.selector, max_count=1)) == 1
+    assert lineage(root.selector, selector_prefix='/report/') == \
+        [(2, report.selector)]
+    assert sorted(lineage(report.selector, ancestors=True)) == sorted([
+        (1, child.selector), (1, version1.selector), (2, root.selector)])
+    assert lineage('/nonexistent/%' + 'a' * 64) == []
+    assert set(d.selector for d in
+               store.get_children('default', root.selector)) == \
+        set((child.selector, version1.selector, report.selector))
+
+
+def test_ancestry(storage):
+    store = storage()
+    root, child, version1 = populate(store)
+    report = Descriptor('sample', '/report/summary', 'ok', agent='report',
+                        precursors=[child.selector, version1.selector],
+                        uuid=root.uuid)
+    assert store.add(report)
+    assert store.get_ancestry('default', report.selector) == \
+        (2, {'/report/summary/': (0,), '/signature/md5/': (1,),
+             '/binary/elf/': (2,)})
+    assert store.get_ancestry('default', '/nonexistent/%' + 'a' * 64) is None
+
+    # the same prefix may appear at 2 distinct levels of ancestors, not 3
+    unpack1 = report.spawn_descriptor('/report/summary', 'ok2', 'report')
+    assert format_check.processing_depth(store, unpack1)
+    assert store.add(unpack1)
+    unpack2 = unpack1.spawn_descriptor('/report/summary', 'ok3', 'report')
+    assert format_check.processing_depth(store, unpack2)
+    assert store.add(unpack2)
+    unpack3 = unpack2.spawn_descriptor('/report/summary', 'ok4', 'report')
+    assert not format_check.processing_depth(store, unpack3)
+    orphan = Descriptor('sample', '/report/summary', 'ok5', agent='report',
+                        precursors=['/nonexistent/%' + 'a' * 64])
+    assert not format_check.processing_depth(store, orphan)
+
+    if storage.name != 'ramstorage':
+        store.store_state()
+        store = storage()
+        assert store.get_ancestry('default', unpack2.selector) == \
+            (4, {'/report/summary/': (0, 1, 2), '/signature/md5/': (3,),
+                 '/binary/elf/': (4,)})
+
+
+def test_file_value(storage):
+    store = storage()
+    data = '\x7fELF' + os.urandom(3 << 20)
+    fd, fname = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(data)
+    try:
+        desc = Descriptor.from_file('sample', '/binary/elf', fname,
+                                    agent='inject')
+        assert desc.selector == \
+            Descriptor('sample', '/binary/elf', data).selector
+        # streams are read from their current position
+        stream = io.BytesIO('x' + data)
+        stream.read(1)
+        child = Descriptor.from_file('sample', '/binary/elf', stream,
+                                     agent='unpack',
+                                     precursors=[desc.selector])
+        assert child.selector == Descriptor(
+            'sample', '/binary/elf', data, agent='unpack',
+            precursors=[desc.selector]).selector
+        assert store.add(desc)
+        assert store.add(child)
+        if storage.name == 'diskstorage':
+            # copied by chunks
+            assert desc.file_value is not None
+        assert store.get_value('default', desc.selector) == data
+        assert store.get_value('default', child.selector) == data
+        assert not store.add(Descriptor.from_file('sample', '/binary/elf',
+                                                  fname, agent='inject'))
+    finally:
+        os.remove(fname)
+
+
+def test_value_metadata(storage):
+    store = storage()
+    root, child, version1 = populate(store)
+    text = root.spawn_descriptor('/text', u'caf\xe9', 'decoder')
+    assert store.add(text)
+    for desc, data in ((root, root.value), (child, 'abcdef'),
+                       (text, u'caf\xe9'.encode('utf-8'))):
+        stored = store.get_descriptor('default', desc.selector)
+        assert stored.value_size == desc.value_size == len(data)
+        assert stored.value_digest == desc.value_digest == \
+            hashlib.sha256(data).hexdigest()
+
+    class RemoteBus(object):
+        fetched = 0
+
+        def get_value(self, agent, domain, selector):
+            RemoteBus.fetched += 1
+            return store.get_value(domain, selector)
+
+    # as done by bus slaves
+    remote = Descriptor.unserialize(store_serializer,
+                                    child.serialize_meta(store_serializer),
+                                    bus=RemoteBus())
+    assert '[6 bytes]' in repr(remote)
+    assert remote.value_size == 6
+    assert RemoteBus.fetched == 0
+    assert remote.value == 'abcdef'
+    assert RemoteBus.fetched == 1
+    # metadata stored by previous versions
+    old_meta = store_serializer.dumps(dict(
+        (k, getattr(child, k)) for k in Descriptor.META_FIELDS
+        if not k.startswith('value_')))
+    old = Descriptor.unserialize(store_serializer, old_meta, bus=RemoteBus())
+    assert old.value_size is None and '[? bytes]' in repr(old)
+    assert old.value_digest is None
+    assert RemoteBus.fetched == 1
+    assert old.value == 'abcdef'
+    assert old.value_size == 6
+    assert old.value_digest == child.value_digest
+
+
+def test_chunked_transfer(storage):
+    # what bus masters and slaves do, without the bus
+    store = storage()
+    incoming = chunked.IncomingTransfers()
+    reader = chunked.ValueChunkReader(store)
+    data = os.urandom((3 << 20) + 5)
+    objvalue = {'data': data}
+    for desc in (Descriptor('sample', '/binary/elf', data, agent='inject'),
+                 Descriptor('sample', '/struct', objvalue, agent='inject')):
+        meta = Descriptor.unserialize(store_serializer,
+                                      desc.serialize_meta(store_serializer))
+        assert chunked.serialize_small(desc, store_serializer) is None
+        raw, size, chunks = chunked.value_chunks(desc)
+        assert size > chunked.CHUNK_SIZE
+        transfer = []
+
+        def commit(tid, digest):
+            result = incoming.finish('agent', tid, digest)
+            transfer.append(result)
+            if result is None:
+                return False
+            try:
+                return store.add(result.descriptor)
+            finally:
+                result.close()
+
+        assert chunked.push_chunks(
+            size, raw, chunks,
+            lambda size, raw: incoming.begin('agent', meta, size, raw),
+            lambda tid, offset, chunk: incoming.write('agent', tid, offset,
+                                                      chunk),
+            commit)
+        assert not incoming.transfers
+        assert store.get_value('default', desc.selector) == desc.value
+        assert chunked.fetch_chunks(
+            lambda offset, length: reader.read('default', desc.selector,
+                                               offset, length)) == desc.value
+    assert chunked.fetch_chunks(
+        lambda offset, length: reader.read('default', '/binary/elf/%00',
+                                           offset, length)) is None
+    # values larger than the cache are serialized once, then served from a
+    # temporary file
+    reader = chunked.ValueChunkReader(store, max_bytes=1 << 20)
+    calls = []
+    get_value = store.get_value
+    store.get_value = lambda *args: calls.append(args) or get_value(*args)
+    assert chunked.fetch_chunks(
+        lambda offset, length: reader.read('default', desc.selector,
+                                           offset, length)) == objvalue
+    assert len(calls) == 1
+    small = Descriptor('small', '/struct', {'data': 'abc'}, agent='inject')
+    assert Descriptor.unserialize(
+        store_serializer,
+        chunked.serialize_small(small, store_serializer)).value == small.value
+    # out of order chunks and corrupted values are refused
+    tid = incoming.begin('agent', meta, 4, True)
+    assert not incoming.write('agent', tid, 2, 'ab')
+    assert tid not in incoming.transfers
+    tid = incoming.begin('agent', meta, 4, True)
+    assert incoming.write('agent', tid, 0, 'abcd')
+    assert incoming.finish('agent', tid, '0' * 64) is None
+    tid = incoming.begin('agent', meta, 4, True)
+    incoming.discard_agent('agent')
+    assert not incoming.transfers
+
+
+def test_processed(storage):
+    store = storage()
+    root, child, version1 = populate(store)
+    assert store.mark_processed('default', root.selector, 'agent', '{}')
+    assert not store.mark_processed('default', root.selector, 'agent', '{}')
+    assert store.get_processed('default', root.selector) == \
+        set([('agent', '{}')])
+    unprocessed = store.list_unprocessed_by_agent('agent', '{}')
+    assert sorted(unprocessed) == sorted(
+        ('default', d.uuid, d.selector) for d in (child, version1))
+    # selectors are counted once per agent, whatever its configuration
+    assert store.mark_processed('default', root.selector, 'agent', 'conf')
+    assert store.mark_processed('default', child.selector, 'agent2', '{}')
+    assert store.processed_stats('default') == \
+        ([('agent', 1), ('agent2', 1)], 3)
+    assert store.processed_stats('otherdomain') == ([], 0)
+
+    # descriptors added or processed once iteration has started are skipped
+    backlog = store.iter_unprocessed_by_agent('agent', '{}')
+    assert store.add(Descriptor('new', '/text/', 'new', agent='test'))
+    assert store.mark_processed('default', child.selector, 'agent', '{}')
+    assert list(backlog) == [('default', version1.uuid, version1.selector)]
+    if store._name_ == 'diskstorage':
+        backlog = store.db.iter_unprocessed_by_agent('other', '{}', 1)
+        assert [sel for _, _, sel in backlog] == \
+            [d.selector for d in (root, child, version1)] + \
+            store.find('default', '/text/')
+        # counters are persistent, and computed for databases created by
+        # previous versions
+        stats = ([('agent', 2), ('agent2', 1)], 4)
+        store.store_state()
+        assert storage().processed_stats('default') == stats
+        store.db._cursor.execute(
+            "DELETE FROM storage_info WHERE key='processed_counts'")
+        store.db._cursor.execute('DELETE FROM processed_counts')
+        store.store_state()
+        assert storage().processed_stats('default') == stats
+
+
+def test_agent_state_deltas(storage):
+    store = storage()
+    store.store_agent_state('agent', 'state')
+    for i in range(10):
+        store.append_agent_state('agent', 'delta%d' % i)
+    assert store.load_agent_state('agent') == 'state'
+    deltas = []
+    position = 0
+    while True:
+        chunk, position = store.load_agent_state_deltas('agent', position,
+                                                        max_bytes=10)
+        if not chunk:
+            break
+        # reading stops once max_bytes have been exceeded
+        assert len(chunk) == 2 or chunk == ['delta9']
+        deltas.extend(chunk)
+    assert deltas == ['delta%d' % i for i in range(10)]
+    assert store.load_agent_state_deltas('other') == ([], 0)
+    assert sorted(store.list_agent_states()) == ['agent']
+
+    # storing the full state discards deltas
+    store.store_agent_state('agent', 'state2')
+    store.append_agent_state('agent', 'delta10')
+    if store._name_ != 'ramstorage':
+        store.store_state()
+        store = storage()
+    assert store.load_agent_state('agent') == 'state2'
+    assert store.load_agent_state_deltas('agent')[0] == ['delta10']
+    if store._name_ in ('diskstorage', 'segmentstorage'):
+        # interrupted append
+        fname = os.path.join(store.basepath, 'agent_intstate',
+                             'agent.intstate.deltas')
+        with open(fname, 'ab') as fp:
+            fp.write('\x10\x00\x00\x00\x00\x00\x00\x00trunc')
+        assert store.load_agent_state_deltas('agent')[0] == ['delta10']
+
+
+def test_archive(storage):
+    store = storage()
+    root, child, version1 = populate(store)
+    store.add(Descriptor('other', '/text/', {'a': 1}, domain='other',
+                         agent='test'))
+    store.mark_processed('default', child.selector, 'agent', '{}')
+    store.store_agent_state('agent', 'state')
+    fp = io.BytesIO()
+    counts = archive.export_storage(store, fp)
+    assert counts['descriptors'] == 4
+    assert counts['processed'] == 1
+    assert counts['intstates'] == 1
+
+    fp.seek(0)
+    dest = make_storage('ramstorage', [])
+    counts = archive.import_storage(dest, fp)
+    assert counts['descriptors'] == 4
+    assert [d.selector for d in dest.find_by_uuid('default', root.uuid)] == \
+        [d.selector for d in (root, child, version1)]
+    assert dest.get_value('default', root.selector) == root.value
+    sel = dest.find('other', '/text/', 1)[0]
+    assert dest.get_value('other', sel) == {'a': 1}
+    assert dest.get_processed('default', child.selector) == \
+        set([('agent', '{}')])
+    assert dest.load_agent_state('agent') == 'state'
+
+    # import into the same storage, selected uuids
+    fp = io.BytesIO()
+    archive.export_storage(store, fp, ['default'], [root.uuid], False)
+    fp.seek(0)
+    assert archive.import_storage(store, fp) == {
+        'descriptors': 0, 'existing': 3, 'processed': 1, 'intstates': 0}
+    with pytest.raises(archive.ArchiveError):
+        archive.import_storage(store, io.BytesIO(fp.getvalue()[:-5]))
+
+
+def test_diskstorage_reopen(disk_storage, monkeypatch):
+    store = disk_storage()
+    root, child, version1 = populate(store)
+    store.store_state()
+
+    def no_discover(self, relpath):
+        raise AssertionError("metadata must be served from the index")
+    monkeypatch.setattr(store.__class__, '_discover', no_discover)
+    store = disk_storage()
+    assert selector(store.get_descriptor('default', root.selector)) == \
+        root.selector
+    assert selector(store.get_descriptor(
+        'default', child.selector.split('%')[0] + '~-1')) == version1.selector
+    assert store.list_uuids('default') == {root.uuid: 'sample'}
+
+
+def test_diskstorage_rebuild_index(disk_storage):
+    store = disk_storage()
+    root, child, version1 = populate(store)
+    store.store_state()
+    # storage created by a previous version: no metadata index
+    remove_db(store)
+    store = disk_storage()
+    assert selector(store.get_descriptor('default', root.selector)) == \
+        root.selector
+    assert len(store.find_by_uuid('default', root.uuid)) == 3
+
+    # files of descriptors that are being added are skipped while the index
+    # is verified
+    added = Descriptor('added', '/binary/elf', 'added value', agent='test')
+    meta = added.serialize_meta(store_serializer)
+    basename = store._mkdirs('default', added.selector)
+    store._write_ref(basename, store.db.get_value_ref('default',
+                                                      root.selector))
+    assert store._discover('/', concurrent=True) == 0
+    with open(basename + '.meta', 'wb') as fp:
+        fp.write(meta[:len(meta) // 2])
+    assert store._discover('/', concurrent=True) == 0
+    with open(basename + '.meta', 'wb') as fp:
+        fp.write(meta)
+    store.pending_values[('default', added.selector)] = added.value
+    assert store._discover('/', concurrent=True) == 0
+    assert store.get_descriptor('default', added.selector) is None
+    del store.pending_values[('default', added.selector)]
+    assert store._discover('/', concurrent=True) == 1
+    assert selector(store.get_descriptor('default', added.selector)) == \
+        added.selector
+
+
+def test_diskstorage_dedup(disk_storage):
+    store = disk_storage()
+    desc = Descriptor('sample', '/binary/elf', 'same value', domain='default')
+    other = Descriptor('sample', '/binary/elf', 'same value', domain='other')
+    assert store.add(desc)
+    assert store.add(other)
+    value_ref = store.db.get_value_ref('default', desc.selector)
+    assert value_ref == store.db.get_value_ref('other', other.selector)
+    assert store.db.get_refcount(value_ref) == 2
+    blobs = [f for _, _, files in os.walk(store.blobs.path) for f in files]
+    assert blobs == [value_ref]
+    assert store.get_value('other', other.selector) == 'same value'
+
+
+def test_diskstorage_migrate_values(disk_storage):
+    store = disk_storage()
+    root, child, version1 = populate(store)
+    # convert to the layout used by previous versions: one .value file per
+    # descriptor, no blob store
+    for desc in (root, child, version1):
+        basename = store._pathFromSelector('default', desc.selector)
+        os.remove(basename + '.ref')
+        with open(basename + '.value', 'wb') as fp:
+            fp.write(desc.serialize_value(store_serializer))
+    shutil.rmtree(store.blobs.path)
+    remove_db(store)
+
+    store = disk_storage()
+    assert store.get_value('default', root.selector) == root.value
+    assert store.get_value('default', version1.selector) == 'fedcba'
+    basename = store._pathFromSelector('default', root.selector)
+    assert not os.path.exists(basename + '.value')
+    assert os.path.isfile(basename + '.ref')
+
+
+def test_diskstorage_group_commit(disk_storage):
+    store = disk_storage()
+    # clean shutdown, so that no index verification thread writes to the db
+    store.store_state()
+    store = disk_storage('--commit-interval', '60000')
+    root, child, version1 = populate(store)
+    assert store.mark_processed('default', root.selector, 'agent', '{}')
+    assert not store.mark_processed('default', root.selector, 'agent', '{}')
+    # not committed yet, but visible
+    assert store.db._pending > 0
+    assert store.get_processed('default', root.selector) == \
+        set([('agent', '{}')])
+    assert not store.mark_processable('default', root.selector, 'agent', '{}')
+    assert store.processed_stats('default') == ([('agent', 1)], 3)
+
+    assert store.mark_processed('default', child.selector, 'agent', '{}')
+    store.store_state()
+    store = disk_storage()
+    assert store.get_processed('default', child.selector) == \
+        set([('agent', '{}')])
+
+
+def test_diskstorage_raw_values(disk_storage):
+    store = disk_storage()
+    root, child, version1 = populate(store)
+    path = store.get_value_path('default', root.selector)
+    with open(path, 'rb') as fp:
+        assert fp.read() == root.value
+    link1, link2 = root.create_links(child, 'test', 'linktype', 'reason')
+    empty = Descriptor('empty', '/text/ascii', '')
+    for desc in (link1, empty):
+        assert store.add(desc)
+    assert store.get_value_path('default', link1.selector) is None
+    assert store.get_value('default', link1.selector) == link1.value
+    assert store.get_value('default', empty.selector) == ''
+    assert len(store.find_by_value('default', '/text/', '^$')) == 1
+    assert len(store.find_by_value('default', '/binary/elf', '\x7fELFA+$')) \
+        == 1
+
+
+def test_diskstorage_compression(disk_storage):
+    store = disk_storage('--compression', 'zlib', '--compression-min-size',
+                         '10', '--compress-exclude', '/text/')
+    values = {'/binary/elf': 'A' * 1000, '/text/ascii': 'B' * 1000,
+              '/archive/zip': 'C' * 1000, '/graph/dot': 'D' * 5,
+              '/link/test': {'key': 'E' * 1000}}
+    refs = {}
+    for sel, value in values.items():
+        desc = Descriptor('sample', sel, value)
+        assert store.add(desc)
+        refs[sel] = store.db.get_value_ref('default', desc.selector)
+        assert store.get_value('default', desc.selector) == value
+    assert refs['/binary/elf'].endswith('.raw.zlib')
+    assert refs['/link/test'].endswith('.zlib')
+    for sel in ('/text/ascii', '/archive/zip', '/graph/dot'):
+        assert refs[sel].endswith('.raw')
+    assert len(store.find_by_value('default', '/binary/', 'A+$')) == 1
+    stats = store.storage_stats()
+    assert stats['value_blobs'] == 5
+    assert stats['compression_ratio'] > 1
+
+
+def test_diskstorage_cache(disk_storage):
+    store = disk_storage('--cache-entries', '3')
+    root, child, version1 = populate(store)
+    # 3 descriptors and 3 values have been added
+    assert store.cache.stats()['evictions'] == 3
+    assert store.get_value('default', version1.selector) == 'fedcba'
+    assert store.cache.hits == 1
+    assert store.get_value('default', root.selector) == root.value
+    assert store.cache.misses == 1
+    assert store.get_value('default', root.selector) == root.value
+    stats = store.storage_stats()
+    assert stats['cache_hits'] == 2
+    assert stats['cache_entries'] == 3
+
+    store = disk_storage('--cache-bytes', '0')
+    assert store.get_value('default', root.selector) == root.value
+    assert store.get_value('default', root.selector) == root.value
+    assert len(store.cache) == 0
+    assert store.cache.hits == 0
+
+
+def test_diskstorage_shards(disk_storage):
+    store = disk_storage()
+    root, child, version1 = populate(store)
+    store.store_state()
+    store = disk_storage('--shard-levels', '2')
+    desc = Descriptor('sample', '/binary/elf', 'sharded')
+    assert store.add(desc)
+    fname = store._pathFromSelector('default', desc.selector) + '.meta'
+    h = desc.hash
+    assert fname.endswith('/elf/%s/%s/%%%s.meta' % (h[:2], h[2:4], h))
+    assert os.path.isfile(fname)
+    store.store_state()
+
+    # move existing files to the new layout
+    assert diskstorage.reshard(store.basepath, 2) == 3
+    assert diskstorage.reshard(store.basepath, 2) == 0
+    for d in (root, child, version1):
+        assert os.path.isfile(
+            store._pathFromSelector('default', d.selector) + '.meta')
+    # the layout is remembered
+    assert disk_storage().shard_levels == 2
+    # rebuilt index finds moved files
+    remove_db(store)
+    store = disk_storage()
+    assert len(store.find_by_uuid('default', root.uuid)) == 3
+    assert selector(store.get_descriptor('default', desc.selector)) == \
+        desc.selector
+    assert store.get_value('default', child.selector) == 'abcdef'
+
+
+def test_diskstorage_write_behind(disk_storage):
+    store = disk_storage('--write-threads', '2', '--write-queue-bytes', '150',
+                         '--cache-bytes', '0')
+    root, child, version1 = populate(store)
+    # available, whether files have been written or not
+    assert store.get_value('default', root.selector) == root.value
+    assert len(store.find_by_value('default', '/binary', '\x7fELF')) == 1
+    store.store_state()
+    assert store.pending_bytes == 0
+    for desc in (root, child, version1):
+        basename = store._pathFromSelector('default', desc.selector)
+        assert os.path.isfile(basename + '.meta')
+        assert store.db.get_value_ref('default', desc.selector) is not None
+    assert store.get_value('default', child.selector) == 'abcdef'
+
+    # descriptors whose files cannot be written are removed from the index
+    def write_ref(basename, value_ref):
+        raise IOError("No space left on device")
+    store._write_ref = write_ref
+    lost = Descriptor('lost', '/binary/elf', 'lost value', agent='test')
+    assert store.add(lost)
+    store.write_queue.join()
+    assert store.get_descriptor('default', lost.selector) is None
+    assert store.processed_stats('default') == ([], 3)
+    assert not store.pinned_refs
+    assert store.pending_bytes == 0
+
+
+def test_diskstorage_recover_writes(disk_storage):
+    store = disk_storage()
+    root, child, version1 = populate(store)
+    # crash while files of a descriptor were being written: files have been
+    # written, but value reference has not been set in the index
+    store.db._cursor.execute(
+        'UPDATE descriptors SET value_ref=NULL WHERE selector=?',
+        (root.selector,))
+    # files have not been written
+    lost = Descriptor('lost', '/binary/elf', 'lost value')
+    store.db.add_descriptor(lost, lost.serialize_meta(store_serializer))
+    store.db.flush()
+
+    store = disk_storage()
+    assert store.get_value('default', root.selector) == root.value
+    assert store.get_descriptor('default', lost.selector) is None
+
+
+def test_find(storage):
+    store = storage()
+    root, child, version1 = populate(store)
+    for agent in ('agent1', 'agent2'):
+        store.mark_processed('default', root.selector, agent, '{}')
+    # newest first, each selector once
+    assert store.find('default', '/signature/') == \
+        [version1.selector, child.selector]
+    assert store.find('default', '/.*/md5') == \
+        [version1.selector, child.selector]
+    assert store.find('default', '/binary/el?f') == [root.selector]
+    # inline flags apply to the whole regex
+    assert store.find('default', '/BINARY/(?i)') == [root.selector]
+    assert store.find('default', '/sig|/bin', limit=1, offset=1) == \
+        [child.selector]
+    assert store.find('otherdomain', '.*') == []
+    assert [d.selector for d in store.find_by_selector(
+        'default', '/signature/md5')] == [child.selector, version1.selector]
+    assert [d.selector for d in store.find_by_selector(
+        'default', '/', limit=2, offset=1)] == \
+        [child.selector, version1.selector]
+
+
+def test_find_by_value(storage):
+    name = storage.name
+    extra = []
+    if name in ('diskstorage', 'sqlitestorage'):
+        # values larger than 20 bytes are not indexed
+        extra = ['--trigram-max-size', '20']
+    if name == 'diskstorage':
+        extra += ['--search-processes', '2']
+    store = storage(*extra)
+    indexed = hasattr(store, '_index_trigrams')
+    if indexed:
+        # values containing more trigrams are not indexed
+        store.db.MAX_BLOB_TRIGRAMS = 9
+    values = ['MZ header %d' % i for i in xrange(5)] + \
+        ['MZ' + 'x' * 100, '\x7fELF header v2', 'MZ header 1']
+    descs = [Descriptor('sample', '/binary/%d' % i, value, agent='test')
+             for i, value in enumerate(values)]
+    for desc in descs:
+        store.add(desc)
+    store.add(Descriptor('text', '/text/', 'MZ header', agent='test'))
+
+    def found(*args, **kwargs):
+        return [d.selector for d in
+                store.find_by_value('default', '/binary/', *args, **kwargs)]
+    if indexed:
+        # values that have not been indexed yet are always read
+        assert found('MZ header 1') == [descs[1].selector, descs[7].selector]
+        while store._index_trigrams():
+            pass
+
+        def is_indexed(desc):
+            return store.db.is_trigram_indexed(
+                store.db.get_value_ref('default', desc.selector))
+        assert is_indexed(descs[0])
+        assert not is_indexed(descs[5])
+        assert not is_indexed(descs[6])
+    # oldest first
+    assert found('MZ header') == \
+        [descs[i].selector for i in (0, 1, 2, 3, 4, 7)]
+    assert found('MZ header 1') == [descs[1].selector, descs[7].selector]
+    assert found('MZ x+$') == []
+    assert found('MZx+$') == [descs[5].selector]
+    assert found('(?i)mz.*3') == [descs[3].selector]
+    assert found('.*ELF') == [descs[6].selector]
+    assert found('MZ', limit=2, offset=3) == \
+        [descs[3].selector, descs[4].selector]
+    store.store_state()
+
+
+def test_retention_rule():
+    rule = RetentionRule.parse('*:/binary/:max-age=2d,max-bytes=1k')
+    assert (rule.domain, rule.prefix, rule.max_age, rule.max_bytes,
+            rule.max_count) == ('*', '/binary/', 2 * 86400, 1024, None)
+    assert str(rule) == '*:/binary/:max-age=172800,max-bytes=1024'
+    for text in ('/binary/:max-age=2d', 'default:/binary/:max-age=2x',
+                 'default:/binary/:size=2', 'd!:/binary/:max-count=1'):
+        with pytest.raises(ValueError):
+            RetentionRule.parse(text)
+    # newest first
+    records = [('/a/%3', 'u', 1, 100, 500), ('/a/%2', 'u', 0, 100, 500),
+               ('/a/%1', 'v', 0, 10, 10)]
+    assert list(rule.expired(records, 100)) == []
+    assert list(rule.expired(records, 10 + 2 * 86400 + 1)) == ['/a/%1']
+    rule = RetentionRule('default', '/a/', max_bytes=600)
+    assert list(rule.expired(records, 100)) == ['/a/%2', '/a/%1']
+    rule = RetentionRule('default', '/a/', keep_versions=1)
+    assert list(rule.expired(records, 100)) == ['/a/%2']
+    # expired versions do not count towards other limits
+    rule = RetentionRule.parse('default:/a/:max-count=2,keep-versions=1')
+    assert list(rule.expired(records, 100)) == ['/a/%2']
+    rule = RetentionRule.parse('default:/a/:max-bytes=510,keep-versions=1')
+    assert list(rule.expired(records, 100)) == ['/a/%2']
+
+
+def test_collect_garbage(storage):
+    store = storage('--gc-interval', '0', '--retention',
+                    'default:/signature/:keep-versions=1',
+                    'default:/binary/:max-count=2')
+    root, child, version1 = populate(store)
+    binaries = [Descriptor('bin', '/binary/pe', 'MZ%d' % i, agent='test')
+                for i in xrange(2)]
+    for desc in binaries:
+        assert store.add(desc)
+    store.mark_processed('default', child.selector, 'agent', '{}')
+
+    report = store.collect_garbage(dry_run=True)
+    assert report['descriptors'] == 2
+    assert report['rules'] == {'default:/signature/:keep-versions=1': 1,
+                               'default:/binary/:max-count=2': 1}
+    assert selector(store.get_descriptor('default', child.selector)) == \
+        child.selector
+
+    report = store.collect_garbage()
+    assert report['descriptors'] == 2
+    assert report['bytes'] > 0
+    for desc in (root, child):
+        assert store.get_descriptor('default', desc.selector) is None
+    for desc in [version1] + binaries:
+        assert selector(store.get_descriptor('default', desc.selector)) == \
+            desc.selector
+    assert store.find('default', '/signature/') == [version1.selector]
+    assert store.processed_stats('default') == ([], 3)
+    assert sorted(store.list_unprocessed_by_agent('agent', '{}')) == \
+        sorted(('default', d.uuid, d.selector) for d in binaries + [version1])
+    assert store.storage_stats()['gc_descriptors'] == 2
+    assert store.collect_garbage()['descriptors'] == 0
+    # deleted descriptors cannot be marked anymore
+    assert not store.mark_processed('default', child.selector, 'a', '{}')
+    assert not store.mark_processable('default', child.selector, 'a', '{}')
+    assert store.get_processed('default', child.selector) == set()
+    assert store.get_processable('default', child.selector) == set()
+    assert store.processed_stats('default') == ([], 3)
+    if store._name_ == 'diskstorage':
+        # value of child is not referenced anymore
+        assert report['blobs'] == 2
+        assert store.db.get_value_ref('default', child.selector) is None
+        assert store.db.list_orphan_blobs() == []
+        assert not os.path.exists(
+            store._pathFromSelector('default', child.selector) + '.meta')
+    store.store_state()
+
+
+def test_segmentstorage_reopen(segment_storage):
+    store = segment_storage()
+    root, child, version1 = populate(store)
+    store.mark_processed('default', root.selector, 'agent', '{}')
+    store.store_state()
+    # index is loaded from the index file, records appended afterwards are
+    # replayed
+    store = segment_storage()
+    assert store.add(Descriptor('int', '/int/', 42, agent='test'))
+    assert store.mark_processed('default', child.selector, 'agent', '{}')
+    store = segment_storage()
+    assert store.get_value('default', root.selector) == root.value
+    assert store.get_value('default', store.find('default', '/int/')[0]) == 42
+    assert selector(store.get_descriptor(
+        'default', child.selector.split('%')[0] + '~-1')) == version1.selector
+    assert store.processed_stats('default') == ([('agent', 2)], 4)
+    # incomplete records written during a crash are truncated
+    segment = store._segment_path(store.active)
+    size = os.path.getsize(segment)
+    with open(segment, 'ab') as fp:
+        fp.write('D\x00\x10')
+    store = segment_storage()
+    assert os.path.getsize(segment) == size
+    # the index can be rebuilt from segments
+    os.remove(os.path.join(store.basepath, 'index'))
+    store = segment_storage()
+    assert store.processed_stats('default') == ([('agent', 2)], 4)
+    assert store.find('default', '/') == segment_storage().find('default', '/')
+
+
+def test_segmentstorage_compact(segment_storage):
+    store = segment_storage('--segment-size', '500', '--retention',
+                            'default:/binary/:max-count=1')
+    descs = [Descriptor('bin', '/binary/pe', 'MZ%d' % i + 'x' * 400,
+                        agent='test') for i in xrange(4)]
+    for desc in descs:
+        assert store.add(desc)
+        store.mark_processed('default', desc.selector, 'agent', '{}')
+    segments = store._list_segments()
+    assert len(segments) == 5
+    assert store.collect_garbage()['descriptors'] == 3
+    # deleted descriptors are removed from the prefix index
+    assert store.prefixes['default'] == ['/binary/pe/']
+    assert list(store.by_prefix['default']['/binary/pe/']) == \
+        [descs[3].selector]
+    assert store.compact() > 0
+    assert store._list_segments()[0] > segments[0]
+    stats = store.storage_stats()
+    assert stats['segments'] == 2
+    assert stats['compact_segments'] == 3
+    assert store.get_value('default', descs[3].selector) == descs[3].value
+    store.store_state()
+    # load the index file, then rebuild the index from segments
+    for rebuild in (False, True):
+        if rebuild:
+            os.remove(os.path.join(store.basepath, 'index'))
+        store = segment_storage()
+        assert store.find('default', '/binary/') == [descs[3].selector]
+        assert [d.selector for d in store.find_by_selector(
+            'default', '/binary/p')] == [descs[3].selector]
+        assert store.get_value('default', descs[3].selector) == \
+            descs[3].value
+        assert store.processed_stats('default') == ([('agent', 1)], 1)
+
+
+def test_segmentstorage_compact_deletions(segment_storage):
+    store = segment_storage('--segment-size', '2000', '--retention',
+                            'default:/binary/:max-count=1')
+    kept = Descriptor('cfg', '/config/x', 'C' * 1000, agent='test')
+    deleted = Descriptor('bin', '/binary/pe', 'MZ' + 'x' * 300, agent='test')
+    assert store.add(kept)
+    assert store.add(deleted)
+    # segment 0 contains both descriptors, and remains mostly live; the
+    # segment that contains the deletion record becomes mostly dead
+    for i in xrange(3):
+        store.add(Descriptor('bin', '/binary/pe', 'MZ%d' % i + 'z' * 300,
+                             agent='test'))
+        store.collect_garbage()
+    assert 0 in store._list_segments()
+    assert store.compact() > 0
+    assert 0 in store._list_segments()
+    store.store_state()
+    os.remove(os.path.join(store.basepath, 'index'))
+    store = segment_storage()
+    assert store.get_descriptor('default', deleted.selector) is None
+    assert store.get_value('default', kept.selector) == kept.value
+    assert len(store.find('default', '/binary/')) == 1
+
+
+def test_sqlitestorage_values(sqlite_storage):
+    store = sqlite_storage('--out-of-line-size', '50', '--retention',
+                           'default:/binary/:max-count=1')
+    small = Descriptor('small', '/binary/', 'MZ small', agent='test')
+    large = Descriptor('large', '/binary/', 'MZ' + 'x' * 100, agent='test')
+    serialized = Descriptor('int', '/int/', [1] * 100, agent='test')
+    for desc in (small, large, serialized):
+        assert store.add(desc)
+    assert store.get_value_path('default', small.selector) is None
+    path = store.get_value_path('default', large.selector)
+    with open(path, 'rb') as fp:
+        assert fp.read() == large.value
+    assert store.get_value('default', serialized.selector) == [1] * 100
+    assert [d.selector for d in store.find_by_value('default', '/', 'MZ')] == \
+        [small.selector, large.selector]
+    assert store.storage_stats()['inline_values'] == 1
+    store.store_agent_state('agent', 'state')
+    store.store_state()
+    store = sqlite_storage('--retention', 'default:/binary/:max-count=1')
+    assert store.load_agent_state('agent') == 'state'
+    assert store.load_agent_state('other') == ''
+    # values of deleted descriptors are removed
+    report = store.collect_garbage()
+    assert (report['descriptors'], report['blobs']) == (1, 1)
+    assert store.storage_stats()['inline_values'] == 0
+    assert store.get_value('default', large.selector) == large.value
+    store.store_state()
+
+
+def test_ramstorage_spill(ram_storage):
+    store = ram_storage('--max-value-bytes', '250', '--gc-interval', '0',
+                        '--retention', 'default:/binary/:max-count=3')
+    descs = [Descriptor('bin', '/binary/', 'MZ%d' % i + 'x' * 97,
+                        agent='test') for i in xrange(3)]
+    descs.append(Descriptor('dict', '/binary/', {'key': 'x' * 100},
+                            agent='test'))
+    for desc in descs:
+        assert store.add(desc)
+    stats = store.storage_stats()
+    assert stats['resident_values'] == 2
+    assert stats['values_spilled'] == 2
+    # metadata stays in memory, values are reloaded when accessed
+    desc = store.get_descriptor('default', descs[0].selector)
+    assert desc.label == 'bin'
+    assert store.storage_stats()['values_reloaded'] == 0
+    assert desc.value == descs[0].value
+    assert store.get_value('default', descs[1].selector) == descs[1].value
+    assert store.storage_stats()['resident_value_bytes'] <= 250
+    assert [d.selector for d in store.find_by_value(
+        'default', '/binary/', 'MZ2')] == [descs[2].selector]
+    # spilled values are not loaded into stored descriptors
+    for desc in store.find_by_selector('default', '/binary/'):
+        assert desc.value == descs[[d.selector for d in descs].index(
+            desc.selector)].value
+    assert store.storage_stats()['resident_value_bytes'] <= 250
+    # sizes are recorded when descriptors are added
+    assert store.value_sizes['default'][descs[0].selector] == 100
+    report = store.collect_garbage()
+    assert (report['descriptors'], report['bytes']) == (1, 100)
+    assert store.storage_stats()['spill_files'] == 3
+    assert descs[0].selector not in store.value_sizes['default']
+
+
+def test_ramstorage_indexes(ram_storage):
+    store = ram_storage('--gc-interval', '0', '--retention',
+                        'default:/signature/:keep-versions=1')
+    root, child, version1 = populate(store)
+    other = Descriptor('other', '/binary/pe', 'MZ', agent='inject')
+    assert store.add(other)
+    assert store.find('default', '/signature/md5/%') == \
+        [version1.selector, child.selector]
+    assert store.find('default', child.selector) == [child.selector]
+    assert [d.selector for d in store.find_by_selector(
+        'default', '/binary/')] == [root.selector, other.selector]
+    assert store.list_uuids('default') == {root.uuid: 'sample',
+                                           other.uuid: 'other'}
+    store.collect_garbage()
+    assert store.prefixes['default'] == ['/binary/elf/', '/binary/pe/',
+                                         '/signature/md5/']
+    assert [d.selector for d in store.find_by_uuid('default', root.uuid)] \
+        == [root.selector, version1.selector]
+    store._delete_descriptor('default', other.selector)
+    store._delete_descriptor('default', root.selector)
+    # only version1 is left, its label is used
+    assert store.list_uuids('default') == {root.uuid: 'sample'}
+    assert store.prefixes['default'] == ['/signature/md5/']
+
+
+def test_ramstorage_gc_processing(ram_storage):
+    store = ram_storage('--gc-interval', '0', '--gc-rate', '0', '--retention',
+                        'default:/binary/:max-count=1')
+    descs = [Descriptor('bin', '/binary/pe', 'MZ%d' % i, agent='test')
+             for i in xrange(3)]
+    for desc in descs:
+        assert store.add(desc)
+    # descriptors locked by agents are kept until they have been processed
+    store.set_processing('default', descs[0].selector, True)
+    store.set_processing('default', descs[1].selector, True)
+    store.set_processing('default', descs[1].selector, True)
+    store.set_processing('default', descs[1].selector, False)
+    assert store.collect_garbage()['descriptors'] == 0
+    assert store.mark_processed('default', descs[0].selector, 'agent', '{}')
+    assert store.collect_garbage()['descriptors'] == 1
+    assert store.get_descriptor('default', descs[0].selector) is None
+    store.processing[('default', descs[1].selector)] = \
+        (1, time.time() - store.PROCESSING_TIMEOUT)
+    assert store.collect_garbage()['descriptors'] == 1
+    assert store.processing == {}
+
+    # garbage is collected by a background thread
+    store = ram_storage('--gc-interval', '1', '--retention',
+                        'default:/binary/:max-count=1')
+    for desc in descs:
+        assert store.add(desc)
+    for _ in xrange(50):
+        if store.storage_stats()['gc_runs']:
+            break
+        time.sleep(0.1)
+    assert store.find('default', '/binary/') == [descs[2].selector]